@@ -0,0 +1,94 @@
+# benchmarks/bench_logging.py
+# Measures what logging adds to a handler-shaped coroutine (one DB read plus a handful of log calls).
+# Compares logging switched off, the synchronous StreamHandler setup and the queued setup used in production.
+#
+#   python benchmarks/bench_logging.py [iterations]
+#
+# Log output goes to a temporary file so terminal speed does not skew the numbers; the "slow" runs add
+# a fixed delay per write to stand in for a stdout pipe whose reader (e.g. the host's log collector) lags.
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_and_utils
+import db_operations
+
+logger = logging.getLogger("handlers")
+
+SLOW_WRITE_SECONDS = 0.0005
+
+
+class SlowStream:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        time.sleep(SLOW_WRITE_SECONDS)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+async def fake_handler(user_id: int):
+    logger.info("User %s opened the order history", user_id)
+    orders = await asyncio.to_thread(db_operations.get_user_orders_from_db, user_id)
+    logger.debug("Loaded %s orders for %s", len(orders), user_id)
+    for order in orders[:3]:
+        logger.info("Rendering order %s for %s", order[0], user_id)
+    logger.info("Order history sent to %s", user_id)
+
+
+async def measure(iterations: int) -> list:
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await fake_handler(1000 + i % 50)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label: str, samples: list):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{label:<12} mean {statistics.fmean(samples):7.3f} ms   p50 {statistics.median(samples):7.3f} ms   p99 {p99:7.3f} ms")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, "bench.log"), "a", encoding="utf-8") as log_file:
+        config_and_utils.setup_logging(stream=log_file, use_queue=False)
+        db_operations.DB_NAME = os.path.join(tmp, "bench.db")
+        db_operations.init_db()
+        db_operations.add_product_to_db("Bench product", 10.0)
+        product_id = db_operations.get_products_from_db()[0][0]
+        for user_id in range(1000, 1050):
+            db_operations.save_order_to_db(user_id, "Bench", [{'id': product_id, 'name': "Bench product", 'price': 10.0, 'quantity': 1.0}], 10.0)
+
+        slow_file = SlowStream(log_file)
+        scenarios = [
+            ("off", dict(level="CRITICAL", use_queue=False)),
+            ("sync", dict(use_queue=False)),
+            ("queued", dict(use_queue=True)),
+            ("sync-json", dict(fmt="json", use_queue=False)),
+            ("queued-json", dict(fmt="json", use_queue=True)),
+            ("sync-slow", dict(stream=slow_file, use_queue=False)),
+            ("queued-slow", dict(stream=slow_file, use_queue=True)),
+        ]
+        for label, options in scenarios:
+            options = {"level": "INFO", "stream": log_file, **options}
+            config_and_utils.setup_logging(**options)
+            asyncio.run(measure(iterations // 10)) # warm-up
+            report(label, asyncio.run(measure(iterations)))
+        config_and_utils.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
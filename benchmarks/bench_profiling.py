@@ -0,0 +1,77 @@
+# benchmarks/bench_profiling.py
+# What /profile costs the bot while it runs (profiling.py). The same synthetic catalog browses as
+# bench_shops run back to back on the event loop, first without a profile and then inside each kind of profile.
+#
+#   python benchmarks/bench_profiling.py [seconds]
+#
+# "slowdown" is the throughput lost compared with the unprofiled run; the report's own overhead line (sampler
+# CPU time or calibrated slowdown) is printed next to it, so the two measurements can be checked against each other.
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:BENCH") # handlers imports bot-wide settings
+
+import db_operations
+
+PRODUCTS = 200
+USERS = 200
+
+
+async def _browse(handlers, update_id: int, sessions: dict):
+    user_id = 1 + update_id % USERS
+    context = sessions.setdefault(user_id, SimpleNamespace(user_data={'language_code': "lt" if user_id % 2 else "en"}, chat_data={}, bot_data={}))
+    await handlers._paged_catalog_rows(context, user_id, update_id % 5, 0, True, "order_flow", "order_flow_select_prod_",
+                                       lambda product: f"{product[1]} - {product[2]:.2f} EUR/kg")
+    await handlers._(context, "cart_total", user_id=user_id, total_price=12.5)
+
+async def _throughput(handlers, seconds: float, profile=None) -> tuple[float, str]:
+    sessions, browses = {}, 0
+    task = asyncio.create_task(profile) if profile else None
+    await asyncio.sleep(0) # Let the profile start before timing
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        await _browse(handlers, browses, sessions)
+        browses += 1
+        if browses % 50 == 0: await asyncio.sleep(0) # Yield like separate updates would
+    rate = browses / seconds
+    report = await task if task else ""
+    return rate, next((line for line in report.splitlines() if "overhead" in line or "slows" in line), "")
+
+
+async def run(seconds: float):
+    import handlers
+    import profiling
+    from config_and_utils import load_translations
+    load_translations()
+    await _throughput(handlers, 1.0) # Warm the catalog cache
+    baseline, _line = await _throughput(handlers, seconds)
+    print(f"{'profile':<26} {'browses/s':>10} {'slowdown':>9}   measured by the profile")
+    print(f"{'none':<26} {baseline:>10.0f} {'':>9}")
+    for label, use_cprofile, with_memory in (("sampling", False, False), ("sampling + tracemalloc", False, True),
+                                             ("cProfile", True, False), ("cProfile + tracemalloc", True, True)):
+        assert profiling.claim()
+        rate, line = await _throughput(handlers, seconds, profiling.profile_live_traffic(seconds, use_cprofile, with_memory))
+        print(f"{label:<26} {rate:>10.0f} {(1 - rate / baseline) * 100:>8.1f}%   {line}")
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        db_operations.DB_NAME = os.path.join(tmp, "bench.db")
+        db_operations.init_db()
+        categories = [db_operations.add_category_to_db(f"Category {i}") for i in range(6)]
+        for i in range(PRODUCTS):
+            product_id = db_operations.add_product_to_db(f"Product {i:03d}", 1.0 + i % 13)
+            db_operations.update_product_in_db(product_id, category_id=categories[i % len(categories)])
+        asyncio.run(run(seconds))
+
+
+if __name__ == "__main__":
+    main()
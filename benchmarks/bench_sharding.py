@@ -0,0 +1,105 @@
+# benchmarks/bench_sharding.py
+# Throughput of the multi-process mode (sharding.py) for 1..N worker processes.
+# The parent routes synthetic raw updates with sharding.shard_for_update over multiprocessing queues,
+# exactly like the ingest does. Each worker runs the CPU-heavy part of a catalog browse: translations
+# and keyboard building through handlers._paged_catalog_rows, plus the user's order history from the
+# shared WAL database. No Telegram calls are made.
+#
+#   python benchmarks/bench_sharding.py [updates] [max_workers]
+#
+# Scaling is bounded by the number of CPU cores (os.cpu_count() is printed).
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING") # Inherited by the worker processes
+
+USERS = 500
+PRODUCTS = 200
+
+
+def _setup_database(db_path: str):
+    import db_operations
+    db_operations.DB_NAME = db_path
+    db_operations.init_db()
+    categories = [db_operations.add_category_to_db(f"Category {i}") for i in range(8)]
+    for i in range(PRODUCTS):
+        product_id = db_operations.add_product_to_db(f"Product {i:03d}", 1.0 + i % 17)
+        db_operations.update_product_in_db(product_id, category_id=categories[i % len(categories)])
+    for user_id in range(1, USERS + 1, 5):
+        db_operations.save_order_to_db(user_id, "Bench", [{'id': 1, 'name': "Product 000", 'price': 1.0, 'quantity': 2.0}], 2.0)
+
+
+async def _handle(handlers, db_operations, update: dict, sessions: dict):
+    user_id = update["callback_query"]["from"]["id"]
+    context = sessions.setdefault(user_id, SimpleNamespace(user_data={'language_code': "lt" if user_id % 2 else "en"}, chat_data={}, bot_data={}))
+    page = update["update_id"] % 5
+    await handlers._paged_catalog_rows(context, user_id, page, 0, True, "order_flow", "order_flow_select_prod_",
+                                       lambda product: f"{product[1]} - {product[2]:.2f} EUR/kg")
+    await handlers._(context, "cart_total", user_id=user_id, total_price=12.5)
+    db_operations.get_user_orders_from_db(user_id)
+
+
+def _worker(db_path: str, updates, done):
+    import config_and_utils
+    import db_operations
+    import handlers
+    db_operations.DB_NAME = config_and_utils.DB_NAME = db_path
+    config_and_utils.load_translations()
+    sessions = {}
+    done.put("ready")
+
+    async def run():
+        processed = 0
+        while True:
+            update = updates.get()
+            if update is None: break
+            await _handle(handlers, db_operations, update, sessions)
+            processed += 1
+        return processed
+
+    done.put(asyncio.run(run()))
+
+
+def _run(worker_count: int, update_count: int, db_path: str) -> float:
+    from sharding import shard_for_update
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue() for _ in range(worker_count)]
+    done = mp.Queue()
+    workers = [mp.Process(target=_worker, args=(db_path, queues[i], done)) for i in range(worker_count)]
+    updates = [{"update_id": n, "callback_query": {"from": {"id": 1 + n % USERS}, "data": "order_flow_page_1"}} for n in range(update_count)]
+    for worker in workers: worker.start()
+    for _ in workers: done.get() # Interpreter start-up and imports are not measured
+    started = time.perf_counter()
+    for update in updates:
+        queues[shard_for_update(update, worker_count)].put(update)
+    for queue in queues: queue.put(None)
+    processed = sum(done.get() for _ in workers)
+    elapsed = time.perf_counter() - started
+    for worker in workers: worker.join()
+    assert processed == update_count
+    return update_count / elapsed
+
+
+def main():
+    update_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else min(4, os.cpu_count() or 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        _setup_database(db_path)
+        print(f"cpu_count={os.cpu_count()} updates={update_count}")
+        baseline = None
+        for worker_count in range(1, max_workers + 1):
+            throughput = _run(worker_count, update_count, db_path)
+            baseline = baseline or throughput
+            print(f"{worker_count} worker(s): {throughput:8.0f} updates/s  ({throughput / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
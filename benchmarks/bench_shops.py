@@ -0,0 +1,120 @@
+# benchmarks/bench_shops.py
+# Several shops in one process (shops.py) compared with one process per shop.
+# Each shop gets its own SQLite file and catalog, and a built Application with every handler registered
+# (no network). Synthetic catalog browses are spread over the shops and run concurrently,
+# each in its shop's context, doing the CPU-heavy part of a browse as bench_sharding does. Every browse
+# checks that it only sees its own shop's products and orders, and that jobs run in their shop's context.
+#
+#   python benchmarks/bench_shops.py [max_shops] [updates]
+#
+# Each shop count is measured in a fresh interpreter, so RSS is not inflated by earlier runs. The
+# "separate" column is what the same shops cost as single-shop processes (N x the RSS of one).
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:BENCH") # bot.py reads it at import; every shop has its own below
+
+USERS = 300
+PRODUCTS = 150
+CONCURRENCY = 64
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) / 1024
+
+def _populate(shop):
+    import db_operations
+    db_operations.init_db()
+    categories = [db_operations.add_category_to_db(f"{shop.name} category {i}") for i in range(6)]
+    for i in range(PRODUCTS):
+        product_id = db_operations.add_product_to_db(f"{shop.name} product {i:03d}", 1.0 + i % 13)
+        db_operations.update_product_in_db(product_id, category_id=categories[i % len(categories)])
+    for user_id in range(1, USERS + 1, 10):
+        db_operations.save_order_to_db(user_id, shop.name, [{'id': 1, 'name': f"{shop.name} product 000", 'price': 1.0, 'quantity': 1.0}], 1.0)
+
+
+async def _browse(handlers, storage, shop, update_id: int, sessions: dict):
+    user_id = 1 + update_id % USERS
+    context = sessions.setdefault((shop.name, user_id), SimpleNamespace(user_data={'language_code': "lt" if user_id % 2 else "en"}, chat_data={}, bot_data={}))
+    rows, *_rest = await handlers._paged_catalog_rows(context, user_id, update_id % 5, 0, True, "order_flow", "order_flow_select_prod_",
+                                                      lambda product: f"{product[1]} - {product[2]:.2f} EUR/kg")
+    labels = [button.text for row in rows for button in row if button.callback_data.startswith("order_flow_select_prod_")]
+    assert labels and all(label.startswith(f"{shop.name} product") for label in labels), (shop, labels[:2])
+    await handlers._(context, "cart_total", user_id=user_id, total_price=12.5)
+    for order in await storage.backend.get_user_orders(user_id):
+        assert shop.name in order[4], (shop, order)
+
+
+async def _measure(shop_count: int, update_count: int):
+    import bot
+    import handlers
+    import shops
+    import storage
+    from config_and_utils import current_shop, load_translations
+
+    load_translations()
+    with tempfile.TemporaryDirectory() as tmp:
+        shop_list = [shops.Shop(f"shop{i}", f"{1000 + i}:BENCH", [1], os.path.join(tmp, f"shop{i}.db")) for i in range(shop_count)]
+        shops.configure_shops(shop_list)
+        for shop in shop_list: shop.context().run(_populate, shop)
+        # Shared jobs would try to deliver the seeded orders' notifications; only the per-process jobs are scheduled.
+        applications = [shop.context().run(bot.build_application, with_shared_jobs=False, token=shop.token) for shop in shop_list]
+
+        # A job scheduled by a shop's application runs in that shop's context.
+        seen = asyncio.Queue()
+        async def report_shop(context): await seen.put((context.application, current_shop.get()))
+        async def start(application): # Not application.initialize(): that calls getMe
+            await application.job_queue.start()
+            application.job_queue.run_once(report_shop, 0)
+        await asyncio.gather(*(asyncio.create_task(start(application), context=shop.context()) for shop, application in zip(shop_list, applications)))
+        for _ in shop_list:
+            application, shop = await seen.get()
+            assert shop_list[applications.index(application)] is shop
+
+        sessions, semaphore = {}, asyncio.Semaphore(CONCURRENCY)
+        async def browse(update_id: int):
+            async with semaphore:
+                await _browse(handlers, storage, shop_list[update_id % shop_count], update_id, sessions)
+        for update_id in range(shop_count * 5): # Warm the per-shop catalog caches
+            await asyncio.create_task(browse(update_id), context=shop_list[update_id % shop_count].context())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(asyncio.create_task(browse(update_id), context=shop_list[update_id % shop_count].context()) for update_id in range(update_count)))
+        elapsed = time.perf_counter() - started
+        rss = _rss_mb()
+        for application in applications:
+            await application.job_queue.stop()
+    print(f"{update_count / elapsed:.0f} {rss:.1f}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        asyncio.run(_measure(int(sys.argv[2]), int(sys.argv[3])))
+        return
+    max_shops = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    update_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    print(f"updates={update_count} products/shop={PRODUCTS}")
+    print(f"{'shops':>5} {'updates/s':>10} {'RSS MB':>8} {'MB/shop added':>14} {'separate MB':>12}")
+    single_rss = None
+    shop_count = 1
+    while shop_count <= max_shops:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", str(shop_count), str(update_count)],
+                                capture_output=True, text=True, check=True).stdout.split()
+        throughput, rss = float(output[-2]), float(output[-1])
+        single_rss = single_rss or rss
+        added = (rss - single_rss) / (shop_count - 1) if shop_count > 1 else 0.0
+        print(f"{shop_count:>5} {throughput:>10.0f} {rss:>8.1f} {added:>14.2f} {single_rss * shop_count:>12.1f}")
+        shop_count *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# benchmarks/bench_slots.py
+# Concurrent checkouts into a few delivery slots, to show the capacity counters are never overbooked.
+#
+#   python benchmarks/bench_slots.py sqlite [checkouts] [concurrency]
+#   BENCH_DATABASE_URL=postgresql://localhost/bot_bench python benchmarks/bench_slots.py postgres [checkouts] [concurrency]
+#
+# Every checkout picks one of SLOTS slots and carries 1-5 kg, so slots fill up on orders and on kg.
+# SQLite checkouts run save_order_to_db on `concurrency` threads (separate connections, like sharded workers);
+# PostgreSQL checkouts run `concurrency` at a time over the connection pool. Afterwards the slot counters must
+# match the accepted orders exactly and stay within capacity, and cancelling orders must give the room back.
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import db_operations
+import storage
+
+SLOTS = 3
+CAPACITY_ORDERS = 40
+CAPACITY_KG = 90.0
+
+
+async def run(backend: storage.Storage, checkouts: int, concurrency: int, threaded: bool):
+    await backend.open()
+    try:
+        await backend.bulk_upsert_products([("Potatoes", 1.0, 1, "Vegetables")])
+        product_id = (await backend.get_products())[0][0]
+        start_ts = int(time.time()) + 86400
+        slot_times = [(start_ts + i * 7200, start_ts + i * 7200 + 3600) for i in range(SLOTS)]
+        assert await backend.ensure_delivery_slots(slot_times, CAPACITY_ORDERS, CAPACITY_KG) == SLOTS
+        assert await backend.ensure_delivery_slots(slot_times, CAPACITY_ORDERS, CAPACITY_KG) == 0
+        slot_ids = [row[0] for row in await backend.get_available_delivery_slots(0, 0, SLOTS)]
+
+        semaphore = asyncio.Semaphore(concurrency)
+        accepted, full = {slot_id: [] for slot_id in slot_ids}, 0 # slot_id -> [(order_id, kg, checkout index)]
+
+        async def save(i: int):
+            slot_id, kg = slot_ids[i % SLOTS], float(1 + i % 5)
+            cart = [{'id': product_id, 'name': "Potatoes", 'price': 1.0, 'quantity': kg}]
+            if threaded: # SqliteStorage calls run on the loop; threads give real concurrent connections
+                return await asyncio.to_thread(db_operations.save_order_to_db, i, "User", cart, kg, None, f"slots:{i}", slot_id)
+            return await backend.save_order(i, "User", cart, kg, idempotency_key=f"slots:{i}", slot_id=slot_id)
+
+        async def checkout(i: int):
+            nonlocal full
+            async with semaphore:
+                order_id = await save(i)
+            assert order_id is not None, "checkout failed with a database error"
+            if order_id == db_operations.SLOT_FULL: full += 1
+            else: accepted[slot_ids[i % SLOTS]].append((order_id, float(1 + i % 5), i))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(checkout(i) for i in range(checkouts)))
+        elapsed = time.perf_counter() - started
+
+        def check_counters(overview):
+            for slot_id, _start, _end, booked_orders, capacity_orders, booked_kg, capacity_kg in overview:
+                orders = accepted[slot_id]
+                assert booked_orders == len(orders) <= capacity_orders, (slot_id, booked_orders, len(orders))
+                assert abs(booked_kg - sum(kg for _id, kg, _i in orders)) < 1e-9 and booked_kg <= capacity_kg, (slot_id, booked_kg)
+
+        overview = await backend.get_delivery_slot_overview(0, SLOTS)
+        check_counters(overview)
+        assert sum(len(orders) for orders in accepted.values()) + full == checkouts
+        # A duplicate tap on an accepted checkout returns the same order and books nothing more.
+        order_id, _kg, i = accepted[slot_ids[0]][0]
+        assert await save(i) == order_id
+        check_counters(await backend.get_delivery_slot_overview(0, SLOTS))
+
+        # Cancelling gives the room back; completing does not.
+        cancelled = accepted[slot_ids[0]][:5]
+        assert sorted(await backend.set_orders_status([row[0] for row in cancelled], 'cancelled')) == sorted(row[0] for row in cancelled)
+        accepted[slot_ids[0]] = accepted[slot_ids[0]][5:]
+        assert await backend.set_orders_status([row[0] for row in accepted[slot_ids[1]][:5]], 'completed')
+        check_counters(await backend.get_delivery_slot_overview(0, SLOTS))
+        assert slot_ids[0] in [row[0] for row in await backend.get_available_delivery_slots(0, 1.0, SLOTS)]
+
+        # A slot starting within the booking lead time is refused even with room left (e.g. a picker left open).
+        soon_ts = db_operations.slot_booking_cutoff(int(time.time())) - 60
+        assert await backend.ensure_delivery_slots([(soon_ts, soon_ts + 3600)], CAPACITY_ORDERS, CAPACITY_KG) == 1
+        soon_id = next(row[0] for row in await backend.get_delivery_slot_overview(0, SLOTS + 1) if row[1] == soon_ts)
+        cart = [{'id': product_id, 'name': "Potatoes", 'price': 1.0, 'quantity': 1.0}]
+        assert await backend.save_order(1, "User", cart, 1.0, idempotency_key="slots:soon", slot_id=soon_id) == db_operations.SLOT_FULL
+        assert next(row[3] for row in await backend.get_delivery_slot_overview(0, SLOTS + 1) if row[0] == soon_id) == 0
+
+        for slot_id, start, end, booked_orders, capacity_orders, booked_kg, capacity_kg in overview:
+            print(f"slot {slot_id}: {booked_orders}/{capacity_orders} orders, {booked_kg:.0f}/{capacity_kg:.0f} kg")
+        print(f"{checkouts} checkouts ({concurrency} concurrent) in {elapsed:.2f}s: {checkouts - full} booked, {full} turned away as full")
+        print("checks passed: no slot overbooked")
+    finally:
+        await backend.close()
+
+
+async def run_postgres(url: str, checkouts: int, concurrency: int):
+    import asyncpg
+    schema = f"bench_slots_{os.getpid()}"
+    admin = await asyncpg.connect(url)
+    try:
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        await run(storage.PostgresStorage(url, max_size=concurrency, server_settings={'search_path': schema}), checkouts, concurrency, threaded=False)
+    finally:
+        await admin.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await admin.close()
+
+
+def main():
+    backend_name = sys.argv[1] if len(sys.argv) > 1 else "sqlite"
+    checkouts = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    if backend_name == "postgres":
+        url = os.getenv("BENCH_DATABASE_URL")
+        if not url: sys.exit("Set BENCH_DATABASE_URL to a scratch PostgreSQL database.")
+        asyncio.run(run_postgres(url, checkouts, concurrency))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        db_operations.DB_NAME = os.path.join(tmp, "bench.db")
+        db_operations.init_db()
+        asyncio.run(run(storage.SqliteStorage(), checkouts, concurrency, threaded=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# benchmarks/bench_storage.py
+# Runs the same checks and timings against either storage backend (storage.py).
+#
+#   python benchmarks/bench_storage.py sqlite [iterations] [concurrency]
+#   BENCH_DATABASE_URL=postgresql://localhost/bot_bench python benchmarks/bench_storage.py postgres [iterations] [concurrency]
+#
+# The checks assert that the backend returns the same shapes and follows the same rules (idempotent
+# checkout, rollups, outbox, reorder lines, staff roles) before anything is timed. The timings run the handler-side
+# calls `concurrency` at a time, the way concurrent updates hit the backend.
+# SQLite uses a temporary file. PostgreSQL uses a throw-away schema in BENCH_DATABASE_URL, dropped at the end;
+# it is a separate variable from DATABASE_URL so the bot's own database is never touched by accident.
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import db_operations
+import storage
+
+USERS = 200
+PRODUCTS = 200
+PAGE_SIZE = 8
+
+
+async def populate(backend: storage.Storage):
+    rows = [(f"Product {i:03d}", 1.0 + i % 17, 1, f"Category {i % 8}") for i in range(PRODUCTS)]
+    summary = await backend.bulk_upsert_products(rows)
+    assert summary and len(summary['added']) == PRODUCTS, summary
+    for user_id in range(1, USERS + 1):
+        await backend.ensure_user(user_id, f"User {user_id}", None)
+
+
+async def check(backend: storage.Storage):
+    """ Behaviour both backends must share. Leaves two cancelled orders and one pending order behind. """
+    products, page, total_pages, categories, category_id = await backend.get_catalog_page(0, PAGE_SIZE)
+    assert len(products) == PAGE_SIZE and page == 0 and total_pages == -(-PRODUCTS // PAGE_SIZE) and len(categories) == 8 and category_id == 0
+    product = await backend.get_product(products[0][0])
+    assert product[:4] == products[0] and product[4]
+    assert [row[1] for row in await backend.search_products("product 01")][:1] == ["Product 010"]
+    assert await backend.get_user_language(1) == await backend.ensure_user(1, "User 1", None)
+
+    # Staff roles (a role can be given before the user ever wrote to the bot) and languages of many users in one query.
+    assert await backend.set_user_role(5, 'packer') and await backend.set_user_role(10**9, 'viewer')
+    assert await backend.get_staff_roles() == {5: 'packer', 10**9: 'viewer'}
+    assert await backend.set_user_role(10**9, None) and await backend.get_staff_roles() == {5: 'packer'}
+    await backend.set_user_language(6, 'en')
+    assert await backend.get_user_languages([5, 6, 10**12]) == {5: db_operations.DEFAULT_LANGUAGE, 6: 'en'}
+
+    cart = [{'id': product[0], 'name': product[1], 'price': product[2], 'quantity': 1.5}]
+    order_id = await backend.save_order(1, "User 1", cart, product[2] * 1.5, idempotency_key="bench:1")
+    assert order_id and await backend.save_order(1, "User 1", cart, product[2] * 1.5, idempotency_key="bench:1") == order_id
+    assert [order[0] for order in await backend.get_user_orders(1)] == [order_id]
+    assert (await backend.get_reorder_lines(order_id, 1))[0][:4] == (product[0], product[1], 1.5, product[2])
+    assert await backend.get_reorder_lines(order_id, 2) == []
+    assert await backend.get_shopping_list() == [(product[1], 1.5)]
+    assert await backend.mark_order_completed(order_id) and not await backend.mark_order_completed(order_id)
+
+    events = await backend.get_due_outbox_events()
+    assert [event[2]['order_id'] for event in events] == [order_id]
+    assert await backend.record_outbox_delivery(events[0][0], 42, 'sent')
+    assert (await backend.get_due_outbox_events())[0][4] == {42}
+    assert await backend.finish_outbox_event(events[0][0], True, events[0][3])
+    assert await backend.get_due_outbox_events() == []
+
+    today = db_operations.rollup_day(int(time.time()))
+    assert (await backend.get_sales_stats(today, today, today))['today'][:3] == (1, product[2] * 1.5, 1)
+    assert await backend.rebuild_sales_rollups() == 1
+    assert (await backend.get_sales_stats(today, today, today))['today'][:3] == (1, product[2] * 1.5, 1)
+
+    # Bulk status changes: one UPDATE per action, only allowed transitions, cancelled orders leave the rollups.
+    second = await backend.save_order(2, "User 2", cart, product[2] * 1.5, idempotency_key="bench:2")
+    third = await backend.save_order(2, "User 2", cart, product[2] * 1.5, idempotency_key="bench:3")
+    assert [order[0] for order in await backend.get_orders_by_status()] == [second, third]
+    assert await backend.set_orders_status([second], 'confirmed', notify_customers=True) == [second]
+    assert sorted(await backend.set_orders_status([order_id, second, third], 'cancelled', notify_customers=True)) == [second, third]
+    assert await backend.get_orders_by_status() == [] and await backend.get_shopping_list() == []
+    for _ in range(2):
+        stats = await backend.get_sales_stats(today, today, today)
+        assert stats['today'][:3] == (1, product[2] * 1.5, 1) and stats['top_products'][0][1:] == (1.5, product[2] * 1.5), stats
+        assert await backend.rebuild_sales_rollups() == 1
+    events = await backend.get_due_outbox_events()
+    assert sorted((event[1], event[2].get('status')) for event in events) == [('order_created', None)] * 2 + [('order_status_changed', 'cancelled')] * 2 + [('order_status_changed', 'confirmed')]
+    for event in events: await backend.finish_outbox_event(event[0], True, event[3])
+    batches = [rows async for rows in backend.iter_order_export_rows(100)]
+    assert len(batches) == 1 and batches[0][0][0] == order_id
+
+    # Purging completed orders keeps their sales, also through the nightly rebuild (the day keeps a pending order too).
+    pending = await backend.save_order(4, "User 4", cart, product[2] * 1.5, idempotency_key="bench:4")
+    for event in await backend.get_due_outbox_events(): await backend.finish_outbox_event(event[0], True, event[3])
+    before_purge = await backend.get_sales_stats(today, today, today)
+    assert before_purge['today'][:3] == (2, product[2] * 3, 1), before_purge
+    assert await backend.delete_completed_orders() == 1 and await backend.get_user_orders(1) == []
+    assert await backend.delete_completed_orders() == 0
+    for _ in range(2):
+        assert await backend.get_sales_stats(today, today, today) == before_purge
+        assert await backend.rebuild_sales_rollups() == 1
+    assert [order[0] for order in await backend.get_user_orders(4)] == [pending]
+
+    # Standing orders: placed once per week at current prices, deleted products skipped, one digest per batch.
+    gone = {'id': 10**6, 'name': "Gone", 'price': 1.0, 'quantity': 1.0}
+    standing_id = await backend.create_standing_order(3, "User 3", None, cart + [gone], 2)
+    (_id, weekday, next_run_ts, summary), = await backend.get_user_standing_orders(3)
+    assert _id == standing_id and weekday == 2 and "Gone" in summary
+    assert await backend.materialize_standing_orders(next_run_ts - 1) == []
+    runs = await backend.materialize_standing_orders(next_run_ts)
+    assert len(runs) == 1 and runs[0]['order_id'] and runs[0]['skipped'] == ["Gone"], runs
+    assert runs[0]['next_run_ts'] == db_operations.next_weekly_run(2, next_run_ts) > next_run_ts
+    assert await backend.materialize_standing_orders(next_run_ts) == []
+    assert [order[0] for order in await backend.get_user_orders(3)] == [runs[0]['order_id']]
+    events = await backend.get_due_outbox_events()
+    assert sorted(event[1] for event in events) == ['standing_order_placed', 'standing_orders_digest'], events
+    for event in events: await backend.finish_outbox_event(event[0], True, event[3])
+    assert not await backend.delete_standing_order(standing_id, 4) and await backend.delete_standing_order(standing_id, 3)
+    print("checks passed")
+
+
+async def timed(label: str, operation, iterations: int, concurrency: int):
+    samples = []
+
+    async def worker(offset: int):
+        for i in range(offset, iterations, concurrency):
+            start = time.perf_counter()
+            await operation(i)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    samples.sort()
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{label:<14} {iterations / elapsed:9.0f} ops/s   p50 {statistics.median(samples):7.3f} ms   p99 {p99:7.3f} ms")
+
+
+async def run(backend: storage.Storage, iterations: int, concurrency: int):
+    await backend.open()
+    try:
+        await populate(backend)
+        await check(backend)
+        products = await backend.get_products()
+        cart = [{'id': products[0][0], 'name': products[0][1], 'price': products[0][2], 'quantity': 1.0}]
+
+        print(f"iterations={iterations} concurrency={concurrency}")
+        await timed("ensure_user", lambda i: backend.ensure_user(1 + i % USERS, "User", None), iterations, concurrency)
+        await timed("catalog_page", lambda i: backend.get_catalog_page(i % 25, PAGE_SIZE), iterations, concurrency)
+        await timed("get_product", lambda i: backend.get_product(products[i % len(products)][0]), iterations, concurrency)
+        await timed("search", lambda i: backend.search_products(f"product {i % 100:02d}"), iterations, concurrency)
+        await timed("save_order", lambda i: backend.save_order(1 + i % USERS, "User", cart, products[0][2], idempotency_key=f"bench-order:{i}"), iterations, concurrency)
+        await timed("user_orders", lambda i: backend.get_user_orders(1 + i % USERS), iterations, concurrency)
+
+        # Standing orders are placed by one job in batches, so this is a single timed run rather than concurrent calls.
+        for user_id in range(1, USERS + 1):
+            await backend.create_standing_order(user_id, "User", None, cart, 0)
+        due_ts = max(row[2] for row in await backend.get_user_standing_orders(USERS))
+        started, placed = time.perf_counter(), 0
+        while runs := await backend.materialize_standing_orders(due_ts):
+            placed += len(runs)
+        elapsed = time.perf_counter() - started
+        print(f"{'standing':<14} {placed / elapsed:9.0f} orders/s in batches of {db_operations.STANDING_ORDER_BATCH_SIZE} ({placed} placed)")
+    finally:
+        await backend.close()
+
+
+async def run_postgres(url: str, iterations: int, concurrency: int):
+    import asyncpg
+    schema = f"bench_storage_{os.getpid()}"
+    admin = await asyncpg.connect(url)
+    try:
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        await run(storage.PostgresStorage(url, server_settings={'search_path': schema}), iterations, concurrency)
+    finally:
+        await admin.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await admin.close()
+
+
+def main():
+    backend_name = sys.argv[1] if len(sys.argv) > 1 else "sqlite"
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    if backend_name == "postgres":
+        url = os.getenv("BENCH_DATABASE_URL")
+        if not url: sys.exit("Set BENCH_DATABASE_URL to a scratch PostgreSQL database.")
+        asyncio.run(run_postgres(url, iterations, concurrency))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        db_operations.DB_NAME = os.path.join(tmp, "bench.db")
+        db_operations.init_db()
+        asyncio.run(run(storage.SqliteStorage(), iterations, concurrency))
+
+
+if __name__ == "__main__":
+    main()
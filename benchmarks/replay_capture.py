@@ -0,0 +1,270 @@
+# benchmarks/replay_capture.py
+# Replays captured traffic (capture.py, TRAFFIC_CAPTURE_DIR) through every handler of the bot against a fake
+# Bot API and a scratch SQLite database, and reports latency and call counts per handler callback.
+#
+#   python benchmarks/replay_capture.py CAPTURE.jsonl.gz [...] [--speed 10] [--db backup.db] [--api-latency-ms 40]
+#                                       [--json report.json] [--baseline old_report.json]
+#
+# Updates are fed at their recorded pace divided by --speed (0 = all at once) and processed the way
+# Application does it, so a burst queues up exactly as in production. "update ms" is the time from an update's
+# scheduled arrival to the end of its processing, queueing included; the per-handler numbers are the handler's
+# own time. Counted per handler: storage.backend calls, SQLite connections opened by db_operations, and Bot API
+# requests (answered at once, or after --api-latency-ms to model the round trip to Telegram).
+#
+# --db copies a database (e.g. a nightly backup) as the starting point, so product and order ids in the
+# capture resolve; otherwise the replay starts from an empty database. Senders get the staff role they had
+# when recorded. Compare releases by writing --json with the old one and passing it as --baseline to the new one.
+
+import argparse
+import asyncio
+import collections
+import contextvars
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:REPLAY") # bot.py reads it at import
+os.environ["TRAFFIC_CAPTURE_DIR"] = "" # Never record the replay itself
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+import capture
+import config_and_utils
+import db_operations
+import storage
+
+_current_handler = contextvars.ContextVar("current_handler", default="(outside handlers)")
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": True}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list) # handler -> seconds
+        self.counts = collections.defaultdict(collections.Counter) # handler -> {"storage": n, "sqlite": n, "api": n}
+        self.api_methods = collections.Counter()
+        self.update_latencies = []
+        self.errors = collections.Counter()
+
+    def count(self, kind: str):
+        self.counts[_current_handler.get()][kind] += 1
+
+stats = Stats()
+
+
+class FakeBotApi(BaseRequest):
+    """ Answers every Bot API request with a minimal valid result, optionally after a fixed delay. """
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+        self._message_ids = iter(range(10**6, 10**9))
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, api_method: str, parameters: dict):
+        if api_method == "getMe": return BOT_USER
+        if api_method == "getFile":
+            return {"file_id": parameters.get("file_id", ""), "file_unique_id": "replay", "file_size": 0, "file_path": "replay/file"}
+        if api_method.startswith(("send", "edit", "copy")) and "chat_id" in parameters:
+            return {"message_id": parameters.get("message_id") or next(self._message_ids), "date": int(time.time()), "from": BOT_USER,
+                    "chat": {"id": int(parameters["chat_id"]), "type": "private"}, "text": str(parameters.get("text") or "")}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency_seconds: await asyncio.sleep(self.latency_seconds)
+        if "/file/bot" in url: return 200, b"" # File downloads (e.g. an imported CSV) come back empty
+        api_method = url.rsplit("/", 1)[-1]
+        stats.count("api")
+        stats.api_methods[api_method] += 1
+        result = self._result(api_method, request_data.parameters if request_data else {})
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class CountingStorage:
+    """ storage.backend wrapper counting calls per handler. """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+        if not callable(attribute): return attribute
+        def counted(*args, **kwargs):
+            stats.count("storage")
+            return attribute(*args, **kwargs)
+        return counted
+
+class CountingSqlite:
+    """ Stands in for the sqlite3 module in db_operations to count the connections it opens. """
+
+    def __getattr__(self, name):
+        return getattr(sqlite3, name)
+
+    def connect(self, *args, **kwargs):
+        stats.count("sqlite")
+        return sqlite3.connect(*args, **kwargs)
+
+
+def _timed(callback):
+    name = callback.__name__
+    async def timed(update, context):
+        token = _current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            stats.latencies[name].append(time.perf_counter() - started)
+            _current_handler.reset(token)
+    return timed
+
+def _instrument(handlers: list, seen: set):
+    for handler in handlers:
+        if id(handler) in seen: continue
+        seen.add(id(handler))
+        if isinstance(handler, ConversationHandler):
+            _instrument(handler.entry_points, seen)
+            for state_handlers in handler.states.values(): _instrument(state_handlers, seen)
+            _instrument(handler.fallbacks, seen)
+        else:
+            handler.callback = _timed(handler.callback)
+
+async def _count_error(update, context):
+    stats.errors[type(context.error).__name__] += 1
+
+
+def load_entries(paths: list) -> list:
+    entries = [entry for path in paths for entry in capture.read_capture(path)]
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+def prepare_database(tmp: str, entries: list, source_db: str = None):
+    db_operations.DB_NAME = os.path.join(tmp, "replay.db")
+    if source_db: shutil.copyfile(source_db, db_operations.DB_NAME)
+    db_operations.init_db()
+    config_and_utils.PRODUCT_PHOTO_DIR = os.path.join(tmp, "product_photos")
+    config_and_utils.DB_BACKUP_DIR = os.path.join(tmp, "backups")
+    staff = {}
+    for entry in entries:
+        user = Update.de_json(entry["update"], None).effective_user
+        if user and entry.get("role"): staff[user.id] = entry["role"]
+    for user_id, role in staff.items(): db_operations.set_user_role(user_id, role)
+    return staff
+
+
+async def replay(entries: list, speed: float, api_latency_seconds: float) -> float:
+    import bot
+    application = bot.build_application(with_shared_jobs=False, with_updater=False, request=FakeBotApi(api_latency_seconds))
+    for handlers in application.handlers.values(): _instrument(handlers, set())
+    application.add_error_handler(_count_error)
+    storage.backend = CountingStorage(storage.backend)
+    db_operations.sqlite3 = CountingSqlite()
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    async with application:
+        await application.post_init(application) # Not run by start(); opens the storage backend and loads the roles
+        await application.start()
+
+        async def feed():
+            first_ts, started = entries[0]["ts"], loop.time()
+            for entry in entries:
+                due = started + (entry["ts"] - first_ts) / speed if speed > 0 else started
+                if due > loop.time(): await asyncio.sleep(due - loop.time())
+                await queue.put((due, Update.de_json(entry["update"], application.bot)))
+            await queue.put(None)
+
+        async def process(due: float, update: Update):
+            await application.update_processor.process_update(update, application.process_update(update))
+            stats.update_latencies.append(loop.time() - due)
+
+        # Same as Application's update fetcher: one at a time unless concurrent updates are enabled.
+        feeder, tasks = asyncio.create_task(feed()), set()
+        started = loop.time()
+        while (item := await queue.get()) is not None:
+            if application.update_processor.max_concurrent_updates > 1:
+                task = asyncio.create_task(process(*item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                await process(*item)
+        await feeder
+        if tasks: await asyncio.gather(*tasks)
+        elapsed = loop.time() - started
+        await application.stop()
+        await application.post_shutdown(application)
+    return elapsed
+
+
+def _percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    at = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+    return {"p50": statistics.median(ordered) * 1000, "p95": at(0.95), "p99": at(0.99)}
+
+def build_report(elapsed: float, speed: float) -> dict:
+    return {
+        "updates": len(stats.update_latencies), "seconds": round(elapsed, 3), "speed": speed,
+        "update_ms": _percentiles(stats.update_latencies), "errors": dict(stats.errors), "api_methods": dict(stats.api_methods),
+        "handlers": {name: {"calls": len(samples), **_percentiles(samples),
+                            **{kind: stats.counts[name][kind] / len(samples) for kind in ("storage", "sqlite", "api")}}
+                     for name, samples in stats.latencies.items()},
+    }
+
+def print_report(report: dict, baseline: dict = None):
+    update_ms = report["update_ms"]
+    print(f"{report['updates']} updates in {report['seconds']:.2f}s ({report['updates'] / report['seconds']:.0f}/s, speed {report['speed']}x): "
+          f"update ms p50 {update_ms['p50']:.2f} p95 {update_ms['p95']:.2f} p99 {update_ms['p99']:.2f}")
+    if report["errors"]: print("handler errors: " + ", ".join(f"{name} x{count}" for name, count in report["errors"].items()))
+    print(f"{'handler':<38} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'storage':>8} {'sqlite':>7} {'api':>5}" + ("   p50/p99 vs baseline" if baseline else ""))
+    for name, row in sorted(report["handlers"].items(), key=lambda item: -item[1]["calls"] * item[1]["p50"]):
+        line = f"{name:<38} {row['calls']:>6} {row['p50']:>8.3f} {row['p95']:>8.3f} {row['p99']:>8.3f} {row['storage']:>8.2f} {row['sqlite']:>7.2f} {row['api']:>5.2f}"
+        old = (baseline or {}).get("handlers", {}).get(name)
+        if old: line += f"   {(row['p50'] / old['p50'] - 1) * 100 if old['p50'] else 0:+6.1f}% / {(row['p99'] / old['p99'] - 1) * 100 if old['p99'] else 0:+6.1f}%"
+        print(line)
+    print("api calls: " + ", ".join(f"{name} {count}" for name, count in sorted(report["api_methods"].items(), key=lambda item: -item[1])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured updates against a fake Bot API and a scratch database.")
+    parser.add_argument("captures", nargs="+", help="capture-*.jsonl.gz files written with TRAFFIC_CAPTURE_DIR")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed; 0 feeds every update at once")
+    parser.add_argument("--db", help="database to start from (copied, never modified), e.g. a backup")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="delay of every Bot API answer")
+    parser.add_argument("--json", help="write the report here")
+    parser.add_argument("--baseline", help="report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    entries = load_entries(args.captures)
+    if not entries: sys.exit("The captures hold no updates.")
+    config_and_utils.load_translations()
+    with tempfile.TemporaryDirectory() as tmp:
+        staff = prepare_database(tmp, entries, args.db)
+        print(f"replaying {len(entries)} updates from {len(args.captures)} file(s), {len(staff)} staff senders")
+        elapsed = asyncio.run(replay(entries, args.speed, args.api_latency_ms / 1000))
+    report = build_report(elapsed, args.speed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
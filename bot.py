@@ -1,16 +1,38 @@
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler
+import datetime
+import logging
+
+from telegram import Update
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler, filters
+from telegram.request import BaseRequest
 
 # Import configurations and utilities
 from config_and_utils import (
     TELEGRAM_TOKEN,
     ADMIN_TELEGRAM_ID_STR,
     ADMIN_IDS, # This is a list, will be populated
-    logger,
+    BOT_TZ,
+    OUTBOX_POLL_SECONDS,
+    DB_MAINTENANCE_HOUR,
+    WORKER_PROCESSES,
+    TRANSLATIONS_POLL_SECONDS,
+    STANDING_ORDER_POLL_SECONDS,
+    DELIVERY_SLOTS,
+    SHOPS_CONFIG,
+    TRAFFIC_CAPTURE_DIR,
     load_translations
 )
 
 # Import DB operations
-from db_operations import init_db
+from db_operations import init_db, get_saved_cart_user_ids
+import capture
+import roles
+import shops
+import storage
+
+# Import background jobs
+from jobs import (
+    rebuild_sales_rollups_job, reload_translations_job, deliver_outbox_job, standing_orders_job, ensure_delivery_slots_job, resume_broadcasts_job, db_checkpoint_job, db_maintenance_job, evict_idle_sessions_job
+)
 
 # Import handlers and conversation objects
 from handlers import (
@@ -21,33 +43,70 @@ from handlers import (
     admin_add_prod_conv,
     admin_manage_prod_conv,
     admin_clear_orders_conv,
+    admin_broadcast_conv,
+    admin_orders_range_conv,
+    admin_import_products_conv,
     my_orders_direct_cb,
+    standing_order_stop_cb,
     admin_view_orders_direct_cb,
-    admin_shop_list_direct_cb
+    admin_manage_orders_cb,
+    admin_orders_set_status_cb,
+    admin_shop_list_direct_cb,
+    admin_stats_direct_cb,
+    admin_broadcast_cancel_cb,
+    admin_export_orders_command,
+    admin_export_orders_cb,
+    inline_product_search,
+    record_activity,
+    debounce_callback_query,
+    release_callback_query,
+    admin_memstats_command,
+    admin_reload_translations_command,
+    admin_roles_command,
+    admin_set_role_command,
+    admin_profile_command,
+    admin_delivery_slots_command
 )
 
+logger = logging.getLogger(__name__)
 
-def main() -> None:
-    # --- Initial Setup ---
-    if not TELEGRAM_TOKEN:
-        logger.critical("TELEGRAM_TOKEN missing!")
-        return
-    if not ADMIN_TELEGRAM_ID_STR:
-        logger.critical("ADMIN_TELEGRAM_ID missing!")
-        return
 
-    try:
-        # Populate ADMIN_IDS (which is defined in config_and_utils)
-        # ADMIN_IDS from config_and_utils is a global list, so we modify it directly.
-        # Clear it first in case this main() is somehow called multiple times (unlikely for typical bot script)
-        ADMIN_IDS.clear()
-        parsed_ids = [int(aid.strip()) for aid in ADMIN_TELEGRAM_ID_STR.split(',') if aid.strip()]
-        ADMIN_IDS.extend(parsed_ids)
-        if not ADMIN_IDS:
-            logger.warning("ADMIN_TELEGRAM_ID is set but parsed to an empty list. No admins configured.")
-    except ValueError:
-        logger.critical("Admin IDs invalid! Must be comma-separated numbers.")
-        return
+def configure(init_database: bool = True) -> bool:
+    """ Process-wide setup shared by the single-process bot, the sharded workers (see sharding.py) and multi-shop mode (shops.py). """
+    if SHOPS_CONFIG:
+        if WORKER_PROCESSES > 1:
+            logger.critical("SHOPS_CONFIG cannot be combined with WORKER_PROCESSES > 1.")
+            return False
+        try:
+            shops.configure_shops(shops.load_shops(SHOPS_CONFIG))
+        except (OSError, ValueError) as e:
+            logger.critical("SHOPS_CONFIG: %s", e)
+            return False
+    else:
+        if not TELEGRAM_TOKEN:
+            logger.critical("TELEGRAM_TOKEN missing!")
+            return False
+        if not ADMIN_TELEGRAM_ID_STR:
+            logger.critical("ADMIN_TELEGRAM_ID missing!")
+            return False
+
+        try:
+            # Populate ADMIN_IDS (which is defined in config_and_utils)
+            # ADMIN_IDS from config_and_utils is a global list, so we modify it directly.
+            # Clear it first in case this main() is somehow called multiple times (unlikely for typical bot script)
+            ADMIN_IDS.clear()
+            parsed_ids = [int(aid.strip()) for aid in ADMIN_TELEGRAM_ID_STR.split(',') if aid.strip()]
+            ADMIN_IDS.extend(parsed_ids)
+            if not ADMIN_IDS:
+                logger.warning("ADMIN_TELEGRAM_ID is set but parsed to an empty list. No admins configured.")
+        except ValueError:
+            logger.critical("Admin IDs invalid! Must be comma-separated numbers.")
+            return False
+
+        storage_error = storage.configuration_error()
+        if storage_error:
+            logger.critical(storage_error)
+            return False
 
     load_translations()
     if not ("en" in globals().get("translations", {}) and "lt" in globals().get("translations", {})): # Check if translations actually loaded
@@ -57,29 +116,107 @@ def main() -> None:
          from config_and_utils import translations as loaded_translations # get the potentially updated global
          if not loaded_translations.get("en") or not loaded_translations.get("lt"):
             logger.critical("Core translations missing after load attempt in main! Bot cannot function correctly.")
-            return
+            return False
 
+    if init_database: # The SQLite file is used with every STORAGE_BACKEND, see storage.py
+        if shops.SHOPS: shops.init_shop_databases()
+        else: init_db()
+    return True
 
-    init_db() # Initialize database
+async def open_storage(application: Application):
+    await storage.backend.open()
+    await roles.load_roles()
 
-    # --- Application Setup ---
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def close_storage(application: Application):
+    await storage.backend.close()
+
+def build_application(with_shared_jobs: bool = True, with_updater: bool = True, token: str = None, request: BaseRequest = None) -> Application:
+    """
+    Application with every handler registered. Sharded workers build it without an updater, since updates
+    are fed to them by the ingest process, and only one of them schedules the shared jobs. In multi-shop mode
+    it is built in the shop's context with the shop's token. request replaces the HTTP transport of the Bot
+    API calls (benchmarks/replay_capture.py answers them without a network).
+    """
+    builder = Application.builder().token(token or TELEGRAM_TOKEN).post_init(open_storage).post_shutdown(close_storage)
+    if not with_updater: builder = builder.updater(None)
+    if request is not None: builder = builder.request(request)
+    application = builder.build()
+    application.bot_data['spilled_cart_users'] = set(get_saved_cart_user_ids()) # Carts of sessions evicted before a restart
+    if TRAFFIC_CAPTURE_DIR: capture.install(application)
 
     # --- Add Handlers ---
-    application.add_handler(CommandHandler("start", start_command_handler))
+    application.add_handler(TypeHandler(Update, record_activity), group=-2)
+    application.add_handler(CallbackQueryHandler(debounce_callback_query), group=-1)
+    application.add_handler(CallbackQueryHandler(release_callback_query), group=1)
+    # Product deep links (/start prod_<id>) are handled by order_conv, so the generic /start must skip them.
+    application.add_handler(CommandHandler("start", start_command_handler, filters=~filters.Regex(r"^/start prod_\d+$")))
     application.add_handler(CommandHandler("admin", admin_command_entry))
+    application.add_handler(CommandHandler("export", admin_export_orders_command))
+    application.add_handler(CommandHandler("memstats", admin_memstats_command))
+    application.add_handler(CommandHandler("reloadlocales", admin_reload_translations_command))
+    application.add_handler(CommandHandler("roles", admin_roles_command))
+    application.add_handler(CommandHandler("setrole", admin_set_role_command))
+    application.add_handler(CommandHandler("profile", admin_profile_command))
+    application.add_handler(CommandHandler("slots", admin_delivery_slots_command))
 
     application.add_handler(lang_conv)
     application.add_handler(order_conv)
     application.add_handler(admin_add_prod_conv)
     application.add_handler(admin_manage_prod_conv)
     application.add_handler(admin_clear_orders_conv)
+    application.add_handler(admin_broadcast_conv)
+    application.add_handler(admin_orders_range_conv)
+    application.add_handler(admin_import_products_conv)
 
     # Direct callback handlers
     application.add_handler(CallbackQueryHandler(my_orders_direct_cb, pattern="^my_orders_direct_cb$"))
-    application.add_handler(CallbackQueryHandler(admin_view_orders_direct_cb, pattern="^admin_view_orders_direct_cb$"))
+    application.add_handler(CallbackQueryHandler(standing_order_stop_cb, pattern=r"^standing_order_stop_\d+$"))
+    application.add_handler(CallbackQueryHandler(admin_view_orders_direct_cb, pattern="^(admin_view_orders_direct_cb|admin_view_orders_range_(today|yesterday|week|all))$"))
+    application.add_handler(CallbackQueryHandler(admin_manage_orders_cb, pattern=r"^(admin_manage_orders_cb|admin_orders_(toggle_\d+|page_\d+|select_page|clear|notify))$"))
+    application.add_handler(CallbackQueryHandler(admin_orders_set_status_cb, pattern="^admin_orders_set_(confirmed|completed|cancelled)$"))
     application.add_handler(CallbackQueryHandler(admin_shop_list_direct_cb, pattern="^admin_shop_list_direct_cb$"))
+    application.add_handler(CallbackQueryHandler(admin_stats_direct_cb, pattern="^admin_stats_direct_cb$"))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_cancel_cb, pattern=r"^admin_broadcast_cancel_\d+$"))
+    application.add_handler(CallbackQueryHandler(admin_export_orders_cb, pattern="^admin_export_orders_cb$"))
+
+    # Inline mode (@bot tomatoes), requires inline mode to be enabled with @BotFather
+    application.add_handler(InlineQueryHandler(inline_product_search))
+
+    # --- Background Jobs ---
+    # Jobs working on shared state (database, outbox, broadcasts) run in one process only; sessions are per process.
+    if application.job_queue:
+        if with_shared_jobs:
+            application.job_queue.run_daily(rebuild_sales_rollups_job, time=datetime.time(hour=3, tzinfo=BOT_TZ), name="rebuild_sales_rollups")
+            application.job_queue.run_repeating(deliver_outbox_job, interval=OUTBOX_POLL_SECONDS, first=5, name="deliver_outbox")
+            application.job_queue.run_once(resume_broadcasts_job, 5, name="resume_broadcasts")
+            application.job_queue.run_repeating(standing_orders_job, interval=STANDING_ORDER_POLL_SECONDS, first=30, name="standing_orders")
+            if DELIVERY_SLOTS:
+                application.job_queue.run_once(ensure_delivery_slots_job, 1, name="ensure_delivery_slots_now")
+                application.job_queue.run_daily(ensure_delivery_slots_job, time=datetime.time(hour=0, minute=5, tzinfo=BOT_TZ), name="ensure_delivery_slots")
+            application.job_queue.run_daily(db_maintenance_job, time=datetime.time(hour=DB_MAINTENANCE_HOUR, tzinfo=BOT_TZ), name="db_maintenance")
+            application.job_queue.run_repeating(db_checkpoint_job, interval=600, first=600, name="db_checkpoint")
+            if TRANSLATIONS_POLL_SECONDS > 0: # Other workers reload when this one publishes "translations" (sharding.py)
+                application.job_queue.run_repeating(reload_translations_job, interval=TRANSLATIONS_POLL_SECONDS, first=TRANSLATIONS_POLL_SECONDS, name="reload_translations")
+        application.job_queue.run_repeating(evict_idle_sessions_job, interval=600, first=600, name="evict_idle_sessions")
+    else:
+        logger.warning("JobQueue unavailable (install python-telegram-bot[job-queue]); background jobs are disabled.")
+    return application
+
+
+def main() -> None:
+    if not configure():
+        return
+    if shops.SHOPS:
+        logger.info("Bot starting %s shops in one process...", len(shops.SHOPS))
+        shops.run_shops()
+        return
+    if WORKER_PROCESSES > 1:
+        import sharding
+        logger.info("Bot starting with %s worker processes...", WORKER_PROCESSES)
+        sharding.run_sharded(WORKER_PROCESSES)
+        return
 
+    application = build_application()
     logger.info("Bot starting with modularized structure...")
     application.run_polling()
 
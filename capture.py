@@ -0,0 +1,141 @@
+# capture.py
+# Opt-in recording of real traffic (TRAFFIC_CAPTURE_DIR) for benchmarks/replay_capture.py. A TypeHandler in the
+# first handler group hands every incoming Update to a writer thread, which anonymizes it and appends one JSON
+# line to a gzip file, so the event loop only pays for a queue put.
+#
+# Each line is {"ts": <epoch seconds when received>, "role": <sender's staff role or null>, "update": {...}}.
+# Anonymization keeps what the handlers route on and drops who the users are:
+#   - user and chat ids are replaced by a keyed hash (TRAFFIC_CAPTURE_SALT; random per process when unset,
+#     so set it to keep ids stable across restarts and sharded workers), names become "User", usernames,
+#     phone numbers, contacts and locations are dropped
+#   - message texts, captions and file names keep their length, digits and punctuation, but every letter
+#     becomes "x" (so quantities and dates replay as they were)
+#   - a /command keeps its command word and the arguments the bot parses (role names, export formats, /profile
+#     options and seconds, product deep links); user id arguments (/setrole) get the same hash as the senders,
+#     and any other argument has its letters and digits masked (it can be a name or a phone number)
+#   - callback data (our own strings), inline search queries, dates and message ids are kept as they are
+# Each process writes its own file, capture-<shop>-<start time>-<pid>.jsonl.gz; the replay merges files by "ts".
+
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from config_and_utils import TRAFFIC_CAPTURE_DIR, TRAFFIC_CAPTURE_SALT, current_shop
+
+import exports
+import roles
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_HANDLER_GROUP = -1000 # Before every other group, so updates are recorded even when a later handler stops them
+_DROPPED_KEYS = {"last_name", "username", "phone_number", "contact", "location", "venue", "bio", "vcard"}
+_MASKED_TEXT_KEYS = {"text", "caption", "file_name"}
+# Command arguments recorded as they are: the handlers route on them and they say nothing about the user.
+_KEPT_COMMAND_ARGUMENTS = {*roles.ROLES, "none", *exports.EXPORT_FORMATS, "gz", "gzip", "cprofile", "mem"}
+_KEPT_COMMAND_ARGUMENT = re.compile(r"prod_\d+|\d{1,4}") # /start deep links; small numbers such as /profile seconds
+_USER_ID_ARGUMENTS = {"/setrole": 0} # command -> position of a Telegram user id argument
+
+
+def anonymous_id(value: int, salt: bytes) -> int:
+    """ A stable stand-in for a user or chat id: 48 bits of a keyed hash, with the sign kept (groups are negative). """
+    digest = hmac.new(salt, str(abs(value)).encode(), hashlib.sha256).digest()
+    anonymous = int.from_bytes(digest[:6], "big") or 1
+    return -anonymous if value < 0 else anonymous
+
+def _mask_text(text: str) -> str:
+    return "".join("x" if char.isalpha() else char for char in text)
+
+def _mask_command(text: str, salt: bytes) -> str:
+    command, *rest = re.split(r"(\s+)", text)
+    id_position = _USER_ID_ARGUMENTS.get(command.split("@", 1)[0].lower())
+    masked = [command]
+    for position, (separator, argument) in enumerate(zip(rest[::2], rest[1::2])):
+        if argument.lower() in _KEPT_COMMAND_ARGUMENTS or _KEPT_COMMAND_ARGUMENT.fullmatch(argument): pass
+        elif position == id_position and argument.isdigit(): argument = str(anonymous_id(int(argument), salt))
+        else: argument = "".join("x" if char.isalpha() else "0" if char.isdigit() else char for char in argument)
+        masked += [separator, argument]
+    return "".join(masked)
+
+def anonymize(data, salt: bytes):
+    """ A copy of an Update's to_dict() with the personal fields replaced as described above. """
+    if isinstance(data, list): return [anonymize(item, salt) for item in data]
+    if not isinstance(data, dict): return data
+    is_user_or_chat = isinstance(data.get("id"), int) and ("first_name" in data or "type" in data or "is_bot" in data)
+    result = {}
+    for key, value in data.items():
+        if key in _DROPPED_KEYS: continue
+        if is_user_or_chat and key == "id": result[key] = anonymous_id(value, salt)
+        elif key in ("first_name", "title"): result[key] = "User"
+        elif key in _MASKED_TEXT_KEYS and isinstance(value, str): result[key] = _mask_command(value, salt) if value.startswith("/") else _mask_text(value)
+        else: result[key] = anonymize(value, salt)
+    return result
+
+
+class TrafficRecorder:
+    """ Appends anonymized updates to a gzip JSONL file from a writer thread. """
+
+    def __init__(self, path: str, salt: bytes):
+        self.path, self.salt = path, salt
+        self.recorded = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="traffic-capture", daemon=True)
+        self._thread.start()
+
+    def record(self, update: Update, role: str | None):
+        self._queue.put((time.time(), role, update))
+
+    def close(self):
+        """ Writes what is still queued and closes the file; registered with atexit. """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+    def _write(self):
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            while (item := self._queue.get()) is not None:
+                received_ts, role, update = item
+                try:
+                    f.write(json.dumps({"ts": round(received_ts, 3), "role": role, "update": anonymize(update.to_dict(), self.salt)}, ensure_ascii=False) + "\n")
+                    self.recorded += 1
+                except (TypeError, ValueError) as e:
+                    logger.warning("Traffic capture: update %s not recorded: %s", update.update_id, e)
+                if self._queue.empty(): f.flush() # Sync-flushes the gzip stream, so a capture can be read while it is still written
+        logger.info("Traffic capture closed: %s updates in %s", self.recorded, self.path)
+
+
+async def record_update(update: Update, context):
+    user = update.effective_user
+    context.bot_data['traffic_recorder'].record(update, roles.role_of(user.id) if user else None)
+
+def install(application):
+    """ Starts recording the application's updates into TRAFFIC_CAPTURE_DIR. """
+    os.makedirs(TRAFFIC_CAPTURE_DIR, exist_ok=True)
+    shop = current_shop.get()
+    filename = f"capture-{shop.name if shop else 'bot'}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz"
+    salt = TRAFFIC_CAPTURE_SALT.encode() if TRAFFIC_CAPTURE_SALT else os.urandom(16)
+    recorder = TrafficRecorder(os.path.join(TRAFFIC_CAPTURE_DIR, filename), salt)
+    atexit.register(recorder.close)
+    application.bot_data['traffic_recorder'] = recorder
+    application.add_handler(TypeHandler(Update, record_update), group=CAPTURE_HANDLER_GROUP)
+    logger.info("Recording anonymized traffic to %s", recorder.path)
+
+
+def read_capture(path: str):
+    """ Yields the entries of a capture file in order. A file whose writer is still running (or died) ends early, not with an error. """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"): yield json.loads(line)
+        except EOFError:
+            return
@@ -0,0 +1,95 @@
+# catalog_import.py
+# Parsing and validation for bulk catalog uploads (see handlers.admin_import_products_file_state).
+# Every row is validated before anything is written, so an upload is applied entirely or not at all.
+
+import asyncio
+import csv
+import io
+import math
+
+import storage
+
+MAX_IMPORT_ROWS = 1000
+MAX_IMPORT_FILE_BYTES = 1024 * 1024
+
+NAME_COLUMNS = ("name", "product", "pavadinimas")
+PRICE_COLUMNS = ("price", "price_per_kg", "kaina")
+AVAILABLE_COLUMNS = ("available", "is_available", "yra")
+CATEGORY_COLUMNS = ("category", "kategorija")
+
+_TRUE_VALUES = {"1", "yes", "y", "true", "taip", "t"}
+_FALSE_VALUES = {"0", "no", "n", "false", "ne", "f"}
+
+
+def _find_column(header: list, candidates: tuple):
+    for candidate in candidates:
+        if candidate in header:
+            return header.index(candidate)
+    return None
+
+
+def parse_catalog_csv(data: bytes) -> tuple[list, list]:
+    """
+    Parses a name/price[/available][/category] CSV (comma or semicolon separated, header row required).
+    Returns (rows, errors): rows are (name, price_per_kg, is_available, category_name or None) tuples ready for
+    Storage.bulk_upsert_products; errors are human-readable strings with line numbers.
+    Rows are only meaningful when errors is empty.
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return [], ["File is not UTF-8 encoded."]
+    try:
+        dialect = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(io.StringIO(text), dialect)
+
+    header = [column.strip().lower() for column in next(reader, [])]
+    name_idx, price_idx = _find_column(header, NAME_COLUMNS), _find_column(header, PRICE_COLUMNS)
+    avail_idx, category_idx = _find_column(header, AVAILABLE_COLUMNS), _find_column(header, CATEGORY_COLUMNS)
+    if name_idx is None or price_idx is None:
+        return [], ["Header row must contain 'name' and 'price' columns."]
+
+    rows, errors, seen_names = [], [], set()
+    for line_no, record in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in record):
+            continue
+        if len(rows) + len(errors) >= MAX_IMPORT_ROWS:
+            errors.append(f"Too many rows (max {MAX_IMPORT_ROWS}).")
+            break
+        def cell(idx):
+            return record[idx].strip() if idx is not None and idx < len(record) else ""
+
+        name, price_str, avail_str = cell(name_idx), cell(price_idx), cell(avail_idx).lower()
+        if not name:
+            errors.append(f"Line {line_no}: missing name."); continue
+        if name.casefold() in seen_names:
+            errors.append(f"Line {line_no}: duplicate product '{name}'."); continue
+        seen_names.add(name.casefold())
+        try:
+            price = round(float(price_str.replace(",", ".")), 2)
+        except ValueError:
+            price = math.nan
+        if not (math.isfinite(price) and price > 0):
+            errors.append(f"Line {line_no}: invalid price '{price_str}' for '{name}'."); continue
+        if not avail_str or avail_str in _TRUE_VALUES: is_available = 1
+        elif avail_str in _FALSE_VALUES: is_available = 0
+        else:
+            errors.append(f"Line {line_no}: invalid availability '{avail_str}' for '{name}'."); continue
+        rows.append((name, price, is_available, cell(category_idx) or None))
+
+    if not rows and not errors:
+        errors.append("No product rows found.")
+    return rows, errors
+
+
+async def import_catalog_csv(data: bytes) -> tuple[dict | None, list]:
+    """ Validates the whole file first, then applies it in one transaction. Returns (diff summary or None, errors). """
+    rows, errors = await asyncio.to_thread(parse_catalog_csv, data)
+    if errors:
+        return None, errors
+    summary = await storage.backend.bulk_upsert_products(rows)
+    if summary is None:
+        return None, ["Database error while applying the import; nothing was changed."]
+    return summary, []
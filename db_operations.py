@@ -1,35 +1,145 @@
+import json
+import logging
+import os
+import re
 import sqlite3
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 # Import necessary variables from config_and_utils
-from config_and_utils import DB_NAME, DEFAULT_LANGUAGE, logger
+from config_and_utils import BOT_TZ, DB_NAME, DEFAULT_LANGUAGE, DELIVERY_SLOT_LEAD_MINUTES, STANDING_ORDER_HOUR, current_shop, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+def db_path() -> str:
+    """ The current shop's SQLite file in multi-shop mode (shops.py), else DB_NAME. """
+    shop = current_shop.get()
+    return shop.db_name if shop else DB_NAME
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
+    # Incremental auto-vacuum lets maintenance hand pages freed by order purges back in small steps;
+    # WAL lets readers and the online backup run alongside checkout writes.
+    cursor.execute("PRAGMA auto_vacuum")
+    auto_vacuum_mode = cursor.fetchone()[0]
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master)")
+    needs_vacuum_conversion = auto_vacuum_mode != 2 and bool(cursor.fetchone()[0])
+    if auto_vacuum_mode != 2: cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode = WAL")
     sql_create_users_table = f"""
     CREATE TABLE IF NOT EXISTS users (
         telegram_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT,
         is_admin INTEGER DEFAULT 0, language_code TEXT DEFAULT '{DEFAULT_LANGUAGE}'
     )"""
     cursor.execute(sql_create_users_table)
-    cursor.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, price_per_kg REAL NOT NULL, is_available INTEGER DEFAULT 1)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, sort_order INTEGER DEFAULT 0)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, price_per_kg REAL NOT NULL, is_available INTEGER DEFAULT 1, category_id INTEGER REFERENCES categories (id), photo_file_id TEXT)")
+    _add_column_if_missing(cursor, "products", "category_id", "INTEGER REFERENCES categories (id)")
+    _add_column_if_missing(cursor, "products", "photo_file_id", "TEXT") # Telegram file_id of the product photo (see product_photos.py)
     cursor.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, user_name TEXT, order_date TEXT NOT NULL, total_price REAL NOT NULL, status TEXT DEFAULT 'pending', FOREIGN KEY (user_id) REFERENCES users (telegram_id))")
-    cursor.execute("CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity_kg REAL NOT NULL, price_at_order REAL NOT NULL, FOREIGN KEY (order_id) REFERENCES orders (id), FOREIGN KEY (product_id) REFERENCES products (id))")
+    cursor.execute("CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity_kg REAL NOT NULL, price_at_order REAL NOT NULL, product_name TEXT, unit TEXT DEFAULT 'kg', FOREIGN KEY (order_id) REFERENCES orders (id), FOREIGN KEY (product_id) REFERENCES products (id))")
+    # Order lines keep a snapshot of the product name/unit and the order keeps a precomputed
+    # summary, so order history survives product deletion and is read from `orders` alone.
+    _add_column_if_missing(cursor, "order_items", "product_name", "TEXT")
+    _add_column_if_missing(cursor, "order_items", "unit", "TEXT DEFAULT 'kg'")
+    _add_column_if_missing(cursor, "orders", "items_summary", "TEXT")
+    _add_column_if_missing(cursor, "orders", "items_json", "TEXT")
+    # order_ts is the authoritative order time (epoch seconds, UTC); order_date is kept for older readers.
+    _add_column_if_missing(cursor, "orders", "order_ts", "INTEGER")
+    cursor.execute("UPDATE orders SET order_ts = CAST(strftime('%s', order_date, 'utc') AS INTEGER) WHERE order_ts IS NULL")
+    cursor.execute("DROP INDEX IF EXISTS idx_orders_user_id")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_ts ON orders (user_id, order_ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_ts ON orders (order_ts)")
+    # One key per checked-out cart, so a repeated checkout can never create a second order.
+    _add_column_if_missing(cursor, "orders", "idempotency_key", "TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key) WHERE idempotency_key IS NOT NULL")
+    _backfill_order_snapshots(cursor)
+    # Daily sales rollups, maintained incrementally by save/complete so the admin stats screen never scans orders.
+    cursor.execute("CREATE TABLE IF NOT EXISTS sales_daily (day TEXT PRIMARY KEY, orders_count INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0, completed_count INTEGER NOT NULL DEFAULT 0, completed_revenue REAL NOT NULL DEFAULT 0)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sales_daily_product (day TEXT NOT NULL, product_name TEXT NOT NULL, orders_count INTEGER NOT NULL DEFAULT 0, quantity_kg REAL NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, product_name))")
+    # Rollup totals of the completed orders purged by delete_completed_orders_from_db; rebuild_sales_rollups adds them back.
+    cursor.execute("CREATE TABLE IF NOT EXISTS sales_purged_daily (day TEXT PRIMARY KEY, orders_count INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0, completed_count INTEGER NOT NULL DEFAULT 0, completed_revenue REAL NOT NULL DEFAULT 0)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sales_purged_daily_product (day TEXT NOT NULL, product_name TEXT NOT NULL, orders_count INTEGER NOT NULL DEFAULT 0, quantity_kg REAL NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, product_name))")
+    _init_product_search_index(cursor)
+    # Transactional outbox: order events are queued in the order's own transaction and delivered by a background job.
+    cursor.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, event_type TEXT NOT NULL, payload TEXT NOT NULL, created_ts INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt_ts INTEGER NOT NULL, last_error TEXT)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_ts)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS outbox_deliveries (event_id INTEGER NOT NULL, recipient_id INTEGER NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, delivered_ts INTEGER, last_error TEXT, PRIMARY KEY (event_id, recipient_id))")
+    # Broadcasts walk users in telegram_id order; last_user_id is the resume cursor after a restart.
+    _add_column_if_missing(cursor, "users", "is_blocked", "INTEGER DEFAULT 0")
+    # Staff role (roles.py): 'owner', 'packer', 'viewer' or NULL. The older is_admin column is no longer written or read.
+    _add_column_if_missing(cursor, "users", "role", "TEXT")
+    cursor.execute("CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, created_by INTEGER, created_ts INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'running', last_user_id INTEGER NOT NULL DEFAULT 0, total_count INTEGER NOT NULL DEFAULT 0, sent_count INTEGER NOT NULL DEFAULT 0, failed_count INTEGER NOT NULL DEFAULT 0, blocked_count INTEGER NOT NULL DEFAULT 0, progress_chat_id INTEGER, progress_message_id INTEGER, finished_ts INTEGER)")
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM orders) AND NOT EXISTS(SELECT 1 FROM sales_daily)")
+    rollups_need_backfill = bool(cursor.fetchone()[0])
+    # Carts of evicted idle sessions, restored on the user's next update.
+    cursor.execute("CREATE TABLE IF NOT EXISTS saved_carts (user_id INTEGER PRIMARY KEY, cart_json TEXT NOT NULL, saved_ts INTEGER NOT NULL)")
+    # Delivery/pickup slots; booked_* are counters kept in step with orders.slot_id, so availability never counts orders.
+    cursor.execute("CREATE TABLE IF NOT EXISTS delivery_slots (id INTEGER PRIMARY KEY AUTOINCREMENT, start_ts INTEGER NOT NULL UNIQUE, end_ts INTEGER NOT NULL, capacity_orders INTEGER NOT NULL, capacity_kg REAL NOT NULL, booked_orders INTEGER NOT NULL DEFAULT 0, booked_kg REAL NOT NULL DEFAULT 0)")
+    _add_column_if_missing(cursor, "orders", "slot_id", "INTEGER")
+    # Weekly repeat orders: a saved cart placed by standing_orders_job every week on `weekday` (0 = Monday).
+    cursor.execute("CREATE TABLE IF NOT EXISTS standing_orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, user_name TEXT, username TEXT, items_json TEXT NOT NULL, items_summary TEXT, weekday INTEGER NOT NULL, next_run_ts INTEGER NOT NULL, created_ts INTEGER NOT NULL, last_order_id INTEGER)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_standing_orders_next_run ON standing_orders (next_run_ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_standing_orders_user ON standing_orders (user_id)")
+    # Maintenance runs are recorded with their duration so slow steps are visible.
+    cursor.execute("CREATE TABLE IF NOT EXISTS maintenance_log (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT NOT NULL, started_ts INTEGER NOT NULL, duration_ms INTEGER NOT NULL, ok INTEGER NOT NULL, details TEXT)")
     conn.commit()
+    if needs_vacuum_conversion:
+        conn.execute("VACUUM") # One-off rebuild; auto_vacuum mode only takes effect on an existing file after VACUUM
+        logger.info("Converted database to incremental auto-vacuum.")
     conn.close()
-    logger.info(f"Database initialized/checked at {DB_NAME}")
+    if rollups_need_backfill: rebuild_sales_rollups()
+    logger.info("Database initialized/checked at %s", db_path())
 
-async def ensure_user_exists(user_id: int, first_name: str, username: str, context): # context from telegram.ext
-    # We need ADMIN_IDS here. It's better if this function is in config_and_utils or takes ADMIN_IDS
-    # For now, let's assume ADMIN_IDS is accessible or this logic is slightly simplified/moved.
-    # To keep this file focused on DB, let's pass ADMIN_IDS if needed or handle admin check elsewhere.
-    # For simplicity, I will import ADMIN_IDS here.
-    from config_and_utils import ADMIN_IDS
+def _add_column_if_missing(cursor, table: str, column: str, definition: str):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info("Migrated table '%s': added column '%s'.", table, column)
+
+def _init_product_search_index(cursor):
+    """
+    FTS5 index over product names. It is an external-content table kept in sync with `products` by
+    triggers, so add/update/delete_product_from_db and bulk imports never need to touch it directly.
+    remove_diacritics folds Lithuanian letters ("bulves" finds "Bulvės"); prefix indexes serve typeahead.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+    already_exists = cursor.fetchone() is not None
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(name, content='products', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')")
+    except sqlite3.OperationalError as e:
+        logger.warning("FTS5 unavailable, product search will fall back to LIKE: %s", e)
+        return
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name); END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name); END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name); INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name); END")
+    if not already_exists:
+        cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        logger.info("Built product search index.")
+
+def format_order_items_summary(items: list) -> str:
+    return "\n".join(f"{item['name']} ({item['quantity']}{item.get('unit') or 'kg'})" for item in items)
 
-    conn = sqlite3.connect(DB_NAME)
+def _backfill_order_snapshots(cursor):
+    """ One-off migration for rows written before order lines carried their own product snapshot. """
+    cursor.execute("UPDATE order_items SET product_name = (SELECT p.name FROM products p WHERE p.id = order_items.product_id) WHERE product_name IS NULL")
+    cursor.execute("UPDATE order_items SET unit = 'kg' WHERE unit IS NULL")
+    cursor.execute("SELECT id FROM orders WHERE items_json IS NULL")
+    order_ids = [row[0] for row in cursor.fetchall()]
+    for order_id_val in order_ids:
+        cursor.execute("SELECT product_id, product_name, quantity_kg, price_at_order, unit FROM order_items WHERE order_id = ? ORDER BY id", (order_id_val,))
+        items = [{'id': pid, 'name': pname or f"#{pid}", 'quantity': qty, 'price': price, 'unit': unit or 'kg'}
+                 for pid, pname, qty, price, unit in cursor.fetchall()]
+        cursor.execute("UPDATE orders SET items_summary = ?, items_json = ? WHERE id = ?",
+                       (format_order_items_summary(items), json.dumps(items, ensure_ascii=False), order_id_val))
+    if order_ids:
+        logger.info("Backfilled item snapshots for %s existing orders.", len(order_ids))
+
+async def ensure_user_exists(user_id: int, first_name: str, username: str, context): # context from telegram.ext
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
-    is_admin_user = 1 if ADMIN_IDS and user_id in ADMIN_IDS else 0
     current_lang = DEFAULT_LANGUAGE
     try:
         cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
@@ -41,52 +151,143 @@ async def ensure_user_exists(user_id: int, first_name: str, username: str, conte
         # This function should primarily focus on DB write.
 
         cursor.execute("""
-            INSERT INTO users (telegram_id, first_name, username, language_code, is_admin)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO users (telegram_id, first_name, username, language_code)
+            VALUES (?, ?, ?, ?)
             ON CONFLICT(telegram_id) DO UPDATE SET
                 first_name = excluded.first_name,
                 username = excluded.username,
-                is_admin = excluded.is_admin,
+                is_blocked = 0,
                 language_code = COALESCE(users.language_code, excluded.language_code)
-        """, (user_id, first_name, username, current_lang, is_admin_user))
+        """, (user_id, first_name, username, current_lang))
         conn.commit()
-        logger.info(f"User {user_id} ensured in DB. Admin status: {is_admin_user}. Lang: {current_lang}")
+        logger.info("User %s ensured in DB. Lang: %s", user_id, current_lang)
     except sqlite3.Error as e:
-        logger.error(f"DB error in ensure_user_exists for user {user_id}: {e}")
+        logger.error("DB error in ensure_user_exists for user %s: %s", user_id, e)
         # Return a default or raise error, let caller handle context.user_data
     finally:
         conn.close()
     return current_lang # Return the language determined/used for DB
 
+def get_user_language_from_db(user_id: int) -> str | None:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    result = None
+    try:
+        cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
+        result = cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.error("DB error in get_user_language for user %s: %s", user_id, e)
+    finally:
+        conn.close()
+    return result[0] if result else None
+
 async def set_user_language_db(user_id: int, lang_code: str):
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     try:
         cursor.execute("UPDATE users SET language_code = ? WHERE telegram_id = ?", (lang_code, user_id))
         conn.commit()
-        logger.info(f"User {user_id} language set to {lang_code} in DB.")
-    except sqlite3.Error as e: logger.error(f"DB error in set_user_language_db for user {user_id}: {e}")
+        logger.info("User %s language set to %s in DB.", user_id, lang_code)
+    except sqlite3.Error as e: logger.error("DB error in set_user_language_db for user %s: %s", user_id, e)
     finally: conn.close()
 
-def add_product_to_db(name: str, price: float) -> bool:
-    conn = sqlite3.connect(DB_NAME)
+def get_user_languages(user_ids: list) -> dict:
+    """ {telegram_id: language_code} for the given users in one query; users not in the table are left out. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    languages = {}
+    try:
+        cursor.execute(f"SELECT telegram_id, language_code FROM users WHERE telegram_id IN ({','.join('?' * len(user_ids))})", list(user_ids))
+        languages = {user_id: lang_code for user_id, lang_code in cursor.fetchall() if lang_code}
+    except sqlite3.Error as e:
+        logger.error("DB error reading the languages of %s users: %s", len(user_ids), e)
+    finally:
+        conn.close()
+    return languages
+
+def get_staff_roles() -> dict | None:
+    """ {telegram_id: role} for every user with a staff role. None on a database error, so callers keep what they have. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT telegram_id, role FROM users WHERE role IS NOT NULL")
+        return dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error("DB error reading staff roles: %s", e)
+        return None
+    finally:
+        conn.close()
+
+def set_user_role(user_id: int, role: str | None) -> bool:
+    """ Gives the user a staff role, or takes it away with role=None. Creates the user row if they never wrote to the bot. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        cursor.execute("INSERT INTO users (telegram_id, role) VALUES (?, ?) ON CONFLICT(telegram_id) DO UPDATE SET role = excluded.role", (user_id, role))
+        conn.commit()
+        success = True
+        logger.info("User %s role set to %s.", user_id, role)
+    except sqlite3.Error as e:
+        logger.error("DB error setting the role of user %s: %s", user_id, e)
+    finally:
+        conn.close()
+    return success
+
+# --- Catalog Cache ---
+# Product listings are read on every browse but change rarely, so they are cached in-process.
+# Every function that writes to `products` must call invalidate_catalog_cache() after committing.
+# Caches are kept per database file, so each shop in multi-shop mode (shops.py) has its own.
+_catalog_caches = {}
+_search_caches = {}
+SEARCH_CACHE_MAX_ENTRIES = 512
+
+def _catalog_cache() -> dict:
+    path = db_path()
+    cache = _catalog_caches.get(path)
+    if cache is None: cache = _catalog_caches[path] = {}
+    return cache
+
+def _search_cache() -> dict:
+    path = db_path()
+    cache = _search_caches.get(path)
+    if cache is None: cache = _search_caches[path] = {}
+    return cache
+
+# Called after every local invalidation; in multi-process mode sharding.py uses it to tell the other workers.
+catalog_invalidation_listeners = []
+
+def invalidate_catalog_cache(notify: bool = True):
+    _catalog_cache().clear()
+    _search_cache().clear()
+    if notify:
+        for listener in catalog_invalidation_listeners: listener()
+
+def add_product_to_db(name: str, price: float) -> int | None:
+    """ Returns the new product's id, or None if it could not be added (e.g. duplicate name). """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO products (name, price_per_kg) VALUES (?, ?)", (name, price))
         conn.commit()
-        logger.info(f"Product '{name}' added to DB.")
-        return True
+        invalidate_catalog_cache()
+        logger.info("Product '%s' added to DB.", name)
+        return cursor.lastrowid
     except sqlite3.IntegrityError:
-        logger.warning(f"Attempted to add duplicate product name: {name}")
-        return False
+        logger.warning("Attempted to add duplicate product name: %s", name)
+        return None
     except sqlite3.Error as e:
-        logger.error(f"DB error adding product {name}: {e}")
-        return False
+        logger.error("DB error adding product %s: %s", name, e)
+        return None
     finally:
         conn.close()
 
 def get_products_from_db(available_only: bool = True) -> list:
-    conn = sqlite3.connect(DB_NAME)
+    """ Returns (id, name, price_per_kg, is_available) tuples sorted by name. The list is cached; do not mutate it. """
+    cache = _catalog_cache()
+    if available_only in cache:
+        return cache[available_only]
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     products = []
     try:
@@ -96,33 +297,182 @@ def get_products_from_db(available_only: bool = True) -> list:
         query += " ORDER BY name"
         cursor.execute(query)
         products = cursor.fetchall()
+        cache[available_only] = products
     except sqlite3.Error as e:
-        logger.error(f"DB error getting products: {e}")
+        logger.error("DB error getting products: %s", e)
     finally:
         conn.close()
     return products
 
+def search_products_in_db(query_text: str, limit: int = 20, available_only: bool = True) -> list:
+    """
+    Prefix, case- and diacritic-insensitive name search; every word must match.
+    Returns (id, name, price_per_kg, is_available) tuples, best matches first. Results are cached per query.
+    """
+    terms = re.findall(r"\w+", query_text.lower())
+    if not terms: return []
+    cache_key = (" ".join(terms), limit, available_only)
+    cache = _search_cache()
+    if cache_key in cache:
+        return cache[cache_key]
+
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    results = []
+    availability_filter = " AND p.is_available = 1" if available_only else ""
+    try:
+        try:
+            match_expr = " ".join(f'"{term}"*' for term in terms)
+            cursor.execute("SELECT p.id, p.name, p.price_per_kg, p.is_available FROM products_fts JOIN products p ON p.id = products_fts.rowid "
+                           f"WHERE products_fts MATCH ?{availability_filter} ORDER BY products_fts.rank LIMIT ?", (match_expr, limit))
+        except sqlite3.OperationalError:
+            # No FTS5 in this SQLite build: plain substring match (no diacritic folding).
+            like_conditions = " AND ".join("p.name LIKE ?" for _term in terms)
+            cursor.execute(f"SELECT p.id, p.name, p.price_per_kg, p.is_available FROM products p WHERE {like_conditions}{availability_filter} ORDER BY p.name LIMIT ?",
+                           (*[f"%{term}%" for term in terms], limit))
+        results = cursor.fetchall()
+        if len(cache) >= SEARCH_CACHE_MAX_ENTRIES: cache.clear()
+        cache[cache_key] = results
+    except sqlite3.Error as e:
+        logger.error("DB error searching products for '%s': %s", query_text, e)
+    finally:
+        conn.close()
+    return results
+
+def get_catalog_index(available_only: bool = True) -> dict:
+    """
+    Pre-sorted catalog used to render paged keyboards: {'categories': [(id, name)], 'by_category': {id: [products]}}.
+    by_category[0] holds every product; category lists only include categories that have products.
+    Built once per catalog change (cached with the product list), so each page is a plain slice.
+    """
+    cache_key = ('index', available_only)
+    cache = _catalog_cache()
+    if cache_key in cache:
+        return cache[cache_key]
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    index = {'categories': [], 'by_category': {0: []}}
+    try:
+        query = "SELECT id, name, price_per_kg, is_available, category_id FROM products"
+        if available_only: query += " WHERE is_available = 1"
+        cursor.execute(query + " ORDER BY name")
+        for pid, name, price, avail, category_id in cursor.fetchall():
+            product = (pid, name, price, avail)
+            index['by_category'][0].append(product)
+            if category_id: index['by_category'].setdefault(category_id, []).append(product)
+        cursor.execute("SELECT id, name FROM categories ORDER BY sort_order, name")
+        index['categories'] = [(cid, cname) for cid, cname in cursor.fetchall() if cid in index['by_category']]
+        cache[cache_key] = index
+    except sqlite3.Error as e:
+        logger.error("DB error building catalog index: %s", e)
+    finally:
+        conn.close()
+    return index
+
+def get_catalog_page(page: int, page_size: int, category_id: int = 0, available_only: bool = True) -> tuple[list, int, int, list, int]:
+    """
+    Returns (products on the page, clamped page, total pages, categories, effective category id).
+    An empty or unknown category falls back to 0 (all products). O(page_size) once the index is cached.
+    """
+    return slice_catalog_page(get_catalog_index(available_only), page, page_size, category_id)
+
+def slice_catalog_page(index: dict, page: int, page_size: int, category_id: int) -> tuple[list, int, int, list, int]:
+    if category_id not in index['by_category']: category_id = 0
+    products = index['by_category'][category_id]
+    total_pages = max(1, -(-len(products) // page_size))
+    page = min(max(page, 0), total_pages - 1)
+    return products[page * page_size:(page + 1) * page_size], page, total_pages, index['categories'], category_id
+
+def get_product_photo_ids() -> dict:
+    """ {product_id: photo_file_id} for every product with a photo. Cached with the catalog; do not mutate it. """
+    cache = _catalog_cache()
+    if 'photos' in cache:
+        return cache['photos']
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    photo_ids = {}
+    try:
+        cursor.execute("SELECT id, photo_file_id FROM products WHERE photo_file_id IS NOT NULL")
+        photo_ids = dict(cursor.fetchall())
+        cache['photos'] = photo_ids
+    except sqlite3.Error as e:
+        logger.error("DB error getting product photo ids: %s", e)
+    finally:
+        conn.close()
+    return photo_ids
+
+def set_product_photo(product_id: int, file_id: str | None) -> bool:
+    """ Stores the Telegram file_id of the product's photo; None removes the photo. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        cursor.execute("UPDATE products SET photo_file_id = ? WHERE id = ?", (file_id, product_id))
+        conn.commit()
+        if cursor.rowcount > 0:
+            success = True
+            invalidate_catalog_cache()
+    except sqlite3.Error as e:
+        logger.error("DB error setting photo for product %s: %s", product_id, e)
+    finally:
+        conn.close()
+    return success
+
+def get_categories_from_db() -> list:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    categories = []
+    try:
+        cursor.execute("SELECT id, name FROM categories ORDER BY sort_order, name")
+        categories = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting categories: %s", e)
+    finally:
+        conn.close()
+    return categories
+
+def add_category_to_db(name: str) -> int | None:
+    """ Creates the category if needed and returns its id. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    category_id = None
+    try:
+        cursor.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (name,))
+        cursor.execute("SELECT id FROM categories WHERE name = ?", (name,))
+        category_id = cursor.fetchone()[0]
+        conn.commit()
+        invalidate_catalog_cache()
+        logger.info("Category '%s' ensured in DB (id %s).", name, category_id)
+    except sqlite3.Error as e:
+        logger.error("DB error adding category %s: %s", name, e)
+    finally:
+        conn.close()
+    return category_id
+
 def get_product_by_id(product_id: int):
-    conn = sqlite3.connect(DB_NAME)
+    """ Returns (id, name, price_per_kg, is_available, category_id) or None. """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     product = None
     try:
-        cursor.execute("SELECT id, name, price_per_kg, is_available FROM products WHERE id = ?", (product_id,))
+        cursor.execute("SELECT id, name, price_per_kg, is_available, category_id FROM products WHERE id = ?", (product_id,))
         product = cursor.fetchone()
     except sqlite3.Error as e:
-        logger.error(f"DB error getting product by ID {product_id}: {e}")
+        logger.error("DB error getting product by ID %s: %s", product_id, e)
     finally:
         conn.close()
     return product
 
-def update_product_in_db(product_id: int, name: str = None, price: float = None, is_available: int = None) -> bool:
-    conn = sqlite3.connect(DB_NAME)
+def update_product_in_db(product_id: int, name: str = None, price: float = None, is_available: int = None, category_id: int = None) -> bool:
+    """ Only the given fields are changed; category_id=0 removes the product from its category. """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     success = False
     fields, params = [], []
     if name is not None: fields.append("name = ?"); params.append(name)
     if price is not None: fields.append("price_per_kg = ?"); params.append(price)
     if is_available is not None: fields.append("is_available = ?"); params.append(is_available)
+    if category_id is not None: fields.append("category_id = ?"); params.append(category_id or None)
 
     if not fields: conn.close(); return False
 
@@ -133,15 +483,16 @@ def update_product_in_db(product_id: int, name: str = None, price: float = None,
         conn.commit()
         if cursor.rowcount > 0:
             success = True
-            logger.info(f"Product {product_id} updated in DB. Fields: {fields}")
+            invalidate_catalog_cache()
+            logger.info("Product %s updated in DB. Fields: %s", product_id, fields)
     except sqlite3.Error as e:
-        logger.error(f"DB error updating product {product_id}: {e}")
+        logger.error("DB error updating product %s: %s", product_id, e)
     finally:
         conn.close()
     return success
 
 def delete_product_from_db(product_id: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     success = False
     try:
@@ -149,30 +500,233 @@ def delete_product_from_db(product_id: int) -> bool:
         conn.commit()
         if cursor.rowcount > 0:
             success = True
-            logger.info(f"Product {product_id} deleted from DB.")
+            invalidate_catalog_cache()
+            logger.info("Product %s deleted from DB.", product_id)
     except sqlite3.Error as e:
-        logger.error(f"DB error deleting product {product_id}: {e}")
+        logger.error("DB error deleting product %s: %s", product_id, e)
     finally:
         conn.close()
     return success
 
-def save_order_to_db(user_id: int, user_name: str, cart: list, total_price: float) -> int | None:
-    conn = sqlite3.connect(DB_NAME)
+def plan_bulk_upsert(rows: list, category_ids: dict, current_products) -> tuple[list, list, list]:
+    """
+    Diffs import rows against the stored (name, price_per_kg, is_available, category_id) rows.
+    Returns (added names, updated names, (name, price, available, category_id) rows to write).
+    """
+    existing = {name: (price, avail, cid) for name, price, avail, cid in current_products}
+    added, updated, to_write = [], [], []
+    for name, price, avail, cname in rows:
+        category_id = category_ids[cname] if cname else (existing[name][2] if name in existing else None)
+        if name not in existing: added.append(name)
+        elif existing[name] != (price, avail, category_id): updated.append(name)
+        else: continue
+        to_write.append((name, price, avail, category_id))
+    return added, updated, to_write
+
+def bulk_upsert_products(rows: list) -> dict | None:
+    """
+    Applies validated (name, price_per_kg, is_available, category_name) rows as a single executemany upsert keyed
+    on the unique product name, in one transaction. A None category keeps the product's current category;
+    unknown category names are created. Rows identical to the stored product are skipped.
+    Returns {'added': [names], 'updated': [names], 'unchanged': count}, or None on a database error.
+    """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN TRANSACTION")
+        cursor.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", {(cname,) for *_fields, cname in rows if cname})
+        cursor.execute("SELECT name, id FROM categories")
+        category_ids = dict(cursor.fetchall())
+        cursor.execute("SELECT name, price_per_kg, is_available, category_id FROM products")
+        added, updated, to_write = plan_bulk_upsert(rows, category_ids, cursor.fetchall())
+        cursor.executemany("""
+            INSERT INTO products (name, price_per_kg, is_available, category_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET price_per_kg = excluded.price_per_kg, is_available = excluded.is_available, category_id = excluded.category_id
+        """, to_write)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("DB error during bulk product import (%s rows): %s", len(rows), e)
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+    if to_write: invalidate_catalog_cache()
+    logger.info("Bulk product import: %s added, %s updated, %s unchanged.", len(added), len(updated), len(rows) - len(to_write))
+    return {'added': added, 'updated': updated, 'unchanged': len(rows) - len(to_write)}
+
+# --- Sales Rollups ---
+
+def rollup_day(order_ts: int) -> str:
+    return format_timestamp(order_ts, "%Y-%m-%d")
+
+ROLLUP_SOURCE_SELECT = "SELECT o.id, o.order_ts, o.total_price, o.status, oi.product_name, oi.quantity_kg, oi.price_at_order FROM orders o LEFT JOIN order_items oi ON oi.order_id = o.id "
+# Cancelled orders are not sales (see status_rollup_deltas).
+ROLLUP_SOURCE_QUERY = ROLLUP_SOURCE_SELECT + "WHERE o.status != 'cancelled' ORDER BY o.id"
+
+def accumulate_sales_rollups(rows) -> tuple[dict, dict]:
+    """
+    Folds ROLLUP_SOURCE_QUERY rows into ({day: [orders, revenue, completed, completed revenue]},
+    {(day, product_name): [orders, quantity, revenue]}). Days are local (BOT_TZ), as in save_order_to_db.
+    """
+    daily, per_product = {}, {}
+    last_order_id = None
+    for order_id_val, order_ts, total_price, status, pname, qty, price in rows:
+        day = rollup_day(order_ts)
+        if order_id_val != last_order_id:
+            last_order_id = order_id_val
+            day_stats = daily.setdefault(day, [0, 0.0, 0, 0.0])
+            day_stats[0] += 1; day_stats[1] += total_price
+            if status == 'completed': day_stats[2] += 1; day_stats[3] += total_price
+        if pname is not None:
+            prod_stats = per_product.setdefault((day, pname), [0, 0.0, 0.0])
+            prod_stats[0] += 1; prod_stats[1] += qty; prod_stats[2] += qty * price
+    return daily, per_product
+
+def _add_order_to_rollups(cursor, day: str, items: list, total_price: float):
+    cursor.execute("INSERT INTO sales_daily (day, orders_count, revenue) VALUES (?, 1, ?) ON CONFLICT(day) DO UPDATE SET orders_count = orders_count + 1, revenue = revenue + excluded.revenue",
+                   (day, total_price))
+    cursor.executemany("""
+        INSERT INTO sales_daily_product (day, product_name, orders_count, quantity_kg, revenue) VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT(day, product_name) DO UPDATE SET
+            orders_count = orders_count + 1,
+            quantity_kg = quantity_kg + excluded.quantity_kg,
+            revenue = revenue + excluded.revenue
+    """, [(day, item['name'], item['quantity'], item['price'] * item['quantity']) for item in items])
+
+def _move_to_purged_rollups(cursor, daily: dict, per_product: dict):
+    """ Adds accumulate_sales_rollups totals of orders about to be purged to sales_purged_daily*. """
+    cursor.executemany("""
+        INSERT INTO sales_purged_daily (day, orders_count, revenue, completed_count, completed_revenue) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            orders_count = orders_count + excluded.orders_count, revenue = revenue + excluded.revenue,
+            completed_count = completed_count + excluded.completed_count, completed_revenue = completed_revenue + excluded.completed_revenue
+    """, [(day, *stats) for day, stats in daily.items()])
+    cursor.executemany("""
+        INSERT INTO sales_purged_daily_product (day, product_name, orders_count, quantity_kg, revenue) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day, product_name) DO UPDATE SET
+            orders_count = orders_count + excluded.orders_count,
+            quantity_kg = quantity_kg + excluded.quantity_kg,
+            revenue = revenue + excluded.revenue
+    """, [(day, pname, *stats) for (day, pname), stats in per_product.items()])
+
+def _include_purged_rollups(cursor, daily: dict, per_product: dict):
+    """ Adds the sales_purged_daily* totals to accumulate_sales_rollups results. """
+    for day, *stats in cursor.execute("SELECT day, orders_count, revenue, completed_count, completed_revenue FROM sales_purged_daily").fetchall():
+        day_stats = daily.setdefault(day, [0, 0.0, 0, 0.0])
+        for i, value in enumerate(stats): day_stats[i] += value
+    for day, pname, *stats in cursor.execute("SELECT day, product_name, orders_count, quantity_kg, revenue FROM sales_purged_daily_product").fetchall():
+        prod_stats = per_product.setdefault((day, pname), [0, 0.0, 0.0])
+        for i, value in enumerate(stats): prod_stats[i] += value
+
+def rebuild_sales_rollups() -> int:
+    """
+    Recomputes the rollups from orders/order_items plus the totals of purged orders (sales_purged_daily*)
+    in one transaction. Meant for a background job: it scans the whole history. Days with neither are
+    left as they are. Returns the number of days rebuilt, or -1 on error.
+    """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN TRANSACTION")
+        daily, per_product = accumulate_sales_rollups(cursor.execute(ROLLUP_SOURCE_QUERY))
+        _include_purged_rollups(cursor, daily, per_product)
+        cursor.executemany("INSERT OR REPLACE INTO sales_daily (day, orders_count, revenue, completed_count, completed_revenue) VALUES (?, ?, ?, ?, ?)",
+                           [(day, *stats) for day, stats in daily.items()])
+        cursor.executemany("DELETE FROM sales_daily_product WHERE day = ?", [(day,) for day in daily])
+        cursor.executemany("INSERT INTO sales_daily_product (day, product_name, orders_count, quantity_kg, revenue) VALUES (?, ?, ?, ?, ?)",
+                           [(day, pname, *stats) for (day, pname), stats in per_product.items()])
+        conn.commit()
+        logger.info("Rebuilt sales rollups for %s days.", len(daily))
+        return len(daily)
+    except sqlite3.Error as e:
+        logger.error("DB error rebuilding sales rollups: %s", e)
+        if conn: conn.rollback()
+        return -1
+    finally:
+        conn.close()
+
+def get_sales_stats(today: str, week_start: str, month_start: str, top_n: int = 5) -> dict:
+    """ Reads the admin stats from the rollup tables only; every query is a bounded range on the day key. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    stats = {}
+    try:
+        for label, first_day in (("today", today), ("week", week_start), ("month", month_start)):
+            cursor.execute("SELECT COALESCE(SUM(orders_count), 0), COALESCE(SUM(revenue), 0), COALESCE(SUM(completed_count), 0) FROM sales_daily WHERE day >= ? AND day <= ?", (first_day, today))
+            stats[label] = cursor.fetchone()
+        cursor.execute("SELECT day, orders_count, revenue FROM sales_daily WHERE day >= ? AND day <= ? ORDER BY day DESC", (week_start, today))
+        stats['daily'] = cursor.fetchall()
+        cursor.execute("SELECT product_name, SUM(quantity_kg), SUM(revenue) FROM sales_daily_product WHERE day >= ? AND day <= ? GROUP BY product_name ORDER BY SUM(revenue) DESC LIMIT ?",
+                       (month_start, today, top_n))
+        stats['top_products'] = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error reading sales stats: %s", e)
+        stats = {}
+    finally:
+        conn.close()
+    return stats
+
+def _find_order_by_idempotency_key(cursor, idempotency_key: str) -> int | None:
+    cursor.execute("SELECT id FROM orders WHERE idempotency_key = ?", (idempotency_key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def snapshot_order_items(cart: list) -> list:
+    """ The order lines as stored in orders.items_json and the 'order_created' event. """
+    return [{'id': item['id'], 'name': item['name'], 'quantity': item['quantity'], 'price': item['price'], 'unit': item.get('unit', 'kg')}
+            for item in cart]
+
+def _insert_order(cursor, user_id: int, user_name: str, items: list, total_price: float, order_ts: int, idempotency_key: str = None, slot_id: int = None) -> int:
+    """ The order row, its lines and rollup deltas on the caller's cursor; items as from snapshot_order_items. """
+    order_date = datetime.fromtimestamp(order_ts).strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("INSERT INTO orders (user_id, user_name, order_date, order_ts, total_price, status, items_summary, items_json, idempotency_key, slot_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (user_id, user_name, order_date, order_ts, total_price, 'pending',
+                    format_order_items_summary(items), json.dumps(items, ensure_ascii=False), idempotency_key, slot_id))
+    order_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order, product_name, unit) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(order_id, item['id'], item['quantity'], item['price'], item['name'], item['unit']) for item in items])
+    _add_order_to_rollups(cursor, rollup_day(order_ts), items, total_price)
+    return order_id
+
+def save_order_to_db(user_id: int, user_name: str, cart: list, total_price: float, username: str = None, idempotency_key: str = None,
+                     slot_id: int = None) -> int | None:
+    """
+    Saves the order with its items, rollup deltas and 'order_created' outbox event in one transaction.
+    A repeated call with the same idempotency_key returns the already saved order's id instead of creating another order.
+    With slot_id, the slot's capacity is reserved in the same transaction; SLOT_FULL is returned (and nothing saved) if it does not fit
+    or the slot starts too soon to be booked (slot_booking_cutoff).
+    """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     order_id = None
-    order_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    order_ts = int(time.time())
     try:
+        if idempotency_key:
+            order_id = _find_order_by_idempotency_key(cursor, idempotency_key)
+            if order_id:
+                logger.info("Duplicate checkout for user %s ignored, order %s already saved.", user_id, order_id)
+                return order_id
         conn.execute("BEGIN TRANSACTION")
-        cursor.execute("INSERT INTO orders (user_id, user_name, order_date, total_price, status) VALUES (?, ?, ?, ?, ?)",
-                       (user_id, user_name, order_date, total_price, 'pending'))
-        order_id = cursor.lastrowid
-        for item in cart:
-            cursor.execute("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order) VALUES (?, ?, ?, ?)",
-                           (order_id, item['id'], item['quantity'], item['price']))
+        items = snapshot_order_items(cart)
+        slot = None
+        if slot_id is not None:
+            slot = _reserve_delivery_slot(cursor, slot_id, order_weight_kg(items), slot_booking_cutoff(order_ts))
+            if slot is None:
+                conn.rollback()
+                logger.info("Slot %s cannot take the order of user %s.", slot_id, user_id)
+                return SLOT_FULL
+        order_id = _insert_order(cursor, user_id, user_name, items, total_price, order_ts, idempotency_key, slot_id)
+        enqueue_outbox_event(cursor, 'order_created', {'order_id': order_id, 'user_id': user_id, 'user_name': user_name, 'username': username,
+                                                       'items': items, 'total_price': total_price, 'slot': slot}, now=order_ts)
         conn.commit()
-        logger.info(f"Order {order_id} for user {user_id} saved to DB.")
+        logger.info("Order %s for user %s saved to DB.", order_id, user_id)
+    except sqlite3.IntegrityError as e:
+        conn.rollback()
+        # Lost a race with a concurrent checkout of the same cart: report the order that won.
+        order_id = _find_order_by_idempotency_key(cursor, idempotency_key) if idempotency_key else None
+        if order_id is None: logger.error("Error saving order for user %s: %s", user_id, e)
     except sqlite3.Error as e:
-        logger.error(f"Error saving order for user {user_id}: {e}")
+        logger.error("Error saving order for user %s: %s", user_id, e)
         if conn: conn.rollback()
         order_id = None
     finally:
@@ -180,78 +734,789 @@ def save_order_to_db(user_id: int, user_name: str, cart: list, total_price: floa
     return order_id
 
 def get_user_orders_from_db(user_id: int) -> list:
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     orders = []
     try:
-        cursor.execute("SELECT o.id, o.order_date, o.total_price, o.status, group_concat(p.name || ' (' || oi.quantity_kg || 'kg)', CHAR(10)) FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id WHERE o.user_id = ? GROUP BY o.id ORDER BY o.order_date DESC", (user_id,))
+        cursor.execute("SELECT id, order_ts, total_price, status, items_summary FROM orders WHERE user_id = ? ORDER BY order_ts DESC", (user_id,))
         orders = cursor.fetchall()
     except sqlite3.Error as e:
-        logger.error(f"DB error getting orders for user {user_id}: {e}")
+        logger.error("DB error getting orders for user %s: %s", user_id, e)
     finally:
         conn.close()
     return orders
 
-def get_all_orders_from_db() -> list:
-    conn = sqlite3.connect(DB_NAME)
+def get_reorder_lines(order_id: int, user_id: int) -> list:
+    """
+    Lines of one of the user's orders joined with the current catalog in a single query:
+    (product_id, name at order time, quantity, price at order time, current name, current price, is_available).
+    The current fields are None when the product has been deleted. Empty if the order is not the user's.
+    """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    lines = []
+    try:
+        cursor.execute("""
+            SELECT oi.product_id, oi.product_name, oi.quantity_kg, oi.price_at_order, p.name, p.price_per_kg, p.is_available
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            LEFT JOIN products p ON p.id = oi.product_id
+            WHERE o.id = ? AND o.user_id = ?
+            ORDER BY oi.id
+        """, (order_id, user_id))
+        lines = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting reorder lines for order %s: %s", order_id, e)
+    finally:
+        conn.close()
+    return lines
+
+def format_admin_items_details(items_json: str) -> str:
+    if not items_json: return ""
+    return "\n".join(f"{item['name']} ({item['quantity']}{item.get('unit') or 'kg'} @ {item['price']} EUR)" for item in json.loads(items_json))
+
+def get_all_orders_from_db(start_ts: int = None, end_ts: int = None) -> list:
+    """ Orders newest first, optionally limited to start_ts <= order_ts < end_ts (served by idx_orders_ts). """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     orders = []
+    conditions, params = [], []
+    if start_ts is not None: conditions.append("order_ts >= ?"); params.append(start_ts)
+    if end_ts is not None: conditions.append("order_ts < ?"); params.append(end_ts)
+    query = "SELECT id, user_id, user_name, order_ts, total_price, status, items_json FROM orders"
+    if conditions: query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY order_ts DESC"
     try:
-        cursor.execute("SELECT o.id, o.user_id, o.user_name, o.order_date, o.total_price, o.status, GROUP_CONCAT(p.name || ' (' || oi.quantity_kg || 'kg @ ' || oi.price_at_order || ' EUR)', CHAR(10)) as items_details FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id GROUP BY o.id ORDER BY o.order_date DESC")
-        orders = cursor.fetchall()
+        cursor.execute(query, tuple(params))
+        orders = [(oid, cust_id, uname, date_val, total_val, status_val, format_admin_items_details(items_json))
+                  for oid, cust_id, uname, date_val, total_val, status_val, items_json in cursor.fetchall()]
     except sqlite3.Error as e:
-        logger.error(f"DB error getting all orders: {e}")
+        logger.error("DB error getting all orders: %s", e)
     finally:
         conn.close()
     return orders
 
+ORDER_EXPORT_QUERY = "SELECT o.id, o.order_ts, o.user_id, o.user_name, o.status, o.total_price, oi.product_id, oi.product_name, oi.quantity_kg, oi.unit, oi.price_at_order FROM orders o LEFT JOIN order_items oi ON oi.order_id = o.id ORDER BY o.id"
+
+def iter_order_export_rows(batch_size: int = 500):
+    """
+    Streams one row per order line (orders without lines yield a single row with NULL item fields),
+    fetching batch_size rows per step so memory stays flat however many orders exist.
+    Ordering by the orders primary key lets SQLite walk it without a sort.
+    """
+    conn = sqlite3.connect(db_path())
+    try:
+        cursor = conn.execute(ORDER_EXPORT_QUERY)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows: break
+            yield from rows
+    finally:
+        conn.close()
+
 def get_shopping_list_from_db() -> list:
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     shopping_list = []
     try:
-        cursor.execute("SELECT p.name, SUM(oi.quantity_kg) as total_quantity FROM order_items oi JOIN products p ON oi.product_id = p.id JOIN orders o ON oi.order_id = o.id WHERE o.status IN ('pending','confirmed') GROUP BY p.name ORDER BY p.name")
+        cursor.execute("SELECT oi.product_name, SUM(oi.quantity_kg) as total_quantity FROM order_items oi JOIN orders o ON oi.order_id = o.id WHERE o.status IN ('pending','confirmed') GROUP BY oi.product_name ORDER BY oi.product_name")
         shopping_list = cursor.fetchall()
     except sqlite3.Error as e:
-        logger.error(f"DB error getting shopping list: {e}")
+        logger.error("DB error getting shopping list: %s", e)
     finally:
         conn.close()
     return shopping_list
 
 def delete_completed_orders_from_db() -> int:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); deleted_count = 0
+    """
+    Deletes the completed orders with their lines. Their rollup totals move to sales_purged_daily* in the
+    same transaction, so the sales history survives the nightly rebuild_sales_rollups.
+    """
+    conn = sqlite3.connect(db_path()); cursor = conn.cursor(); deleted_count = 0
     try:
-        cursor.execute("SELECT id FROM orders WHERE status = ?", ('completed',))
-        completed_order_ids = [row[0] for row in cursor.fetchall()]
-        if not completed_order_ids: conn.close(); return 0
+        conn.execute("BEGIN IMMEDIATE") # Take the write lock before reading, so the purged totals are exactly the deleted orders
+        daily, per_product = accumulate_sales_rollups(cursor.execute(ROLLUP_SOURCE_SELECT + "WHERE o.status = 'completed' ORDER BY o.id").fetchall())
+        if not daily: conn.rollback(); return 0
 
-        conn.execute("BEGIN TRANSACTION")
-        for order_id_val in completed_order_ids:
-            cursor.execute("DELETE FROM order_items WHERE order_id = ?", (order_id_val,))
-            cursor.execute("DELETE FROM orders WHERE id = ? AND status = ?", (order_id_val, 'completed'))
-            deleted_count += cursor.rowcount
+        _move_to_purged_rollups(cursor, daily, per_product)
+        cursor.execute("DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE status = 'completed')")
+        cursor.execute("DELETE FROM orders WHERE status = 'completed'")
+        deleted_count = cursor.rowcount
         conn.commit()
-        logger.info(f"Deleted {deleted_count} completed orders from DB.")
+        logger.info("Deleted %s completed orders from DB.", deleted_count)
     except sqlite3.Error as e:
-        logger.error(f"DB error deleting completed orders: {e}")
+        logger.error("DB error deleting completed orders: %s", e)
         if conn: conn.rollback()
         deleted_count = -1
     finally:
         if conn: conn.close()
     return deleted_count
 
+# --- Delivery Slots ---
+SLOT_FULL = -1 # save_order_to_db result when the chosen slot cannot take the order
+
+def slot_booking_cutoff(now_ts: int) -> int:
+    """ Only slots starting after this can be offered or booked (DELIVERY_SLOT_LEAD_MINUTES from now). """
+    return now_ts + DELIVERY_SLOT_LEAD_MINUTES * 60
+
+def order_weight_kg(items: list) -> float:
+    return sum(item['quantity'] for item in items)
+
+def delivery_slot_times(template: str, first_day, days: int) -> list:
+    """
+    (start_ts, end_ts) of every slot from first_day for days days, from a template such as "10:00-12:00,16:00-18:00"
+    in BOT_TZ. Raises ValueError for a malformed template.
+    """
+    windows = []
+    for window in filter(None, (part.strip() for part in template.split(","))):
+        start_text, end_text = window.split("-")
+        start, end = (datetime.strptime(text.strip(), "%H:%M").time() for text in (start_text, end_text))
+        if end <= start: raise ValueError(f"Slot '{window}' ends before it starts")
+        windows.append((start, end))
+    return [(int(datetime.combine(day, start, tzinfo=BOT_TZ).timestamp()), int(datetime.combine(day, end, tzinfo=BOT_TZ).timestamp()))
+            for day in (first_day + timedelta(days=offset) for offset in range(days)) for start, end in windows]
+
+def ensure_delivery_slots(slot_times: list, capacity_orders: int, capacity_kg: float) -> int:
+    """ Creates the slots that do not exist yet; existing slots (and capacities changed by hand) are left alone. Returns how many were added. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    added = 0
+    try:
+        cursor.executemany("INSERT OR IGNORE INTO delivery_slots (start_ts, end_ts, capacity_orders, capacity_kg) VALUES (?, ?, ?, ?)",
+                           [(start_ts, end_ts, capacity_orders, capacity_kg) for start_ts, end_ts in slot_times])
+        conn.commit()
+        added = cursor.rowcount
+    except sqlite3.Error as e:
+        logger.error("DB error creating delivery slots: %s", e)
+    finally:
+        conn.close()
+    return added
+
+def get_available_delivery_slots(after_ts: int, weight_kg: float, limit: int) -> list:
+    """ (id, start_ts, end_ts) of the next slots with room for one more order of weight_kg, read from the booked_* counters. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    slots = []
+    try:
+        cursor.execute("SELECT id, start_ts, end_ts FROM delivery_slots WHERE start_ts > ? AND booked_orders < capacity_orders AND booked_kg + ? <= capacity_kg ORDER BY start_ts LIMIT ?",
+                       (after_ts, weight_kg, limit))
+        slots = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting delivery slots: %s", e)
+    finally:
+        conn.close()
+    return slots
+
+def get_delivery_slot_overview(after_ts: int, limit: int) -> list:
+    """ (id, start_ts, end_ts, booked_orders, capacity_orders, booked_kg, capacity_kg) of the next slots. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    slots = []
+    try:
+        cursor.execute("SELECT id, start_ts, end_ts, booked_orders, capacity_orders, booked_kg, capacity_kg FROM delivery_slots WHERE end_ts > ? ORDER BY start_ts LIMIT ?",
+                       (after_ts, limit))
+        slots = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting delivery slot overview: %s", e)
+    finally:
+        conn.close()
+    return slots
+
+def _reserve_delivery_slot(cursor, slot_id: int, weight_kg: float, after_ts: int) -> dict | None:
+    """
+    Books one order of weight_kg in the slot on the caller's cursor. The capacity and start time checks are part of the
+    UPDATE itself, so concurrent checkouts serialize on the row and can never overbook, and a stale picker cannot book a
+    slot starting at or before after_ts. Returns the slot times, or None if it is full, too soon or unknown.
+    """
+    cursor.execute("UPDATE delivery_slots SET booked_orders = booked_orders + 1, booked_kg = booked_kg + ? "
+                   "WHERE id = ? AND start_ts > ? AND booked_orders < capacity_orders AND booked_kg + ? <= capacity_kg RETURNING start_ts, end_ts",
+                   (weight_kg, slot_id, after_ts, weight_kg))
+    row = cursor.fetchone()
+    return {'start_ts': row[0], 'end_ts': row[1]} if row else None
+
+# --- Standing Orders ---
+STANDING_ORDER_BATCH_SIZE = 200 # Standing orders materialized per transaction
+
+def next_weekly_run(weekday: int, after_ts: int) -> int:
+    """ First STANDING_ORDER_HOUR:00 (BOT_TZ) on weekday (0 = Monday) strictly after after_ts. """
+    after = datetime.fromtimestamp(after_ts, tz=BOT_TZ)
+    day = after.date() + timedelta(days=(weekday - after.weekday()) % 7)
+    run = datetime.combine(day, datetime.min.time(), tzinfo=BOT_TZ).replace(hour=STANDING_ORDER_HOUR)
+    if run.timestamp() <= after_ts: run = datetime.combine(day + timedelta(days=7), datetime.min.time(), tzinfo=BOT_TZ).replace(hour=STANDING_ORDER_HOUR)
+    return int(run.timestamp())
+
+def plan_standing_order_runs(due_rows, products: dict, now_ts: int) -> list:
+    """
+    Turns due standing_orders rows (id, user_id, user_name, username, items_json, weekday, next_run_ts) into runs,
+    pricing each line from products ({id: (name, price, is_available)}) as of now. Lines whose product is gone or
+    unavailable are listed in 'skipped'; a run without any line left creates no order. Shared by the storage backends.
+    """
+    runs = []
+    for standing_id, user_id, user_name, username, items_json, weekday, run_ts in due_rows:
+        items, skipped = [], []
+        for line in json.loads(items_json):
+            product = products.get(line['id'])
+            if product is None or not product[2]: skipped.append(line['name']); continue
+            items.append({'id': line['id'], 'name': product[0], 'quantity': line['quantity'], 'price': product[1], 'unit': line.get('unit', 'kg')})
+        runs.append({'standing_id': standing_id, 'user_id': user_id, 'user_name': user_name, 'username': username,
+                     'items': items, 'skipped': skipped, 'total_price': sum(item['price'] * item['quantity'] for item in items),
+                     'idempotency_key': f"standing:{standing_id}:{run_ts}", 'next_run_ts': next_weekly_run(weekday, max(now_ts, run_ts))})
+    return runs
+
+def standing_order_events(runs: list) -> list:
+    """ (event_type, payload) for a materialized batch: one confirmation per customer and one digest for the admins. """
+    events = [('standing_order_placed', {'order_id': run['order_id'], 'user_id': run['user_id'], 'items': run['items'], 'skipped': run['skipped'],
+                                         'total_price': run['total_price'], 'next_run_ts': run['next_run_ts']}) for run in runs]
+    placed = [run for run in runs if run['order_id']]
+    if placed:
+        events.append(('standing_orders_digest', {'orders': [[run['order_id'], run['user_name'], run['total_price']] for run in placed],
+                                                  'total_price': sum(run['total_price'] for run in placed), 'skipped': len(runs) - len(placed)}))
+    return events
+
+def create_standing_order(user_id: int, user_name: str, username: str, cart: list, weekday: int) -> int | None:
+    items = snapshot_order_items(cart)
+    now = int(time.time())
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    standing_id = None
+    try:
+        cursor.execute("INSERT INTO standing_orders (user_id, user_name, username, items_json, items_summary, weekday, next_run_ts, created_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (user_id, user_name, username, json.dumps(items, ensure_ascii=False), format_order_items_summary(items), weekday, next_weekly_run(weekday, now), now))
+        conn.commit()
+        standing_id = cursor.lastrowid
+        logger.info("Standing order %s created for user %s (weekday %s).", standing_id, user_id, weekday)
+    except sqlite3.Error as e:
+        logger.error("DB error creating standing order for user %s: %s", user_id, e)
+    finally:
+        conn.close()
+    return standing_id
+
+def get_user_standing_orders(user_id: int) -> list:
+    """ (id, weekday, next_run_ts, items_summary) of the user's standing orders. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    standing_orders = []
+    try:
+        cursor.execute("SELECT id, weekday, next_run_ts, items_summary FROM standing_orders WHERE user_id = ? ORDER BY id", (user_id,))
+        standing_orders = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting standing orders for user %s: %s", user_id, e)
+    finally:
+        conn.close()
+    return standing_orders
+
+def delete_standing_order(standing_id: int, user_id: int) -> bool:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    deleted = False
+    try:
+        cursor.execute("DELETE FROM standing_orders WHERE id = ? AND user_id = ?", (standing_id, user_id))
+        conn.commit()
+        deleted = cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error("DB error deleting standing order %s: %s", standing_id, e)
+    finally:
+        conn.close()
+    return deleted
+
+def materialize_standing_orders(now_ts: int, limit: int = STANDING_ORDER_BATCH_SIZE) -> list | None:
+    """
+    Places up to limit standing orders due at now_ts in one transaction: the orders (same rows and rollups as
+    save_order_to_db), the advanced next_run_ts and the outbox events from standing_order_events, which replace
+    the per-order 'order_created' admin notifications with one digest. Blocking; meant for standing_orders_job.
+    Returns the runs (see plan_standing_order_runs, plus 'order_id'), or None on a database error.
+    """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    runs = None
+    try:
+        conn.execute("BEGIN IMMEDIATE") # Take the write lock before reading, so the due rows cannot be placed twice
+        cursor.execute("SELECT id, user_id, user_name, username, items_json, weekday, next_run_ts FROM standing_orders WHERE next_run_ts <= ? ORDER BY next_run_ts, id LIMIT ?",
+                       (now_ts, limit))
+        due_rows = cursor.fetchall()
+        product_ids = sorted({line['id'] for row in due_rows for line in json.loads(row[4])})
+        products = {}
+        if product_ids:
+            cursor.execute(f"SELECT id, name, price_per_kg, is_available FROM products WHERE id IN ({','.join('?' * len(product_ids))})", product_ids)
+            products = {pid: (name, price, avail) for pid, name, price, avail in cursor.fetchall()}
+        runs = plan_standing_order_runs(due_rows, products, now_ts)
+        for run in runs:
+            run['order_id'] = _find_order_by_idempotency_key(cursor, run['idempotency_key']) if run['items'] else None
+            if run['items'] and not run['order_id']:
+                run['order_id'] = _insert_order(cursor, run['user_id'], run['user_name'], run['items'], run['total_price'], now_ts, run['idempotency_key'])
+        cursor.executemany("UPDATE standing_orders SET next_run_ts = ?, last_order_id = COALESCE(?, last_order_id) WHERE id = ?",
+                           [(run['next_run_ts'], run['order_id'], run['standing_id']) for run in runs])
+        for event_type, payload in standing_order_events(runs):
+            enqueue_outbox_event(cursor, event_type, payload)
+        conn.commit()
+        if runs: logger.info("Materialized %s standing orders (%s placed).", len(runs), sum(1 for run in runs if run['order_id']))
+    except sqlite3.Error as e:
+        logger.error("DB error materializing standing orders: %s", e)
+        conn.rollback()
+        runs = None
+    finally:
+        conn.close()
+    return runs
+
+# --- Order Status ---
+# Target status -> the statuses an order may move from. Completed and cancelled orders are final.
+ORDER_STATUS_TRANSITIONS = {
+    'confirmed': ('pending',),
+    'completed': ('pending', 'confirmed'),
+    'cancelled': ('pending', 'confirmed'),
+}
+OPEN_ORDER_STATUSES = ('pending', 'confirmed')
+
+def status_rollup_deltas(status: str, changed_orders) -> tuple[list, list]:
+    """
+    Rollup changes for orders that just moved to status, from (id, user_id, order_ts, total_price, items_json, slot_id) rows.
+    Completing adds to the day's completed totals; cancelling takes the order out of the day's and its products' totals.
+    Returns (daily rows, product rows), one per day / (day, product), in the parameter order of the rollup UPDATEs.
+    """
+    daily, per_product = {}, {}
+    for _order_id, _user_id, order_ts, total_price, items_json, *_rest in changed_orders:
+        day = rollup_day(order_ts)
+        day_delta = daily.setdefault(day, [0, 0.0, 0, 0.0])
+        if status == 'completed':
+            day_delta[2] += 1; day_delta[3] += total_price
+        elif status == 'cancelled':
+            day_delta[0] -= 1; day_delta[1] -= total_price
+            for item in json.loads(items_json or "[]"):
+                product_delta = per_product.setdefault((day, item['name']), [0, 0.0, 0.0])
+                product_delta[0] -= 1; product_delta[1] -= item['quantity']; product_delta[2] -= item['quantity'] * item['price']
+    if status not in ('completed', 'cancelled'): return [], []
+    return ([(*delta, day) for day, delta in daily.items()],
+            [(*delta, day, pname) for (day, pname), delta in per_product.items()])
+
+def slot_release_deltas(status: str, changed_orders) -> list:
+    """ (orders, kg, slot_id) to take off the slot counters when orders are cancelled; rows as for status_rollup_deltas. """
+    if status != 'cancelled': return []
+    released = {}
+    for _order_id, _user_id, _order_ts, _total_price, items_json, slot_id in changed_orders:
+        if slot_id is None: continue
+        slot_delta = released.setdefault(slot_id, [0, 0.0])
+        slot_delta[0] += 1; slot_delta[1] += order_weight_kg(json.loads(items_json or "[]"))
+    return [(*delta, slot_id) for slot_id, delta in released.items()]
+
+def get_orders_by_status(statuses: tuple = OPEN_ORDER_STATUSES) -> list:
+    """ (id, user_id, user_name, order_ts, total_price, status), oldest first: the order they are packed in. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    orders = []
+    try:
+        cursor.execute(f"SELECT id, user_id, user_name, order_ts, total_price, status FROM orders WHERE status IN ({','.join('?' * len(statuses))}) ORDER BY order_ts, id",
+                       tuple(statuses))
+        orders = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB error getting %s orders: %s", "/".join(statuses), e)
+    finally:
+        conn.close()
+    return orders
+
+def set_orders_status(order_ids: list, status: str, notify_customers: bool = False) -> list | None:
+    """
+    Moves the orders to status with one set-based UPDATE; orders that may not make that transition
+    (ORDER_STATUS_TRANSITIONS) are left as they are. The rollup deltas and, with notify_customers, one
+    'order_status_changed' outbox event per changed order are written in the same transaction.
+    Returns the ids of the orders that changed, or None on a database error.
+    """
+    from_statuses = ORDER_STATUS_TRANSITIONS[status]
+    if not order_ids: return []
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    changed_ids = None
+    try:
+        conn.execute("BEGIN TRANSACTION")
+        cursor.execute(f"UPDATE orders SET status = ? WHERE id IN ({','.join('?' * len(order_ids))}) AND status IN ({','.join('?' * len(from_statuses))}) "
+                       "RETURNING id, user_id, order_ts, total_price, items_json, slot_id", (status, *order_ids, *from_statuses))
+        changed = cursor.fetchall()
+        daily_deltas, product_deltas = status_rollup_deltas(status, changed)
+        cursor.executemany("UPDATE delivery_slots SET booked_orders = booked_orders - ?, booked_kg = booked_kg - ? WHERE id = ?", slot_release_deltas(status, changed))
+        cursor.executemany("UPDATE sales_daily SET orders_count = orders_count + ?, revenue = revenue + ?, completed_count = completed_count + ?, completed_revenue = completed_revenue + ? WHERE day = ?",
+                           daily_deltas)
+        cursor.executemany("UPDATE sales_daily_product SET orders_count = orders_count + ?, quantity_kg = quantity_kg + ?, revenue = revenue + ? WHERE day = ? AND product_name = ?",
+                           product_deltas)
+        if notify_customers:
+            for order_id_val, user_id, *_rest in changed:
+                enqueue_outbox_event(cursor, 'order_status_changed', {'order_id': order_id_val, 'user_id': user_id, 'status': status})
+        conn.commit()
+        changed_ids = [row[0] for row in changed]
+        logger.info("%s of %s orders set to '%s'.", len(changed_ids), len(order_ids), status)
+    except sqlite3.Error as e:
+        logger.error("DB error setting %s orders to '%s': %s", len(order_ids), status, e)
+        conn.rollback()
+    finally:
+        conn.close()
+    return changed_ids
+
 def mark_order_as_completed_in_db(order_id_to_mark: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
+    return bool(set_orders_status([order_id_to_mark], 'completed'))
+
+# --- Outbox ---
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SECONDS = 15
+OUTBOX_RETRY_MAX_SECONDS = 3600
+
+def enqueue_outbox_event(cursor, event_type: str, payload: dict, now: int = None):
+    """ Queues an event on the caller's cursor, so it commits or rolls back together with the change it describes. """
+    now = int(time.time()) if now is None else now
+    cursor.execute("INSERT INTO outbox (event_type, payload, created_ts, next_attempt_ts) VALUES (?, ?, ?, ?)",
+                   (event_type, json.dumps(payload, ensure_ascii=False), now, now))
+
+def get_due_outbox_events(limit: int = 50) -> list:
+    """ Pending events whose retry time has come, oldest first, as (id, event_type, payload, attempts, done_recipient_ids). """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    events = []
+    try:
+        cursor.execute("SELECT id, event_type, payload, attempts FROM outbox WHERE status = 'pending' AND next_attempt_ts <= ? ORDER BY id LIMIT ?",
+                       (int(time.time()), limit))
+        rows = cursor.fetchall()
+        delivered = {}
+        if rows:
+            placeholders = ",".join("?" * len(rows))
+            cursor.execute(f"SELECT event_id, recipient_id FROM outbox_deliveries WHERE status IN ('sent', 'unreachable') AND event_id IN ({placeholders})",
+                           tuple(row[0] for row in rows))
+            for event_id, recipient_id in cursor.fetchall():
+                delivered.setdefault(event_id, set()).add(recipient_id)
+        events = [(event_id, event_type, json.loads(payload), attempts, delivered.get(event_id, set()))
+                  for event_id, event_type, payload, attempts in rows]
+    except sqlite3.Error as e:
+        logger.error("DB error reading due outbox events: %s", e)
+    finally:
+        conn.close()
+    return events
+
+def record_outbox_delivery(event_id: int, recipient_id: int, status: str, error: str = None) -> bool:
+    """ Stores the per-recipient result ('sent', 'failed' or 'unreachable'); (event_id, recipient_id) is the idempotency key that stops a retry from re-sending. """
+    conn = sqlite3.connect(db_path())
     cursor = conn.cursor()
     success = False
     try:
-        cursor.execute("UPDATE orders SET status = ? WHERE id = ?", ('completed', order_id_to_mark))
+        cursor.execute("""
+            INSERT INTO outbox_deliveries (event_id, recipient_id, status, attempts, delivered_ts, last_error) VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (event_id, recipient_id) DO UPDATE SET status = excluded.status, attempts = attempts + 1,
+                delivered_ts = excluded.delivered_ts, last_error = excluded.last_error
+        """, (event_id, recipient_id, status, int(time.time()) if status == 'sent' else None, error))
         conn.commit()
-        if cursor.rowcount > 0:
-            success = True
-            logger.info(f"Order {order_id_to_mark} marked as completed in DB.")
+        success = True
+    except sqlite3.Error as e:
+        logger.error("DB error recording outbox delivery %s -> %s: %s", event_id, recipient_id, e)
+    finally:
+        conn.close()
+    return success
+
+def next_outbox_state(delivered: bool, attempts: int) -> tuple[str, int, int]:
+    """ (status, attempts, next_attempt_ts) after a delivery run; shared by the storage backends. """
+    attempts += 1
+    if delivered:
+        return 'sent', attempts, int(time.time())
+    status = 'failed' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending'
+    return status, attempts, int(time.time()) + min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+
+def finish_outbox_event(event_id: int, delivered: bool, attempts: int, error: str = None) -> bool:
+    """ Marks an event sent, or schedules a retry with exponential backoff until OUTBOX_MAX_ATTEMPTS, after which it is marked failed. """
+    status, attempts, next_attempt_ts = next_outbox_state(delivered, attempts)
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        cursor.execute("UPDATE outbox SET status = ?, attempts = ?, next_attempt_ts = ?, last_error = ? WHERE id = ?",
+                       (status, attempts, next_attempt_ts, error, event_id))
+        conn.commit()
+        success = True
+        if status == 'failed': logger.error("Outbox event %s gave up after %s attempts: %s", event_id, attempts, error)
     except sqlite3.Error as e:
-        logger.error(f"DB error marking order {order_id_to_mark} as completed: {e}")
+        logger.error("DB error finishing outbox event %s: %s", event_id, e)
     finally:
         conn.close()
-    return success
\ No newline at end of file
+    return success
+
+# Everything below (saved carts, broadcast progress, maintenance) is this process's operational state and
+# always lives in the SQLite file. Users, catalog and orders go through storage.py, which can put them on PostgreSQL.
+
+# --- Saved Carts ---
+def save_carts(carts: dict) -> bool:
+    """ Spills {user_id: cart} in one transaction; an existing saved cart for the same user is replaced. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    now = int(time.time())
+    try:
+        cursor.executemany("INSERT OR REPLACE INTO saved_carts (user_id, cart_json, saved_ts) VALUES (?, ?, ?)",
+                           [(user_id, json.dumps(cart, ensure_ascii=False), now) for user_id, cart in carts.items()])
+        conn.commit()
+        success = True
+    except sqlite3.Error as e:
+        logger.error("DB error saving %s carts: %s", len(carts), e)
+        conn.rollback()
+    finally:
+        conn.close()
+    return success
+
+def pop_saved_cart(user_id: int) -> list | None:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    cart = None
+    try:
+        cursor.execute("DELETE FROM saved_carts WHERE user_id = ? RETURNING cart_json", (user_id,))
+        row = cursor.fetchone()
+        conn.commit()
+        if row: cart = json.loads(row[0])
+    except sqlite3.Error as e:
+        logger.error("DB error restoring saved cart for user %s: %s", user_id, e)
+    finally:
+        conn.close()
+    return cart
+
+def get_saved_cart_user_ids() -> list:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    user_ids = []
+    try:
+        cursor.execute("SELECT user_id FROM saved_carts")
+        user_ids = [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error("DB error listing saved carts: %s", e)
+    finally:
+        conn.close()
+    return user_ids
+
+def prune_saved_carts(max_age_seconds: int) -> list:
+    """ Deletes saved carts older than max_age_seconds and returns the affected user ids. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    user_ids = []
+    try:
+        cursor.execute("DELETE FROM saved_carts WHERE saved_ts < ? RETURNING user_id", (int(time.time()) - max_age_seconds,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("DB error pruning saved carts: %s", e)
+    finally:
+        conn.close()
+    return user_ids
+
+# --- Broadcasts ---
+BROADCAST_COLUMNS = "id, text, status, last_user_id, total_count, sent_count, failed_count, blocked_count, progress_chat_id, progress_message_id, created_ts"
+
+def _broadcast_row_to_dict(row) -> dict:
+    return dict(zip([c.strip() for c in BROADCAST_COLUMNS.split(",")], row))
+
+def count_reachable_users() -> int:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    count = 0
+    try:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 0")
+        count = cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error("DB error counting reachable users: %s", e)
+    finally:
+        conn.close()
+    return count
+
+def mark_users_blocked(user_ids: list) -> bool:
+    """ Flags users who blocked the bot, so broadcasts skip them until they write to the bot again. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        cursor.executemany("UPDATE users SET is_blocked = 1 WHERE telegram_id = ?", [(uid,) for uid in user_ids])
+        conn.commit()
+        success = True
+    except sqlite3.Error as e:
+        logger.error("DB error marking %s users as blocked: %s", len(user_ids), e)
+    finally:
+        conn.close()
+    return success
+
+def create_broadcast(text: str, created_by: int, total: int, progress_chat_id: int = None, progress_message_id: int = None) -> int | None:
+    """ total is the number of reachable users (Storage.count_reachable_users), shown as the progress target. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    broadcast_id = None
+    try:
+        cursor.execute("INSERT INTO broadcasts (text, created_by, created_ts, total_count, progress_chat_id, progress_message_id) VALUES (?, ?, ?, ?, ?, ?)",
+                       (text, created_by, int(time.time()), total, progress_chat_id, progress_message_id))
+        conn.commit()
+        broadcast_id = cursor.lastrowid
+        logger.info("Broadcast %s created by %s for %s users.", broadcast_id, created_by, total)
+    except sqlite3.Error as e:
+        logger.error("DB error creating broadcast: %s", e)
+    finally:
+        conn.close()
+    return broadcast_id
+
+def get_broadcast(broadcast_id: int) -> dict | None:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    broadcast = None
+    try:
+        cursor.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,))
+        row = cursor.fetchone()
+        if row: broadcast = _broadcast_row_to_dict(row)
+    except sqlite3.Error as e:
+        logger.error("DB error getting broadcast %s: %s", broadcast_id, e)
+    finally:
+        conn.close()
+    return broadcast
+
+def get_running_broadcast_ids() -> list:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    ids = []
+    try:
+        cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        ids = [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error("DB error listing running broadcasts: %s", e)
+    finally:
+        conn.close()
+    return ids
+
+def get_broadcast_recipients(after_user_id: int, limit: int) -> list:
+    """ Next batch of reachable users after the cursor (primary-key range scan). """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    user_ids = []
+    try:
+        cursor.execute("SELECT telegram_id FROM users WHERE telegram_id > ? AND is_blocked = 0 ORDER BY telegram_id LIMIT ?", (after_user_id, limit))
+        user_ids = [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error("DB error reading broadcast recipients after %s: %s", after_user_id, e)
+    finally:
+        conn.close()
+    return user_ids
+
+def advance_broadcast(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int) -> bool:
+    """ Moves the cursor past a finished batch. The batch's blocked users are flagged first (mark_users_blocked), so a resend after a crash skips them. """
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        cursor.execute("""
+            UPDATE broadcasts SET last_user_id = ?, sent_count = sent_count + ?, failed_count = failed_count + ?, blocked_count = blocked_count + ?
+            WHERE id = ?
+        """, (last_user_id, sent, failed, blocked, broadcast_id))
+        conn.commit()
+        success = True
+    except sqlite3.Error as e:
+        logger.error("DB error advancing broadcast %s: %s", broadcast_id, e)
+    finally:
+        conn.close()
+    return success
+
+def set_broadcast_status(broadcast_id: int, status: str, only_if_running: bool = False) -> bool:
+    conn = sqlite3.connect(db_path())
+    cursor = conn.cursor()
+    success = False
+    try:
+        query = "UPDATE broadcasts SET status = ?, finished_ts = ? WHERE id = ?"
+        if only_if_running: query += " AND status = 'running'"
+        cursor.execute(query, (status, None if status == 'running' else int(time.time()), broadcast_id))
+        conn.commit()
+        success = cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error("DB error setting broadcast %s status to %s: %s", broadcast_id, status, e)
+    finally:
+        conn.close()
+    return success
+
+# --- Maintenance ---
+VACUUM_STEP_PAGES = 256 # Pages released per incremental_vacuum transaction, keeps each write lock short
+BACKUP_STEP_PAGES = 64 # Pages copied per backup step; the source is unlocked between steps
+MAINTENANCE_STEP_SLEEP_SECONDS = 0.01 # Pause between steps so queued writers get the lock
+
+def _log_maintenance(task: str, started: float, duration_ms: int, ok: bool, details: str):
+    conn = sqlite3.connect(db_path())
+    try:
+        conn.execute("INSERT INTO maintenance_log (task, started_ts, duration_ms, ok, details) VALUES (?, ?, ?, ?, ?)",
+                     (task, int(started), duration_ms, 1 if ok else 0, details))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("DB error recording maintenance task %s: %s", task, e)
+    finally:
+        conn.close()
+    logger.log(logging.INFO if ok else logging.ERROR, "DB maintenance '%s' %s in %s ms: %s", task, "finished" if ok else "failed", duration_ms, details,
+               extra={"task": task, "duration_ms": duration_ms})
+
+def _timed_maintenance(task: str, work) -> bool:
+    """ Runs work() -> details string, and records how long it took. """
+    started, clock = time.time(), time.perf_counter()
+    try:
+        details, ok = work(), True
+    except (sqlite3.Error, OSError) as e:
+        details, ok = str(e), False
+    _log_maintenance(task, started, int((time.perf_counter() - clock) * 1000), ok, details)
+    return ok
+
+def checkpoint_wal(mode: str = "TRUNCATE") -> bool:
+    """ Folds the WAL back into the main file. TRUNCATE also resets the WAL file; use it when the bot is idle. """
+    def work():
+        conn = sqlite3.connect(db_path())
+        try:
+            busy, wal_pages, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        finally:
+            conn.close()
+        return f"mode={mode} busy={busy} wal_pages={wal_pages} checkpointed={checkpointed}"
+    return _timed_maintenance("wal_checkpoint", work)
+
+def optimize_database() -> bool:
+    """ Refreshes planner statistics (bounded by analysis_limit) so query plans track the data. """
+    def work():
+        conn = sqlite3.connect(db_path())
+        try:
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA optimize")
+            conn.commit()
+        finally:
+            conn.close()
+        return "analyze+optimize"
+    return _timed_maintenance("optimize", work)
+
+def incremental_vacuum() -> bool:
+    """ Returns free pages to the filesystem in VACUUM_STEP_PAGES-sized transactions, so checkouts only wait for one step. """
+    def work():
+        conn = sqlite3.connect(db_path())
+        released = 0
+        try:
+            while True:
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free_pages: break
+                step = min(free_pages, VACUUM_STEP_PAGES)
+                # executescript steps the pragma to completion; execute() would free only one page per call.
+                conn.executescript(f"PRAGMA incremental_vacuum({step});")
+                released += step
+                time.sleep(MAINTENANCE_STEP_SLEEP_SECONDS)
+        finally:
+            conn.close()
+        return f"released_pages={released}"
+    return _timed_maintenance("incremental_vacuum", work)
+
+def backup_database(backup_dir: str, keep: int = 7) -> str | None:
+    """
+    Online backup through the sqlite3 backup API, copied in BACKUP_STEP_PAGES steps with the source unlocked in between.
+    Writes to a temporary file first so a crash never leaves a truncated backup under the final name; keeps the newest `keep` files.
+    """
+    target = os.path.join(backup_dir, f"bot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    def work():
+        os.makedirs(backup_dir, exist_ok=True)
+        partial = target + ".partial"
+        source, destination = sqlite3.connect(db_path()), sqlite3.connect(partial)
+        try:
+            source.backup(destination, pages=BACKUP_STEP_PAGES, sleep=MAINTENANCE_STEP_SLEEP_SECONDS)
+        except sqlite3.Error:
+            destination.close()
+            os.remove(partial)
+            raise
+        finally:
+            destination.close()
+            source.close()
+        os.replace(partial, target)
+        backups = sorted(f for f in os.listdir(backup_dir) if f.startswith("bot-") and f.endswith(".db"))
+        for old_backup in backups[:-keep] if keep > 0 else []:
+            os.remove(os.path.join(backup_dir, old_backup))
+        return f"{target} ({os.path.getsize(target)} bytes)"
+    return target if _timed_maintenance("backup", work) else None
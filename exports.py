@@ -0,0 +1,81 @@
+# exports.py
+# Order export writers. Rows are streamed in batches from the storage backend into a spooled
+# temp file, so memory stays bounded by the batch size and the spool threshold rather than by
+# the number of orders. Serializing each batch runs in a worker thread.
+
+import asyncio
+import contextlib
+import csv
+import gzip
+import io
+import json
+import tempfile
+from datetime import datetime, timezone
+
+from config_and_utils import format_timestamp
+
+import storage
+
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_BATCH_SIZE = 500
+EXPORT_SPOOL_MAX_BYTES = 5 * 1024 * 1024 # Spill to a real temp file on disk beyond this size
+
+EXPORT_COLUMNS = (
+    "order_id", "order_time_utc", "order_time_local", "customer_id", "customer_name", "status",
+    "order_total_eur", "product_id", "product_name", "quantity", "unit", "price_per_unit_eur", "line_total_eur"
+)
+
+
+def _export_record(row) -> dict:
+    order_id, order_ts, customer_id, customer_name, status, order_total, product_id, product_name, quantity, unit, price = row
+    return {
+        "order_id": order_id,
+        "order_time_utc": datetime.fromtimestamp(order_ts, tz=timezone.utc).isoformat() if order_ts is not None else None,
+        "order_time_local": format_timestamp(order_ts, "%Y-%m-%d %H:%M:%S"),
+        "customer_id": customer_id,
+        "customer_name": customer_name,
+        "status": status,
+        "order_total_eur": order_total,
+        "product_id": product_id,
+        "product_name": product_name,
+        "quantity": quantity,
+        "unit": unit,
+        "price_per_unit_eur": price,
+        "line_total_eur": round(quantity * price, 2) if quantity is not None and price is not None else None,
+    }
+
+
+def _write_rows(text_target, writer, rows: list) -> int:
+    for row in rows:
+        record = _export_record(row)
+        if writer: writer.writerow(record.values())
+        else: text_target.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return len(rows)
+
+async def write_orders_export(fmt: str = "csv", compress: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    Writes all order lines as CSV or JSON Lines (optionally gzip-compressed) into a SpooledTemporaryFile.
+    Returns (file positioned at 0, number of rows written). The caller owns and must close the file.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    binary_target = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    # utf-8-sig so spreadsheet apps detect the encoding of Lithuanian product names
+    text_target = io.TextIOWrapper(binary_target, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+    rows_written = 0
+    try:
+        try:
+            writer = csv.writer(text_target) if fmt == "csv" else None
+            if writer: writer.writerow(EXPORT_COLUMNS)
+            async with contextlib.aclosing(storage.backend.iter_order_export_rows(batch_size)) as batches: # Releases the DB cursor on errors too
+                async for rows in batches:
+                    rows_written += await asyncio.to_thread(_write_rows, text_target, writer, rows)
+        finally:
+            text_target.detach() # Flushes, but keeps the spool open (closing the wrapper would close it)
+            if compress: binary_target.close() # Writes the gzip trailer, leaves the spool open
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, rows_written
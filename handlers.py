@@ -1,6 +1,18 @@
 # handlers.py
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Message
+import asyncio
+import logging
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+)
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
@@ -8,13 +20,28 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    ApplicationHandlerStop,
 )
 
 # Import utilities and configs
-from config_and_utils import logger, _, ADMIN_IDS, get_user_language
+from config_and_utils import (
+    _, get_user_language, reload_translations,
+    format_timestamp, format_slot, local_today, local_day_range_to_epoch, parse_date_range, CATALOG_PAGE_SIZE, STANDING_ORDER_HOUR,
+    CONVERSATION_TIMEOUT_SECONDS, DELIVERY_SLOTS
+)
 
 # Import DB operations
 import db_operations
+import exports
+import catalog_import
+import jobs
+import product_photos
+import profiling
+import roles
+import sharding
+import storage
+
+logger = logging.getLogger(__name__)
 
 # --- Conversation States ---
 (SELECT_LANGUAGE_STATE,
@@ -22,8 +49,13 @@ import db_operations
  ADMIN_MAIN_PANEL_STATE, # This state is for the main admin panel itself IF it were a conv.
  ADMIN_ADD_PROD_NAME, ADMIN_ADD_PROD_PRICE,
  ADMIN_MANAGE_PROD_LIST, ADMIN_MANAGE_PROD_OPTIONS, ADMIN_MANAGE_PROD_EDIT_PRICE, ADMIN_MANAGE_PROD_DELETE_CONFIRM,
- ADMIN_CLEAR_ORDERS_CONFIRM
-) = range(12)
+ ADMIN_CLEAR_ORDERS_CONFIRM,
+ ADMIN_ORDERS_CUSTOM_RANGE,
+ ADMIN_IMPORT_PRODUCTS_FILE,
+ ADMIN_MANAGE_PROD_NEW_CATEGORY,
+ ADMIN_BROADCAST_TEXT, ADMIN_BROADCAST_CONFIRM,
+ ADMIN_ADD_PROD_PHOTO, ADMIN_MANAGE_PROD_PHOTO
+) = range(19)
 
 
 # --- Helper: Display Main Menu ---
@@ -51,19 +83,19 @@ async def display_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         elif user_id :
             await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=InlineKeyboardMarkup(kb),parse_mode='HTML')
     except Exception as e:
-        logger.warning(f"Display main menu error (edit={edit_message}, target_message_obj exists: {bool(target_message_obj)}): {e}")
+        logger.warning("Display main menu error (edit=%s, target_message_obj exists: %s): %s", edit_message, bool(target_message_obj), e)
         if user_id and not (edit_message and target_message_obj) and not update.message :
             try:
                 await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=InlineKeyboardMarkup(kb),parse_mode='HTML')
             except Exception as send_e:
-                logger.error(f"Fallback display_main_menu send error: {send_e}")
+                logger.error("Fallback display_main_menu send error: %s", send_e)
 
 # --- Start Command & General Back to Main Menu ---
 async def start_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user: logger.error("start_command: effective_user is None"); return
 
-    await db_operations.ensure_user_exists(user.id, user.first_name or "", user.username or "", context)
+    await storage.backend.ensure_user(user.id, user.first_name or "", user.username or "")
     context.user_data['language_code'] = await get_user_language(context, user.id)
 
     lang_code = context.user_data.get('language_code')
@@ -99,14 +131,14 @@ async def back_to_main_menu_cb_handler(update: Update, context: ContextTypes.DEF
 
 # --- Language Selection Flow ---
 async def select_language_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    q=update.callback_query;await q.answer();uid=q.from_user.id;logger.info(f"User {uid} entering language selection.")
+    q=update.callback_query;await q.answer();uid=q.from_user.id;logger.info("User %s entering language selection.", uid)
     kb=[[InlineKeyboardButton("English 🇬🇧",callback_data="lang_select_en")],[InlineKeyboardButton("Lietuvių 🇱🇹",callback_data="lang_select_lt")],[InlineKeyboardButton(await _(context,"back_button",user_id=uid,default="⬅️ Back"),callback_data="main_menu_direct_cb_ender")]]
     await q.edit_message_text(await _(context,"choose_language",user_id=uid),reply_markup=InlineKeyboardMarkup(kb));return SELECT_LANGUAGE_STATE
 
 async def language_selected_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q=update.callback_query;await q.answer();code=q.data.split('_')[-1];uid=q.from_user.id
     context.user_data['language_code']=code
-    await db_operations.set_user_language_db(uid,code)
+    await storage.backend.set_user_language(uid,code)
     name="English" if code=="en" else "Lietuvių"
     
     await q.edit_message_text(await _(context,"language_set_to",user_id=uid,language_name=name))
@@ -119,9 +151,97 @@ async def language_selected_state(update: Update, context: ContextTypes.DEFAULT_
 
     return ConversationHandler.END
 
+# --- Activity Tracking ---
+async def record_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs before every other handler. Background maintenance uses the global timestamp to find idle windows,
+    session eviction uses the per-user one. A cart spilled to SQLite by eviction is restored on the user's next update.
+    """
+    now = time.monotonic()
+    context.bot_data['last_update_monotonic'] = now
+    sharding.note_activity(now) # The checkpoint job runs in one worker but must see every worker's traffic
+    user = update.effective_user
+    if not user: return
+    context.bot_data.setdefault('user_last_seen', {})[user.id] = now
+    spilled_cart_users = context.bot_data.get('spilled_cart_users')
+    if spilled_cart_users and user.id in spilled_cart_users:
+        spilled_cart_users.discard(user.id)
+        cart = await asyncio.to_thread(db_operations.pop_saved_cart, user.id)
+        if cart and not context.user_data.get('cart'): context.user_data['cart'] = cart
+
+# --- Callback Debounce ---
+CALLBACK_DEBOUNCE_SECONDS = 1.0 # Same button on the same message pressed again within this window is ignored
+CALLBACK_IN_FLIGHT_TIMEOUT_SECONDS = 30 # A press whose handler never released is forgotten after this
+
+def _callback_key(q) -> tuple:
+    return (q.from_user.id, q.message.message_id if q.message else q.inline_message_id, q.data)
+
+async def debounce_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Group -1: a press that repeats one still being handled, or handled less than CALLBACK_DEBOUNCE_SECONDS ago,
+    is answered right away and stopped before it reaches the real handler.
+    """
+    q = update.callback_query
+    now, key = time.monotonic(), _callback_key(q)
+    in_flight = context.bot_data.setdefault('callbacks_in_flight', {})
+    recent = context.bot_data.setdefault('callbacks_recent', {})
+    started = in_flight.get(key)
+    if (started is not None and now - started < CALLBACK_IN_FLIGHT_TIMEOUT_SECONDS) or now - recent.get(key, float('-inf')) < CALLBACK_DEBOUNCE_SECONDS:
+        await q.answer()
+        raise ApplicationHandlerStop
+    in_flight[key] = now
+    if len(recent) > 1000: # Drop expired windows so the dict stays bounded
+        for stale_key in [k for k, done in recent.items() if now - done >= CALLBACK_DEBOUNCE_SECONDS]: del recent[stale_key]
+        for stale_key in [k for k, began in in_flight.items() if now - began >= CALLBACK_IN_FLIGHT_TIMEOUT_SECONDS]: del in_flight[stale_key]
+
+async def release_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ Group 1: runs after the real handler (also when it raised) and opens the debounce window. """
+    key = _callback_key(update.callback_query)
+    if context.bot_data.get('callbacks_in_flight', {}).pop(key, None) is not None:
+        context.bot_data.setdefault('callbacks_recent', {})[key] = time.monotonic()
+
+# --- Helper: Paged Catalog Keyboard ---
+async def _paged_catalog_rows(context: ContextTypes.DEFAULT_TYPE, user_id: int, page: int, category_id: int, available_only: bool,
+                              callback_prefix: str, select_prefix: str, button_label) -> tuple[list, int, int, int, int]:
+    """
+    Keyboard rows for one catalog page: category tabs, the page's products and prev/next controls.
+    Returns (rows, page, total_pages, category_id, product_count_on_page) with page/category clamped to valid values.
+    """
+    products, page, total_pages, categories, category_id = await storage.backend.get_catalog_page(page, CATALOG_PAGE_SIZE, category_id, available_only)
+    rows = []
+    if categories:
+        tabs = [(0, await _(context, "catalog_all_categories_tab", user_id=user_id, default="All"))] + categories
+        tab_buttons = [InlineKeyboardButton(("• " if cid == category_id else "") + cname, callback_data=f"{callback_prefix}_cat_{cid}") for cid, cname in tabs]
+        rows.extend(tab_buttons[i:i + 3] for i in range(0, len(tab_buttons), 3))
+    rows.extend([InlineKeyboardButton(button_label(product), callback_data=f"{select_prefix}{product[0]}")] for product in products)
+    if total_pages > 1:
+        nav = []
+        if page > 0: nav.append(InlineKeyboardButton(await _(context, "catalog_prev_page_button", user_id=user_id, default="◀️"), callback_data=f"{callback_prefix}_page_{page - 1}"))
+        if page < total_pages - 1: nav.append(InlineKeyboardButton(await _(context, "catalog_next_page_button", user_id=user_id, default="▶️"), callback_data=f"{callback_prefix}_page_{page + 1}"))
+        rows.append(nav)
+    return rows, page, total_pages, category_id, len(products)
+
+async def _show_product_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, product) -> None:
+    """ Sends the selected product's photo below the quantity prompt; display_cart_and_products removes it again. """
+    try:
+        sent = await product_photos.send_product_photo(context.bot, chat_id, product[0], caption=f"{product[1]} - {product[2]:.2f} EUR/kg")
+    except TelegramError as e:
+        logger.warning("Could not send the photo of product %s: %s", product[0], e)
+        return
+    if sent: context.user_data['product_photo_message'] = (chat_id, sent.message_id)
+
+async def _delete_product_photo_message(context: ContextTypes.DEFAULT_TYPE) -> None:
+    photo_message = context.user_data.pop('product_photo_message', None)
+    if not photo_message: return
+    try:
+        await context.bot.delete_message(chat_id=photo_message[0], message_id=photo_message[1])
+    except TelegramError as e:
+        logger.warning("Could not delete product photo message %s: %s", photo_message[1], e)
+
 # --- USER ORDER FLOW (COMBINED CART & PRODUCTS) ---
 async def display_cart_and_products(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, edit_message_id: int = None) -> int:
     cart = context.user_data.get('cart', [])
+    await _delete_product_photo_message(context)
     query = update.callback_query
 
     cart_text_parts = []
@@ -140,15 +260,16 @@ async def display_cart_and_products(update: Update, context: ContextTypes.DEFAUL
         cart_text_parts.append("------------------------------------")
     cart_display_text = "\n".join(cart_text_parts)
 
-    products = db_operations.get_products_from_db(available_only=True)
-    product_keyboard_buttons = []
+    product_keyboard_buttons, page, total_pages, category_id, products_on_page = await _paged_catalog_rows(
+        context, user_id, context.user_data.get('catalog_page', 0), context.user_data.get('catalog_category', 0), True,
+        "order_flow", "order_flow_select_prod_", lambda product: f"{product[1]} - {product[2]:.2f} EUR/kg")
+    context.user_data['catalog_page'], context.user_data['catalog_category'] = page, category_id
     product_list_text_parts = ["\n" + await _(context, "products_title", user_id=user_id)]
 
-    if not products:
+    if not products_on_page:
         product_list_text_parts.append(await _(context, "no_products_available", user_id=user_id))
-    else:
-        for pid, name, price, _avail in products:
-            product_keyboard_buttons.append([InlineKeyboardButton(f"{name} - {price:.2f} EUR/kg", callback_data=f"order_flow_select_prod_{pid}")])
+    elif total_pages > 1:
+        product_list_text_parts.append(await _(context, "catalog_page_indicator", user_id=user_id, page=page + 1, total_pages=total_pages, default=f"{page + 1}/{total_pages}"))
 
     full_text_to_send = cart_display_text + "\n" + "\n".join(product_list_text_parts)
 
@@ -186,29 +307,37 @@ async def display_cart_and_products(update: Update, context: ContextTypes.DEFAUL
             sent_message_object = await context.bot.send_message(chat_id=user_id, text=full_text_to_send, reply_markup=reply_markup)
             context.user_data['last_product_list_message_id'] = sent_message_object.message_id
     except Exception as e:
-        logger.error(f"Error in display_cart_and_products (edit_id={current_message_id_to_edit}, chat_id={chat_id_to_use}): {e}")
+        logger.error("Error in display_cart_and_products (edit_id=%s, chat_id=%s): %s", current_message_id_to_edit, chat_id_to_use, e)
         try:
             sent_message_object = await context.bot.send_message(chat_id=user_id, text=full_text_to_send, reply_markup=reply_markup)
             context.user_data['last_product_list_message_id'] = sent_message_object.message_id
         except Exception as send_e:
-            logger.error(f"Fallback send_message in display_cart_and_products also failed: {send_e}")
+            logger.error("Fallback send_message in display_cart_and_products also failed: %s", send_e)
 
     return ORDER_FLOW_BROWSING_PRODUCTS
 
 async def order_flow_browse_entry(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    logger.info(f"User {update.effective_user.id} entered order_flow_browse_entry")
+    logger.info("User %s entered order_flow_browse_entry", update.effective_user.id)
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     return await display_cart_and_products(update, context, user_id, edit_message_id=query.message.message_id)
 
+async def order_flow_catalog_nav_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ Category tab (order_flow_cat_<id>) or page control (order_flow_page_<n>) in the product list. """
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    _prefix,kind,value=q.data.rsplit('_',2)
+    if kind=='cat': context.user_data.update({'catalog_category':int(value),'catalog_page':0})
+    else: context.user_data['catalog_page']=int(value)
+    return await display_cart_and_products(update, context, uid, edit_message_id=q.message.message_id)
+
 async def order_flow_product_selected(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
     try:pid=int(q.data.split('_')[-1])
     except (IndexError, ValueError):
-        logger.warning(f"Failed to parse product ID: {q.data}")
+        logger.warning("Failed to parse product ID: %s", q.data)
         return await display_cart_and_products(update, context, uid, edit_message_id=q.message.message_id)
-    prod=db_operations.get_product_by_id(pid)
+    prod=await storage.backend.get_product(pid)
     if not prod:
         await q.edit_message_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
         return await display_cart_and_products(update, context, uid, edit_message_id=q.message.message_id)
@@ -217,6 +346,7 @@ async def order_flow_product_selected(update:Update,context:ContextTypes.DEFAULT
     if q.message:
         context.user_data['last_product_list_message_id'] = q.message.message_id
     await q.edit_message_text(await _(context,"product_selected_prompt",user_id=uid,product_name=prod[1]))
+    await _show_product_photo(context, q.message.chat_id, prod)
     return ORDER_FLOW_SELECTING_QUANTITY
 
 async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
@@ -236,7 +366,7 @@ async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_T
                     text=await _(context,"product_selected_prompt",user_id=uid,product_name=prod_name)
                 )
             except Exception as e:
-                logger.error(f"Error re-editing quantity prompt message {message_to_edit_id}: {e}")
+                logger.error("Error re-editing quantity prompt message %s: %s", message_to_edit_id, e)
                 await context.bot.send_message(chat_id=uid, text=await _(context,"product_selected_prompt",user_id=uid,product_name=prod_name))
         else:
             prod_name = context.user_data.get('current_product_name', 'the selected product')
@@ -252,6 +382,7 @@ async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_T
         return await display_cart_and_products(update, context, uid, edit_message_id=message_to_edit_id)
 
     cart=context.user_data.setdefault('cart',[])
+    context.user_data.pop('cart_token',None) # A changed cart is a new checkout
     found_item = next((item for item in cart if item['id'] == pid), None)
     if found_item:
         found_item['quantity'] += qnt
@@ -261,10 +392,103 @@ async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_T
     try:
         await context.bot.delete_message(chat_id=update.message.chat_id, message_id=update.message.message_id)
     except Exception as e:
-        logger.warning(f"Could not delete user's quantity message: {e}")
+        logger.warning("Could not delete user's quantity message: %s", e)
     
     return await display_cart_and_products(update, context, uid, edit_message_id=message_to_edit_id)
 
+# --- PRODUCT SEARCH (/search, inline mode and deep links) ---
+INLINE_SEARCH_CACHE_TIME = 60 # Seconds Telegram may serve cached inline results; prices can change, so keep it short
+INLINE_SEARCH_MAX_RESULTS = 20
+
+async def order_flow_search_command(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    query_text=" ".join(context.args or []).strip()
+    if not query_text:
+        await update.message.reply_text(await _(context,"search_usage",user_id=uid,default="Usage: /search <product name>"))
+        return ORDER_FLOW_BROWSING_PRODUCTS
+    results=await storage.backend.search_products(query_text, limit=INLINE_SEARCH_MAX_RESULTS)
+    kb=[[InlineKeyboardButton(f"{name} - {price:.2f} EUR/kg",callback_data=f"order_flow_select_prod_{pid}")] for pid,name,price,_avail in results]
+    kb.append([InlineKeyboardButton(await _(context,"back_to_products_button",user_id=uid,default="⬅️ All Products"),callback_data="order_flow_browse_return_cb_detailed")])
+    kb.append([InlineKeyboardButton(await _(context,"back_to_main_menu_button",user_id=uid),callback_data="main_menu_direct_cb_ender")])
+    text_key="search_results_title" if results else "search_no_results"
+    sent=await update.message.reply_text(await _(context,text_key,user_id=uid,query=query_text,default=query_text),reply_markup=InlineKeyboardMarkup(kb))
+    context.user_data['last_product_list_message_id']=sent.message_id
+    return ORDER_FLOW_BROWSING_PRODUCTS
+
+async def order_flow_deep_link_entry(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ /start prod_<id> -- opened from the order button of an inline search result. """
+    user=update.effective_user;uid=user.id
+    await storage.backend.ensure_user(uid, user.first_name or "", user.username or "")
+    try:pid=int(context.args[0].split('_')[-1])
+    except (IndexError, ValueError, TypeError):
+        await display_main_menu(update, context);return ConversationHandler.END
+    prod=await storage.backend.get_product(pid)
+    if not prod or not prod[3]:
+        await update.message.reply_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
+        await display_main_menu(update, context);return ConversationHandler.END
+    context.user_data.update({'current_product_id':pid,'current_product_name':prod[1],'current_product_price':prod[2]})
+    sent=await update.message.reply_text(await _(context,"product_selected_prompt",user_id=uid,product_name=prod[1]))
+    context.user_data['last_product_list_message_id']=sent.message_id
+    await _show_product_photo(context, update.message.chat_id, prod)
+    return ORDER_FLOW_SELECTING_QUANTITY
+
+async def inline_product_search(update:Update,context:ContextTypes.DEFAULT_TYPE):
+    inline_query=update.inline_query
+    uid=inline_query.from_user.id
+    query_text=inline_query.query.strip()
+    if query_text:
+        products=await storage.backend.search_products(query_text, limit=INLINE_SEARCH_MAX_RESULTS)
+    else:
+        products=(await storage.backend.get_products(available_only=True))[:INLINE_SEARCH_MAX_RESULTS]
+    order_button_text=await _(context,"inline_order_button",user_id=uid,default="🛒 Order")
+    photo_ids=await storage.backend.get_product_photo_ids()
+
+    def build_results(with_photos: bool) -> list:
+        results=[]
+        for pid,name,price,_avail in products:
+            order_markup=InlineKeyboardMarkup([[InlineKeyboardButton(order_button_text,url=f"https://t.me/{context.bot.username}?start=prod_{pid}")]])
+            if with_photos and pid in photo_ids: # Telegram shows its own thumbnail of the stored photo in the results list
+                results.append(InlineQueryResultCachedPhoto(id=str(pid), photo_file_id=photo_ids[pid], title=name, description=f"{price:.2f} EUR/kg",
+                                                            caption=f"{name} - {price:.2f} EUR/kg", reply_markup=order_markup))
+            else:
+                results.append(InlineQueryResultArticle(id=str(pid), title=name, description=f"{price:.2f} EUR/kg",
+                                                        input_message_content=InputTextMessageContent(f"{name} - {price:.2f} EUR/kg"), reply_markup=order_markup))
+        return results
+
+    # Button labels are localized, so results are cached per user by Telegram.
+    try:
+        await inline_query.answer(build_results(True), cache_time=INLINE_SEARCH_CACHE_TIME, is_personal=True)
+    except BadRequest as e:
+        # One stale photo file_id fails the whole answer; it gets replaced the next time that photo is sent in a chat.
+        logger.warning("Inline answer with photos rejected (%s); answering without photos.", e)
+        await inline_query.answer(build_results(False), cache_time=INLINE_SEARCH_CACHE_TIME, is_personal=True)
+
+# --- REORDER ---
+REORDER_BUTTONS_MAX = 5 # Reorder buttons are shown for this many of the newest orders
+
+async def order_flow_reorder_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ order_flow_reorder_<order id>: adds a past order's lines to the cart at current prices and opens the cart. """
+    q=update.callback_query;uid=q.from_user.id
+    lines=await storage.backend.get_reorder_lines(int(q.data.split('_')[-1]), uid)
+    cart=context.user_data.setdefault('cart',[])
+    context.user_data.pop('cart_token',None) # A changed cart is a new checkout
+    unavailable,repriced=[],[]
+    for pid,ordered_name,qnt,ordered_price,name,price,avail in lines:
+        if name is None or not avail:
+            unavailable.append(ordered_name or name or str(pid)); continue
+        if price!=ordered_price: repriced.append(f"{name} {price:.2f}")
+        found_item=next((item for item in cart if item['id']==pid),None)
+        if found_item: found_item['quantity']+=qnt
+        else: cart.append({'id':pid,'name':name,'price':price,'quantity':qnt})
+
+    notice=[]
+    if not lines: notice.append(await _(context,"reorder_order_not_found",user_id=uid,default="Order not found."))
+    if unavailable: notice.append(await _(context,"reorder_unavailable_items",user_id=uid,items=", ".join(unavailable),default=", ".join(unavailable)))
+    if repriced: notice.append(await _(context,"reorder_price_changed_items",user_id=uid,items=", ".join(repriced),default=", ".join(repriced)))
+    if notice: await q.answer("\n".join(notice)[:200],show_alert=True) # Telegram's limit for callback answers
+    else: await q.answer()
+    return await order_flow_display_cart_detailed(update, context, uid, edit_message_id=q.message.message_id)
+
 # --- DETAILED CART MANAGEMENT FLOW ---
 async def order_flow_manage_cart_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
@@ -296,6 +520,7 @@ async def order_flow_display_cart_detailed(update: Update, context: ContextTypes
         text_to_send_parts.append(await _(context, "cart_total", user_id=user_id, total_price=total_price))
         text_to_send_parts.append("====================================")
         keyboard_buttons.append([InlineKeyboardButton(await _(context, "checkout_button", user_id=user_id), callback_data="order_flow_checkout_cb")])
+        keyboard_buttons.append([InlineKeyboardButton(await _(context, "standing_order_button", user_id=user_id, default="🔁 Order this every week"), callback_data="order_flow_standing_entry_cb")])
         keyboard_buttons.append([InlineKeyboardButton(await _(context, "back_to_main_list_button", default="⬅️ Back to Products & Cart View"), callback_data="order_flow_browse_return_cb_detailed")])
 
     keyboard_buttons.append([InlineKeyboardButton(await _(context, "back_to_main_menu_button", user_id=user_id), callback_data="main_menu_direct_cb_ender")])
@@ -321,24 +546,25 @@ async def order_flow_display_cart_detailed(update: Update, context: ContextTypes
             sent_msg = await context.bot.send_message(chat_id=user_id, text=full_text, reply_markup=reply_markup)
             context.user_data['last_product_list_message_id'] = sent_msg.message_id
     except Exception as e:
-        logger.error(f"Error in order_flow_display_cart_detailed (edit_id={current_message_id_to_edit}): {e}")
+        logger.error("Error in order_flow_display_cart_detailed (edit_id=%s): %s", current_message_id_to_edit, e)
         try:
             sent_msg = await context.bot.send_message(chat_id=user_id, text=full_text, reply_markup=reply_markup)
             context.user_data['last_product_list_message_id'] = sent_msg.message_id
         except Exception as send_e:
-            logger.error(f"Fallback send in order_flow_display_cart_detailed also failed: {send_e}")
+            logger.error("Fallback send in order_flow_display_cart_detailed also failed: %s", send_e)
     return ORDER_FLOW_VIEWING_CART
 
 async def order_flow_remove_item_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
     try:idx=int(q.data.split('_')[-1])
     except (IndexError, ValueError):
-        logger.warning(f"Failed to parse item index for removal: {q.data}")
+        logger.warning("Failed to parse item index for removal: %s", q.data)
         return await order_flow_display_cart_detailed(update,context,uid,edit_message_id=q.message.message_id)
 
     cart=context.user_data.get('cart',[])
     if 0<=idx<len(cart):
         removed=cart.pop(idx)
+        context.user_data.pop('cart_token',None)
         await context.bot.answer_callback_query(q.id, text=await _(context,"item_removed_from_cart",user_id=uid,item_name=removed['name']), show_alert=False)
     else:
         await context.bot.answer_callback_query(q.id, text=await _(context,"invalid_item_to_remove",user_id=uid), show_alert=True)
@@ -366,55 +592,32 @@ async def order_flow_checkout_cb(update:Update,context:ContextTypes.DEFAULT_TYPE
         else: await context.bot.send_message(chat_id=uid, text=empty_cart_text)
         return await display_cart_and_products(update, context, uid, edit_message_id=message_to_edit_id)
 
+    slot_id=context.user_data.get('slot_id')
+    if DELIVERY_SLOTS and slot_id is None:
+        return await _show_slot_picker(context, uid, cart, message_to_edit_id)
+
     uname=(user.full_name or "N/A")
     total_price_float = sum(i['price']*i['quantity'] for i in cart)
-    oid=db_operations.save_order_to_db(uid,uname,cart,total_price_float)
-    admin_lang_for_notification = ADMIN_IDS[0] if ADMIN_IDS else None
+    # Every tap on checkout for this cart carries the same key, so repeated or concurrent taps yield a single order.
+    cart_token=context.user_data.setdefault('cart_token',uuid.uuid4().hex)
+    oid=await storage.backend.save_order(uid,uname,cart,total_price_float,username=user.username,idempotency_key=f"{uid}:{cart_token}",slot_id=slot_id)
 
+    if oid==db_operations.SLOT_FULL: # Taken by other checkouts, or too close to its start, since the picker was shown
+        context.user_data.pop('slot_id',None)
+        return await _show_slot_picker(context, uid, cart, message_to_edit_id, notice=await _(context,"delivery_slot_full",user_id=uid,default="That slot has just filled up, please pick another one."))
     if oid:
         success_text = await _(context,"order_placed_success",user_id=uid,order_id=oid,total_price=total_price_float)
+        if slot_id is not None:
+            success_text += "\n"+await _(context,"delivery_slot_booked",user_id=uid,slot=context.user_data.get('slot_label',''),default="Delivery slot: {slot}")
         if message_to_edit_id:
              try: await context.bot.edit_message_text(chat_id=uid, message_id=message_to_edit_id, text=success_text, reply_markup=None)
              except Exception: await context.bot.send_message(chat_id=uid, text=success_text)
         else: await context.bot.send_message(chat_id=uid, text=success_text)
 
-        admin_title=await _(context,"admin_new_order_notification_title",user_id=admin_lang_for_notification,order_id=oid,default=f"🔔 New Order #{oid}")
-        admin_msg_body_parts = [
-            await _(context,"admin_order_from",user_id=admin_lang_for_notification,name=uname,username=(f"@{user.username}" if user.username else "N/A"),customer_id=uid,default=f"From:{uname}..."),
-            "\n",
-            await _(context,"admin_order_items_header",user_id=admin_lang_for_notification,default="Items:"),
-            "------------------------------------"
-        ]
-        item_lines = []
-        for i, c_item in enumerate(cart): # Renamed c to c_item to avoid conflict
-            item_subtotal_float = c_item['price'] * c_item['quantity']
-            item_lines.append(await _(context, "admin_order_item_line_format",
-                                      user_id=admin_lang_for_notification,
-                                      index=i + 1,
-                                      item_name=c_item['name'],
-                                      quantity=c_item['quantity'],  # Pass as float
-                                      price_per_kg=c_item['price'],  # Pass as float
-                                      item_subtotal=item_subtotal_float,  # Pass as float
-                                      default=f"{i+1}. {c_item['name']}: ..."))
-        admin_msg_body_parts.extend(item_lines)
-        admin_msg_body_parts.append("------------------------------------")
-        admin_msg_body_parts.append(await _(context,"admin_order_grand_total",user_id=admin_lang_for_notification,total_price=total_price_float,default=f"Total:{total_price_float:.2f} EUR"))
-        
-        full_admin_msg = f"{admin_title}\n" + "\n".join(admin_msg_body_parts)
-
-
-        if ADMIN_IDS:
-            for admin_id_val in ADMIN_IDS:
-                try:
-                    if len(full_admin_msg) > 4096:
-                        for i_part in range(0, len(full_admin_msg), 4096):
-                            await context.bot.send_message(chat_id=admin_id_val, text=full_admin_msg[i_part:i_part+4096])
-                    else:
-                        await context.bot.send_message(chat_id=admin_id_val,text=full_admin_msg)
-                except Exception as e:logger.error(f"Failed to notify admin {admin_id_val} about new order {oid}: {e}")
+        jobs.kick_outbox_delivery(context.application) # Admin notification was queued with the order; deliver it off the request path
 
         lang_code = context.user_data.get('language_code')
-        keys_to_pop=['cart','current_product_id','current_product_name','current_product_price', 'last_product_list_message_id']
+        keys_to_pop=['cart','cart_token','slot_id','slot_label','slot_choices','current_product_id','current_product_name','current_product_price', 'last_product_list_message_id']
         for k_pop in keys_to_pop: context.user_data.pop(k_pop,None)
         if lang_code: context.user_data['language_code']=lang_code
         
@@ -433,13 +636,98 @@ async def order_flow_checkout_cb(update:Update,context:ContextTypes.DEFAULT_TYPE
         return await display_cart_and_products(update, context, uid, edit_message_id=message_to_edit_id)
     return ConversationHandler.END
 
+# --- DELIVERY SLOTS ---
+SLOT_PICKER_SIZE = 8
+
+async def _show_slot_picker(context:ContextTypes.DEFAULT_TYPE, uid:int, cart:list, message_id:int, notice:str=None)->int:
+    """ Slots with room for this cart, read from the slot counters; picking one continues the checkout. """
+    after_ts=db_operations.slot_booking_cutoff(int(time.time()))
+    slots=await storage.backend.get_available_delivery_slots(after_ts,db_operations.order_weight_kg(cart),SLOT_PICKER_SIZE)
+    context.user_data['slot_choices']={slot_id:format_slot(start_ts,end_ts) for slot_id,start_ts,end_ts in slots}
+    kb=[[InlineKeyboardButton(label,callback_data=f"order_flow_slot_{slot_id}")] for slot_id,label in context.user_data['slot_choices'].items()]
+    kb.append([InlineKeyboardButton(await _(context,"back_to_cart_button",user_id=uid,default="⬅️ Back to cart"),callback_data="order_flow_manage_cart_cb")])
+    txt=await _(context,"delivery_slot_pick" if slots else "delivery_slot_none_available",user_id=uid,
+                default="When would you like to receive your order?" if slots else "There are no free delivery slots for this order right now.")
+    if notice: txt=notice+"\n\n"+txt
+    try: await context.bot.edit_message_text(chat_id=uid,message_id=message_id,text=txt,reply_markup=InlineKeyboardMarkup(kb))
+    except (BadRequest, TypeError):
+        sent_msg=await context.bot.send_message(chat_id=uid,text=txt,reply_markup=InlineKeyboardMarkup(kb))
+        context.user_data['last_product_list_message_id']=sent_msg.message_id
+    return ORDER_FLOW_VIEWING_CART
+
+async def order_flow_slot_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ order_flow_slot_<id>: remembers the slot and checks out; the reservation itself happens with the order insert. """
+    q=update.callback_query
+    slot_id=int(q.data.rsplit('_',1)[-1])
+    slot_choices=context.user_data.get('slot_choices',{})
+    if slot_id not in slot_choices: # A picker from an earlier checkout, or crafted callback data
+        await q.answer()
+        return await _show_slot_picker(context, q.from_user.id, context.user_data.get('cart',[]), q.message.message_id if q.message else None,
+                                       notice=await _(context,"delivery_slot_full",user_id=q.from_user.id))
+    context.user_data['slot_id']=slot_id
+    context.user_data['slot_label']=context.user_data.pop('slot_choices')[slot_id]
+    return await order_flow_checkout_cb(update, context)
+
+async def admin_delivery_slots_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /slots -- booked/capacity of the upcoming delivery slots. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"view"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    slots=await storage.backend.get_delivery_slot_overview(int(time.time()),50)
+    if not slots:
+        await update.message.reply_text(await _(context,"admin_delivery_slots_empty",user_id=uid,default="No delivery slots are open."));return
+    lines=[await _(context,"admin_delivery_slots_title",user_id=uid,default="Delivery slots:")]
+    for _slot_id,start_ts,end_ts,booked_orders,capacity_orders,booked_kg,capacity_kg in slots:
+        lines.append(await _(context,"admin_delivery_slot_line",user_id=uid,slot=format_slot(start_ts,end_ts),orders=booked_orders,max_orders=capacity_orders,
+                             kg=booked_kg,max_kg=capacity_kg,default=f"{format_slot(start_ts,end_ts)}: {booked_orders}/{capacity_orders}"))
+    await update.message.reply_text("\n".join(lines))
+
+# --- STANDING ORDERS ---
+async def order_flow_standing_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ Weekday picker for saving the cart as a weekly standing order. """
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not context.user_data.get('cart'): return await order_flow_display_cart_detailed(update, context, uid, edit_message_id=q.message.message_id)
+    days=[InlineKeyboardButton(await _(context,f"weekday_{day}",user_id=uid,default=str(day)),callback_data=f"order_flow_standing_day_{day}") for day in range(7)]
+    kb=[days[:4],days[4:],[InlineKeyboardButton(await _(context,"back_to_cart_button",user_id=uid,default="⬅️ Back to cart"),callback_data="order_flow_manage_cart_cb")]]
+    await q.edit_message_text(await _(context,"standing_order_pick_day",user_id=uid,hour=STANDING_ORDER_HOUR,default="Which day should this cart be ordered every week?"),reply_markup=InlineKeyboardMarkup(kb))
+    return ORDER_FLOW_VIEWING_CART
+
+async def order_flow_standing_day_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ order_flow_standing_day_<0-6>: saves the cart as a standing order; the cart itself stays for a normal checkout. """
+    q=update.callback_query;user=q.from_user;uid=user.id
+    weekday=int(q.data.rsplit('_',1)[-1]);cart=context.user_data.get('cart',[])
+    standing_id=await storage.backend.create_standing_order(uid,user.full_name or "N/A",user.username,cart,weekday) if cart else None
+    if standing_id:
+        await q.answer(await _(context,"standing_order_saved",user_id=uid,day=await _(context,f"weekday_{weekday}",user_id=uid,default=str(weekday)),
+                               next_run=format_timestamp(db_operations.next_weekly_run(weekday,int(time.time()))),default="Weekly order saved."),show_alert=True)
+    else: await q.answer(await _(context,"generic_error_message",user_id=uid,default="Error."),show_alert=True)
+    return await order_flow_display_cart_detailed(update, context, uid, edit_message_id=q.message.message_id)
+
+async def standing_order_stop_cb(update:Update,context:ContextTypes.DEFAULT_TYPE):
+    """ standing_order_stop_<id> on the My Orders screen. """
+    q=update.callback_query;uid=q.from_user.id
+    stopped=await storage.backend.delete_standing_order(int(q.data.rsplit('_',1)[-1]),uid)
+    await q.answer(await _(context,"standing_order_stopped" if stopped else "standing_order_not_found",user_id=uid,default="Stopped." if stopped else "Not found."))
+    await _show_my_orders(q, context, uid)
+
 async def my_orders_direct_cb(update:Update,context:ContextTypes.DEFAULT_TYPE):
-    q=update.callback_query;await q.answer();uid=q.from_user.id;orders=db_operations.get_user_orders_from_db(uid)
+    q=update.callback_query;await q.answer()
+    await _show_my_orders(q, context, q.from_user.id)
+
+async def _show_my_orders(q, context:ContextTypes.DEFAULT_TYPE, uid:int):
+    orders=await storage.backend.get_user_orders(uid)
     txt=await _(context,"my_orders_title",user_id=uid,default="Orders:")+"\n\n" if orders else await _(context,"no_orders_yet",user_id=uid)
     if orders:
-        for oid,date_str,total_val_float,status_str,items_str in orders:
-            txt+=await _(context,"order_details_format",user_id=uid,order_id=oid,date=date_str,status=status_str.capitalize(),total=total_val_float,items=items_str.replace(chr(10), ", ") if items_str else "N/A",default="Order...")
-    kb=[[InlineKeyboardButton(await _(context,"back_to_main_menu_button",user_id=uid),callback_data="main_menu_direct_cb_ender")]]
+        for oid,order_ts,total_val_float,status_str,items_str in orders:
+            txt+=await _(context,"order_details_format",user_id=uid,order_id=oid,date=format_timestamp(order_ts),status=status_str.capitalize(),total=total_val_float,items=items_str.replace(chr(10), ", ") if items_str else "N/A",default="Order...")
+    kb=[[InlineKeyboardButton(await _(context,"reorder_button",user_id=uid,order_id=oid,default=f"🔁 #{oid}"),callback_data=f"order_flow_reorder_{oid}")] for oid,*_rest in orders[:REORDER_BUTTONS_MAX]]
+    standing_orders=await storage.backend.get_user_standing_orders(uid)
+    if standing_orders:
+        txt+="\n"+await _(context,"standing_orders_title",user_id=uid,default="Weekly orders:")+"\n"
+        for standing_id,weekday,next_run_ts,items_summary in standing_orders:
+            day_name=await _(context,f"weekday_{weekday}",user_id=uid,default=str(weekday))
+            txt+=await _(context,"standing_order_line",user_id=uid,day=day_name,next_run=format_timestamp(next_run_ts),items=(items_summary or "").replace(chr(10), ", "),default=f"{day_name}: {items_summary}\n")
+            kb.append([InlineKeyboardButton(await _(context,"standing_order_stop_button",user_id=uid,day=day_name,default=f"✖ {day_name}"),callback_data=f"standing_order_stop_{standing_id}")])
+    kb.append([InlineKeyboardButton(await _(context,"back_to_main_menu_button",user_id=uid),callback_data="main_menu_direct_cb_ender")])
     context.user_data.pop('last_product_list_message_id', None)
     await q.edit_message_text(text=txt,reply_markup=InlineKeyboardMarkup(kb))
 
@@ -448,7 +736,7 @@ async def display_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = update.effective_user;
     if not user: logger.error("display_admin_panel: effective_user is None"); return ConversationHandler.END # Should not happen
     user_id = user.id
-    if not (ADMIN_IDS and user_id in ADMIN_IDS):
+    if not roles.is_staff(user_id):
         unauth_text = await _(context,"admin_unauthorized",user_id=user_id)
         target_msg_obj = update.callback_query.message if edit_message and update.callback_query else update.message
         if edit_message and target_msg_obj: await target_msg_obj.edit_text(unauth_text)
@@ -457,14 +745,18 @@ async def display_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
     context.chat_data['user_id_for_translation'] = user_id
-    kb = [
-        [InlineKeyboardButton(await _(context,"admin_add_product_button",user_id=user_id),callback_data="admin_add_prod_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_manage_products_button",user_id=user_id),callback_data="admin_manage_prod_list_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_view_orders_button",user_id=user_id),callback_data="admin_view_orders_direct_cb")],
-        [InlineKeyboardButton(await _(context,"admin_shopping_list_button",user_id=user_id),callback_data="admin_shop_list_direct_cb")],
-        [InlineKeyboardButton(await _(context,"admin_clear_orders_button", user_id=user_id, default="🧹 Clear Completed Orders"), callback_data="admin_clear_orders_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_exit_button",user_id=user_id),callback_data="main_menu_direct_cb_ender")]
-    ]
+    kb = [] # Only what the user's role allows; every handler behind these buttons checks again
+    if roles.can(user_id,"catalog"): kb.append([InlineKeyboardButton(await _(context,"admin_add_product_button",user_id=user_id),callback_data="admin_add_prod_entry_cb")])
+    if roles.can(user_id,"catalog"): kb.append([InlineKeyboardButton(await _(context,"admin_manage_products_button",user_id=user_id),callback_data="admin_manage_prod_list_entry_cb")])
+    if roles.can(user_id,"catalog"): kb.append([InlineKeyboardButton(await _(context,"admin_import_products_button",user_id=user_id,default="📥 Import Products (CSV)"),callback_data="admin_import_products_entry_cb")])
+    if roles.can(user_id,"view"): kb.append([InlineKeyboardButton(await _(context,"admin_view_orders_button",user_id=user_id),callback_data="admin_view_orders_direct_cb")])
+    if roles.can(user_id,"orders"): kb.append([InlineKeyboardButton(await _(context,"admin_manage_orders_button",user_id=user_id,default="🗂️ Manage Orders"),callback_data="admin_manage_orders_cb")])
+    if roles.can(user_id,"view"): kb.append([InlineKeyboardButton(await _(context,"admin_shopping_list_button",user_id=user_id),callback_data="admin_shop_list_direct_cb")])
+    if roles.can(user_id,"view"): kb.append([InlineKeyboardButton(await _(context,"admin_stats_button",user_id=user_id,default="📈 Stats"),callback_data="admin_stats_direct_cb")])
+    if roles.can(user_id,"view"): kb.append([InlineKeyboardButton(await _(context,"admin_export_orders_button",user_id=user_id,default="📤 Export Orders (CSV)"),callback_data="admin_export_orders_cb")])
+    if roles.can(user_id,"broadcast"): kb.append([InlineKeyboardButton(await _(context,"admin_broadcast_button",user_id=user_id,default="📣 Broadcast"),callback_data="admin_broadcast_entry_cb")])
+    if roles.can(user_id,"admin"): kb.append([InlineKeyboardButton(await _(context,"admin_clear_orders_button", user_id=user_id, default="🧹 Clear Completed Orders"), callback_data="admin_clear_orders_entry_cb")])
+    kb.append([InlineKeyboardButton(await _(context,"admin_exit_button",user_id=user_id),callback_data="main_menu_direct_cb_ender")])
     title = await _(context,"admin_panel_title",user_id=user_id)
     target_msg_obj = update.callback_query.message if edit_message and update.callback_query else update.message
     reply_markup = InlineKeyboardMarkup(kb)
@@ -474,10 +766,10 @@ async def display_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
         elif update.message : await update.message.reply_text(title,reply_markup=reply_markup)
         elif user_id: await context.bot.send_message(chat_id=user_id, text=title,reply_markup=reply_markup)
     except Exception as e:
-        logger.warning(f"Display admin panel error (edit={edit_message}): {e}")
+        logger.warning("Display admin panel error (edit=%s): %s", edit_message, e)
         if user_id and not (edit_message and target_msg_obj) and not update.message :
             try: await context.bot.send_message(chat_id=user_id, text=title,reply_markup=reply_markup)
-            except Exception as send_e: logger.error(f"Fallback display_admin_panel send error: {send_e}")
+            except Exception as send_e: logger.error("Fallback display_admin_panel send error: %s", send_e)
     # This state is not strictly necessary if admin panel itself isn't a conversation state.
     # But if sub-conversations return to it, it helps.
     return ADMIN_MAIN_PANEL_STATE
@@ -516,7 +808,9 @@ async def admin_panel_return_direct_cb(update: Update, context: ContextTypes.DEF
     return ConversationHandler.END
 
 async def admin_add_prod_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    q=update.callback_query;await q.answer();uid=q.from_user.id;await q.edit_message_text(await _(context,"admin_enter_product_name",user_id=uid));return ADMIN_ADD_PROD_NAME
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"catalog"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    await q.edit_message_text(await _(context,"admin_enter_product_name",user_id=uid));return ADMIN_ADD_PROD_NAME
 async def admin_add_prod_name_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     uid=update.effective_user.id;pname=update.message.text;context.user_data['new_pname']=pname;await update.message.reply_text(await _(context,"admin_enter_product_price",user_id=uid,product_name=pname));return ADMIN_ADD_PROD_PRICE
 async def admin_add_prod_price_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
@@ -531,70 +825,177 @@ async def admin_add_prod_price_state(update:Update,context:ContextTypes.DEFAULT_
         return ConversationHandler.END
 
     format_kwargs={'user_id':user_id,'product_name':name}
-    msg_key="admin_product_added" if db_operations.add_product_to_db(name,price) else "admin_product_add_failed"
+    new_pid=await storage.backend.add_product(name,price)
+    msg_key="admin_product_added" if new_pid else "admin_product_add_failed"
     if msg_key=="admin_product_added": format_kwargs['price']=price # Pass float
     await update.message.reply_text(await _(context,msg_key,**format_kwargs))
+    if new_pid: # Optional last step: the product photo
+        context.user_data['new_pid']=new_pid
+        kb=[[InlineKeyboardButton(await _(context,"admin_skip_photo_button",user_id=user_id,default="⏭️ Skip"),callback_data="admin_add_prod_skip_photo_cb")]]
+        await update.message.reply_text(await _(context,"admin_add_product_photo_prompt",user_id=user_id,product_name=name,default=f"Send a photo of {name}, or skip."),reply_markup=InlineKeyboardMarkup(kb))
+        return ADMIN_ADD_PROD_PHOTO
     context.user_data.pop('new_pname', None)
     await display_admin_panel(update, context, edit_message=False) # Send new admin panel
     return ConversationHandler.END
 
+async def admin_add_prod_photo_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    pid=context.user_data.pop('new_pid',None);name=context.user_data.pop('new_pname','')
+    saved=bool(pid) and await product_photos.store_product_photo(pid, update.message.photo)
+    msg_key="admin_photo_saved" if saved else "admin_photo_save_failed"
+    await update.message.reply_text(await _(context,msg_key,user_id=uid,product_name=name,default=msg_key))
+    await display_admin_panel(update, context, edit_message=False)
+    return ConversationHandler.END
+
+async def admin_add_prod_skip_photo_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer()
+    context.user_data.pop('new_pid',None);context.user_data.pop('new_pname',None)
+    await display_admin_panel(update, context, edit_message=True)
+    return ConversationHandler.END
+
 async def admin_manage_prod_list_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"catalog"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
     context.user_data.pop('editing_pid',None)
     context.user_data.pop('admin_product_options_message_to_edit', None)
-
-    prods=db_operations.get_products_from_db(False);kb,txt=[],""
-    if not prods:
+    if q.data=="admin_manage_prod_list_entry_cb": # Fresh entry from the admin panel starts at the first page
+        context.user_data.pop('admin_catalog_page',None);context.user_data.pop('admin_catalog_category',None)
+
+    status_texts={avail:await _(context,"admin_status_available" if avail else "admin_status_unavailable",user_id=uid,default="Available" if avail else "Unavailable") for avail in (0,1)}
+    kb,page,total_pages,category_id,products_on_page=await _paged_catalog_rows(
+        context, uid, context.user_data.get('admin_catalog_page',0), context.user_data.get('admin_catalog_category',0), False,
+        "admin_manage", "admin_manage_select_prod_", lambda product: f"{product[1]} - {product[2]:.2f} EUR ({status_texts[1 if product[3] else 0]})")
+    context.user_data['admin_catalog_page'],context.user_data['admin_catalog_category']=page,category_id
+    if not products_on_page:
         txt=await _(context,"admin_no_products_to_manage",user_id=uid)
-        kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
     else:
         txt=await _(context,"admin_select_product_to_manage",user_id=uid)
-        for pid,name,price_float,avail in prods: # price_float
-            stat_key="admin_status_available" if avail else "admin_status_unavailable"
-            stat=await _(context,stat_key,user_id=uid,default="Available" if avail else "Unavailable")
-            kb.append([InlineKeyboardButton(f"{name} - {price_float:.2f} EUR ({stat})",callback_data=f"admin_manage_select_prod_{pid}")])
-        kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
+        if total_pages>1: txt+="\n"+await _(context,"catalog_page_indicator",user_id=uid,page=page+1,total_pages=total_pages,default=f"{page+1}/{total_pages}")
+    kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
     await q.edit_message_text(text=txt,reply_markup=InlineKeyboardMarkup(kb));return ADMIN_MANAGE_PROD_LIST
 
-async def admin_manage_prod_selected_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    q = update.callback_query
-    await q.answer()
-    uid=q.from_user.id
-    try:pid=int(q.data.split('_')[-1])
-    except (IndexError, ValueError):
-        await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error parsing product ID."))
-        return ADMIN_MANAGE_PROD_LIST # Go back to list
-    prod=db_operations.get_product_by_id(pid)
+async def admin_manage_catalog_nav_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    """ Category tab (admin_manage_cat_<id>) or page control (admin_manage_page_<n>) in the admin product list. """
+    _prefix,kind,value=update.callback_query.data.rsplit('_',2)
+    if kind=='cat': context.user_data.update({'admin_catalog_category':int(value),'admin_catalog_page':0})
+    else: context.user_data['admin_catalog_page']=int(value)
+    return await admin_manage_prod_list_entry_cb(update, context)
+
+async def _show_admin_product_options(context:ContextTypes.DEFAULT_TYPE, uid:int, chat_id:int, message_id:int, pid:int)->int:
+    """ Renders the options menu for one product into an existing message. """
+    prod=await storage.backend.get_product(pid)
     if not prod:
-        await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
+        await context.bot.edit_message_text(chat_id=chat_id,message_id=message_id,text=await _(context,"product_not_found",user_id=uid,default="Product not found."))
         return ADMIN_MANAGE_PROD_LIST
 
     context.user_data['editing_pid']=pid
-    pname,pprice_float,pavail=prod[1],prod[2],prod[3] # pprice_float
+    pname,pprice_float,pavail,pcategory_id=prod[1],prod[2],prod[3],prod[4] # pprice_float
     avail_key="admin_set_unavailable_button" if pavail else "admin_set_available_button"
+    category_name=next((cname for cid,cname in await storage.backend.get_categories() if cid==pcategory_id),None) if pcategory_id else None
+    if category_name is None: category_name=await _(context,"admin_no_category",user_id=uid,default="none")
+    has_photo=pid in await storage.backend.get_product_photo_ids()
+    photo_row=[InlineKeyboardButton(await _(context,"admin_change_photo_button" if has_photo else "admin_add_photo_button",user_id=uid,default="🖼️ Photo"),callback_data="admin_manage_photo_entry_cb")]
+    if has_photo: photo_row.append(InlineKeyboardButton(await _(context,"admin_remove_photo_button",user_id=uid,default="🗑️ Remove photo"),callback_data="admin_manage_remove_photo_cb"))
     kb=[
         [InlineKeyboardButton(await _(context,"admin_change_price_button",user_id=uid,price=pprice_float),callback_data="admin_manage_edit_price_entry_cb")], # Pass float for display in button
         [InlineKeyboardButton(await _(context,avail_key,user_id=uid),callback_data=f"admin_manage_toggle_avail_cb_{1-pavail}")],
+        [InlineKeyboardButton(await _(context,"admin_change_category_button",user_id=uid,category=category_name,default=f"🏷️ {category_name}"),callback_data="admin_manage_category_entry_cb")],
+        photo_row,
         [InlineKeyboardButton(await _(context,"admin_delete_product_button",user_id=uid),callback_data="admin_manage_delete_confirm_cb")],
         [InlineKeyboardButton(await _(context,"admin_back_to_product_list_button",user_id=uid),callback_data="admin_manage_prod_list_refresh_cb")]
     ]
-    await q.message.edit_text(await _(context,"admin_managing_product",user_id=uid,product_name=pname),reply_markup=InlineKeyboardMarkup(kb))
+    await context.bot.edit_message_text(chat_id=chat_id,message_id=message_id,text=await _(context,"admin_managing_product",user_id=uid,product_name=pname),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_MANAGE_PROD_OPTIONS
+
+async def admin_manage_prod_selected_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q = update.callback_query
+    await q.answer()
+    uid=q.from_user.id
+    try:pid=int(q.data.split('_')[-1])
+    except (IndexError, ValueError):
+        await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error parsing product ID."))
+        return ADMIN_MANAGE_PROD_LIST # Go back to list
+    return await _show_admin_product_options(context, uid, q.message.chat_id, q.message.message_id, pid)
+
+async def admin_manage_category_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
+    if not edit_pid:
+        await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected."))
+        return await admin_manage_prod_list_entry_cb(update, context)
+    kb=[[InlineKeyboardButton(cname,callback_data=f"admin_manage_set_cat_{cid}")] for cid,cname in await storage.backend.get_categories()]
+    kb.append([InlineKeyboardButton(await _(context,"admin_remove_category_button",user_id=uid,default="🚫 No category"),callback_data="admin_manage_set_cat_0")])
+    kb.append([InlineKeyboardButton(await _(context,"admin_new_category_button",user_id=uid,default="➕ New category"),callback_data="admin_manage_new_cat_cb")])
+    kb.append([InlineKeyboardButton(await _(context,"back_button",user_id=uid,default="⬅️ Back"),callback_data=f"admin_manage_select_prod_{edit_pid}")])
+    await q.message.edit_text(await _(context,"admin_select_category_prompt",user_id=uid,default="Choose a category:"),reply_markup=InlineKeyboardMarkup(kb))
     return ADMIN_MANAGE_PROD_OPTIONS
 
+async def admin_manage_set_category_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
+    if not edit_pid:
+        await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected."))
+        return await admin_manage_prod_list_entry_cb(update, context)
+    await storage.backend.update_product(edit_pid,category_id=int(q.data.split('_')[-1]))
+    return await _show_admin_product_options(context, uid, q.message.chat_id, q.message.message_id, edit_pid)
+
+async def admin_manage_new_category_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    context.user_data['admin_category_prompt_message']=(q.message.chat_id,q.message.message_id)
+    await q.message.edit_text(await _(context,"admin_enter_category_name",user_id=uid,default="Enter the new category name:"))
+    return ADMIN_MANAGE_PROD_NEW_CATEGORY
+
+async def admin_manage_new_category_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;edit_pid=context.user_data.get('editing_pid')
+    prompt_message=context.user_data.pop('admin_category_prompt_message',None)
+    category_name=update.message.text.strip()
+    if not edit_pid or not prompt_message or not category_name:
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid,default="Error: Product ID missing. Session may have expired."))
+        return await display_admin_panel(update, context, edit_message=False)
+    category_id=await storage.backend.add_category(category_name)
+    if category_id: await storage.backend.update_product(edit_pid,category_id=category_id)
+    else: await update.message.reply_text(await _(context,"generic_error_message",user_id=uid))
+    return await _show_admin_product_options(context, uid, prompt_message[0], prompt_message[1], edit_pid)
+
+async def admin_manage_photo_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
+    prod=await storage.backend.get_product(edit_pid) if edit_pid else None
+    if not prod:
+        await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
+        return await admin_manage_prod_list_entry_cb(update, context)
+    context.user_data['admin_product_options_message_to_edit']=(q.message.chat_id,q.message.message_id)
+    kb=[[InlineKeyboardButton(await _(context,"back_button",user_id=uid,default="⬅️ Back"),callback_data=f"admin_manage_select_prod_{edit_pid}")]]
+    await q.message.edit_text(await _(context,"admin_send_product_photo_prompt",user_id=uid,product_name=prod[1],default=f"Send a photo of {prod[1]}."),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_MANAGE_PROD_PHOTO
+
+async def admin_manage_photo_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;edit_pid=context.user_data.get('editing_pid')
+    options_message=context.user_data.pop('admin_product_options_message_to_edit',None)
+    if not edit_pid or not options_message:
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid,default="Error: Product ID missing. Session may have expired."))
+        return await display_admin_panel(update, context, edit_message=False)
+    saved=await product_photos.store_product_photo(edit_pid, update.message.photo)
+    if not saved: await update.message.reply_text(await _(context,"admin_photo_save_failed",user_id=uid,default="Could not save the photo."))
+    return await _show_admin_product_options(context, uid, options_message[0], options_message[1], edit_pid)
+
+async def admin_manage_remove_photo_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
+    if not edit_pid:
+        await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected."))
+        return await admin_manage_prod_list_entry_cb(update, context)
+    await product_photos.remove_product_photo(edit_pid)
+    return await _show_admin_product_options(context, uid, q.message.chat_id, q.message.message_id, edit_pid)
+
 async def admin_manage_edit_price_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected for price edit."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
 
-    prod=db_operations.get_product_by_id(edit_pid)
+    prod=await storage.backend.get_product(edit_pid)
     if not prod:
         await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found for price edit."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
 
-    context.user_data['admin_product_options_message_to_edit'] = q.message
+    context.user_data['admin_product_options_message_to_edit'] = (q.message.chat_id, q.message.message_id) # Not the Message itself, it pins the whole update in memory
     await q.message.edit_text(await _(context,"admin_enter_new_price",user_id=uid,product_name=prod[1],current_price=prod[2])) # Pass float
     return ADMIN_MANAGE_PROD_EDIT_PRICE
 
@@ -602,7 +1003,7 @@ async def admin_manage_edit_price_state(update: Update, context: ContextTypes.DE
     user_id = update.effective_user.id
     new_price_str = update.message.text
     editing_pid = context.user_data.get('editing_pid')
-    original_options_message: Message | None = context.user_data.pop('admin_product_options_message_to_edit', None)
+    original_options_message: tuple[int, int] | None = context.user_data.pop('admin_product_options_message_to_edit', None) # (chat_id, message_id)
 
     if not editing_pid:
         await update.message.reply_text(await _(context, "generic_error_message", user_id=user_id, default="Error: Product ID missing. Session may have expired."))
@@ -617,7 +1018,7 @@ async def admin_manage_edit_price_state(update: Update, context: ContextTypes.DE
              context.user_data['admin_product_options_message_to_edit'] = original_options_message
         return ADMIN_MANAGE_PROD_EDIT_PRICE
 
-    success = db_operations.update_product_in_db(editing_pid, price=new_price_float)
+    success = await storage.backend.update_product(editing_pid, price=new_price_float)
     msg_key = "admin_price_updated" if success else "admin_price_update_failed"
     await update.message.reply_text(await _(context, msg_key, user_id=user_id, product_id=editing_pid))
 
@@ -626,48 +1027,29 @@ async def admin_manage_edit_price_state(update: Update, context: ContextTypes.DE
         await update.message.reply_text(await _(context, "admin_error_refreshing_menu", user_id=user_id))
         return await display_admin_panel(update, context, edit_message=False)
 
-    class MockCallbackQueryForProductOptions:
-        def __init__(self, effective_user_obj, message_to_act_on: Message, product_id_for_data: int):
-            self.from_user = effective_user_obj
-            self.message = message_to_act_on
-            self.data = f"admin_manage_select_prod_{product_id_for_data}"
-            self.id = "mock_callback_query_id"
-        async def answer(self): pass
-
-    mock_cb_query = MockCallbackQueryForProductOptions(
-        update.effective_user, original_options_message, editing_pid
-    )
-    mock_update_obj = Update(update_id=update.update_id, callback_query=mock_cb_query)
-    if not hasattr(mock_update_obj, 'effective_user') or not mock_update_obj.effective_user:
-        mock_update_obj.effective_user = update.effective_user
-    return await admin_manage_prod_selected_cb(mock_update_obj, context)
+    return await _show_admin_product_options(context, user_id, original_options_message[0], original_options_message[1], editing_pid)
 
 async def admin_manage_toggle_avail_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
     try:new_avail=int(q.data.split('_')[-1])
     except (IndexError, ValueError):
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error parsing availability."))
-        q.data=f"admin_manage_select_prod_{edit_pid}"
-        return await admin_manage_prod_selected_cb(update,context)
+        return await _show_admin_product_options(context, uid, q.message.chat_id, q.message.message_id, edit_pid)
 
-    db_operations.update_product_in_db(edit_pid,is_available=new_avail)
-    q.data=f"admin_manage_select_prod_{edit_pid}"
-    return await admin_manage_prod_selected_cb(update,context)
+    await storage.backend.update_product(edit_pid,is_available=new_avail)
+    return await _show_admin_product_options(context, uid, q.message.chat_id, q.message.message_id, edit_pid)
 
 async def admin_manage_delete_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: No product selected."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
-    prod=db_operations.get_product_by_id(edit_pid)
+    prod=await storage.backend.get_product(edit_pid)
     if not prod:
         await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
     kb=[[InlineKeyboardButton(await _(context,"admin_confirm_delete_yes_button",user_id=uid,product_name=prod[1]),callback_data="admin_manage_delete_do_cb")],[InlineKeyboardButton(await _(context,"admin_confirm_delete_no_button",user_id=uid),callback_data=f"admin_manage_select_prod_{edit_pid}")]]
     await q.message.edit_text(await _(context,"admin_confirm_delete_prompt",user_id=uid,product_name=prod[1]),reply_markup=InlineKeyboardMarkup(kb));return ADMIN_MANAGE_PROD_DELETE_CONFIRM
@@ -676,25 +1058,99 @@ async def admin_manage_delete_do_cb(update:Update,context:ContextTypes.DEFAULT_T
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error: Product ID missing."))
-        q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
-    deleted = db_operations.delete_product_from_db(edit_pid)
+    deleted = await storage.backend.delete_product(edit_pid)
+    if deleted: await product_photos.remove_product_photo(edit_pid)
     msg_key="admin_product_deleted" if deleted else "admin_product_delete_failed"
     await q.message.edit_text(await _(context,msg_key,user_id=uid,product_id=edit_pid))
     context.user_data.pop('editing_pid',None)
-    q.data = "admin_manage_prod_list_entry_cb"
     return await admin_manage_prod_list_entry_cb(update,context)
 
+async def admin_import_products_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"catalog"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    await q.edit_message_text(await _(context,"admin_import_products_prompt",user_id=uid,default="Send a CSV file with columns name,price[,available]."),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_IMPORT_PRODUCTS_FILE
+
+async def admin_import_products_file_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    if not roles.can(uid,"catalog"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    doc=update.message.document
+    if doc.file_size and doc.file_size > catalog_import.MAX_IMPORT_FILE_BYTES:
+        await update.message.reply_text(await _(context,"admin_import_file_too_large",user_id=uid,default="File is too large."))
+        return ADMIN_IMPORT_PRODUCTS_FILE
+    try:
+        tg_file = await doc.get_file()
+        data = bytes(await tg_file.download_as_bytearray())
+    except Exception as e:
+        logger.error("Failed to download catalog import file from admin %s: %s", uid, e)
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid))
+        return ADMIN_IMPORT_PRODUCTS_FILE
+
+    # Validation and the single-transaction upsert are blocking work, keep them off the event loop.
+    summary, errors = await catalog_import.import_catalog_csv(data)
+    if errors:
+        shown_errors = "\n".join(errors[:20]) + (f"\n... (+{len(errors) - 20})" if len(errors) > 20 else "")
+        await update.message.reply_text(await _(context,"admin_import_rejected",user_id=uid,errors=shown_errors,default=f"Import rejected:\n{shown_errors}"))
+        return ADMIN_IMPORT_PRODUCTS_FILE
+
+    def _names(names): return ", ".join(names[:30]) + (f" (+{len(names) - 30})" if len(names) > 30 else "") if names else "-"
+    await update.message.reply_text(await _(context,"admin_import_summary",user_id=uid,
+                                            added_count=len(summary['added']),updated_count=len(summary['updated']),unchanged_count=summary['unchanged'],
+                                            added=_names(summary['added']),updated=_names(summary['updated']),default="Import done."))
+    await display_admin_panel(update, context, edit_message=False)
+    return ConversationHandler.END
+
+async def admin_broadcast_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"broadcast"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    await q.edit_message_text(await _(context,"admin_broadcast_prompt",user_id=uid,default="Send the message text to broadcast to all users."),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_BROADCAST_TEXT
+
+async def admin_broadcast_text_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    if not roles.can(uid,"broadcast"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    context.user_data['broadcast_text']=update.message.text
+    recipients=await storage.backend.count_reachable_users()
+    kb=[[InlineKeyboardButton(await _(context,"admin_broadcast_confirm_button",user_id=uid,default="✅ Send"),callback_data="admin_broadcast_confirm_cb")],
+        [InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    await update.message.reply_text(await _(context,"admin_broadcast_confirm_prompt",user_id=uid,count=recipients,text=update.message.text,default=f"Send to {recipients} users?"),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_BROADCAST_CONFIRM
+
+async def admin_broadcast_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"broadcast"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    text=context.user_data.pop('broadcast_text',None)
+    broadcast_id=await asyncio.to_thread(db_operations.create_broadcast,text,uid,await storage.backend.count_reachable_users(),q.message.chat_id,q.message.message_id) if text else None
+    if not broadcast_id:
+        await q.edit_message_text(await _(context,"generic_error_message",user_id=uid))
+        return ConversationHandler.END
+    kb=[[InlineKeyboardButton(await _(context,"admin_broadcast_cancel_button",user_id=uid,default="⛔ Stop"),callback_data=f"admin_broadcast_cancel_{broadcast_id}")]]
+    await q.edit_message_text(await _(context,"admin_broadcast_status_running",user_id=uid,broadcast_id=broadcast_id,default=f"📣 Broadcast #{broadcast_id} is running..."),reply_markup=InlineKeyboardMarkup(kb))
+    jobs.start_broadcast(context.application, broadcast_id)
+    return ConversationHandler.END
+
+async def admin_broadcast_cancel_cb(update:Update,context:ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;uid=q.from_user.id
+    if not roles.can(uid,"broadcast"):await q.answer(await _(context,"admin_unauthorized",user_id=uid),show_alert=True);return
+    broadcast_id=int(q.data.split('_')[-1])
+    cancelled=await asyncio.to_thread(db_operations.set_broadcast_status,broadcast_id,'cancelled',True)
+    await q.answer(await _(context,"admin_broadcast_cancelled_alert" if cancelled else "admin_broadcast_not_running_alert",user_id=uid,broadcast_id=broadcast_id,
+                           default="Stopping..." if cancelled else "Not running."))
+
 async def admin_clear_completed_orders_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"admin"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
     confirm_txt=await _(context,"admin_clear_orders_confirm_prompt",user_id=uid,default="Sure to delete COMPLETED orders?");yes_txt=await _(context,"admin_clear_orders_yes_button",user_id=uid,default="YES, Delete");no_txt=await _(context,"admin_clear_orders_no_button",user_id=uid,default="NO, Cancel")
     kb=[[InlineKeyboardButton(yes_txt,callback_data="admin_clear_orders_do_confirm")],[InlineKeyboardButton(no_txt,callback_data="admin_panel_return_direct_cb")]]
     await q.edit_message_text(text=confirm_txt,reply_markup=InlineKeyboardMarkup(kb));return ADMIN_CLEAR_ORDERS_CONFIRM
 
 async def admin_clear_orders_do_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
-    if not(ADMIN_IDS and uid in ADMIN_IDS):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
-    deleted_count=db_operations.delete_completed_orders_from_db()
+    if not roles.can(uid,"admin"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    deleted_count=await storage.backend.delete_completed_orders()
     if deleted_count>0:msg=await _(context,"admin_orders_cleared_success",user_id=uid,count=deleted_count,default=f"{deleted_count} orders cleared.")
     elif deleted_count==0:msg=await _(context,"admin_orders_cleared_none",user_id=uid,default="No completed orders.")
     else:msg=await _(context,"admin_orders_cleared_error",user_id=uid,default="Error clearing.")
@@ -702,34 +1158,149 @@ async def admin_clear_orders_do_confirm_cb(update:Update,context:ContextTypes.DE
     await display_admin_panel(update,context,True)
     return ConversationHandler.END
 
-async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- Admin: Order Status Management ---
+ORDER_STATUS_ACTIONS = ('confirmed', 'completed', 'cancelled')
+
+async def _build_order_management_view(context: ContextTypes.DEFAULT_TYPE, uid: int) -> tuple[str, InlineKeyboardMarkup]:
+    """ Open orders, one checkbox button per order on the current page, plus the bulk actions for the selection. """
+    state=context.user_data.setdefault('order_mgmt',{'selected':set(),'page':0,'notify':True})
+    orders=await storage.backend.get_orders_by_status()
+    open_ids={order[0] for order in orders}
+    state['selected']&=open_ids # Orders closed elsewhere (or by the last action) drop out of the selection
+    total_pages=max(1,-(-len(orders)//CATALOG_PAGE_SIZE))
+    page=state['page']=min(max(state['page'],0),total_pages-1)
+    page_orders=orders[page*CATALOG_PAGE_SIZE:(page+1)*CATALOG_PAGE_SIZE]
+
+    txt=await _(context,"admin_manage_orders_title",user_id=uid,default="🗂️ Open orders\n")
+    if not orders:
+        txt+=await _(context,"admin_manage_orders_empty",user_id=uid,default="No pending or confirmed orders.")
+    else:
+        txt+=await _(context,"admin_manage_orders_selected",user_id=uid,selected=len(state['selected']),total=len(orders),default=f"Selected: {len(state['selected'])}/{len(orders)}")
+        if total_pages>1: txt+="\n"+await _(context,"catalog_page_indicator",user_id=uid,page=page+1,total_pages=total_pages,default=f"{page+1}/{total_pages}")
+    status_texts={status:await _(context,f"order_status_{status}",user_id=uid,default=status) for status in db_operations.OPEN_ORDER_STATUSES}
+    kb=[[InlineKeyboardButton(f"{'☑' if oid in state['selected'] else '☐'} #{oid} {uname or 'N/A'} · {format_timestamp(order_ts,'%m-%d %H:%M')} · {total_val:.2f} EUR · {status_texts[status_val]}",
+                              callback_data=f"admin_orders_toggle_{oid}")]
+        for oid,_cust_id,uname,order_ts,total_val,status_val in page_orders]
+    if total_pages>1:
+        nav=[]
+        if page>0: nav.append(InlineKeyboardButton("⬅️",callback_data=f"admin_orders_page_{page-1}"))
+        if page<total_pages-1: nav.append(InlineKeyboardButton("➡️",callback_data=f"admin_orders_page_{page+1}"))
+        kb.append(nav)
+    if orders:
+        kb.append([InlineKeyboardButton(await _(context,"admin_orders_select_page_button",user_id=uid,default="☑ Select page"),callback_data="admin_orders_select_page"),
+                   InlineKeyboardButton(await _(context,"admin_orders_clear_selection_button",user_id=uid,default="☐ Clear"),callback_data="admin_orders_clear")])
+        kb.append([InlineKeyboardButton(await _(context,"admin_orders_notify_on_button" if state['notify'] else "admin_orders_notify_off_button",user_id=uid,
+                                                default="🔔 Notify customers: on" if state['notify'] else "🔕 Notify customers: off"),callback_data="admin_orders_notify")])
+        kb.append([InlineKeyboardButton(await _(context,f"admin_orders_set_{status}_button",user_id=uid,default=status),callback_data=f"admin_orders_set_{status}") for status in ORDER_STATUS_ACTIONS])
+    kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
+    return txt, InlineKeyboardMarkup(kb)
+
+async def _show_order_management(q, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    txt,reply_markup=await _build_order_management_view(context, uid)
+    try: await q.edit_message_text(text=txt,reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower(): logger.error("Error admin_manage_orders: %s", e)
+
+async def admin_manage_orders_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ Entry (admin_manage_orders_cb) and the selection controls: admin_orders_toggle_<id>, _page_<n>, _select_page, _clear, _notify. """
     q=update.callback_query;await q.answer();uid=q.from_user.id
-    orders=db_operations.get_all_orders_from_db()
+    if not roles.can(uid,"orders"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return
+    if q.data=="admin_manage_orders_cb": context.user_data.pop('order_mgmt',None) # Fresh entry from the admin panel
+    state=context.user_data.setdefault('order_mgmt',{'selected':set(),'page':0,'notify':True})
+    if q.data.startswith("admin_orders_toggle_"): state['selected']^={int(q.data.rsplit('_',1)[-1])}
+    elif q.data.startswith("admin_orders_page_"): state['page']=int(q.data.rsplit('_',1)[-1])
+    elif q.data=="admin_orders_select_page":
+        orders=await storage.backend.get_orders_by_status()
+        state['selected'].update(order[0] for order in orders[state['page']*CATALOG_PAGE_SIZE:(state['page']+1)*CATALOG_PAGE_SIZE])
+    elif q.data=="admin_orders_clear": state['selected'].clear()
+    elif q.data=="admin_orders_notify": state['notify']=not state['notify']
+    await _show_order_management(q, context, uid)
+
+async def admin_orders_set_status_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ admin_orders_set_<status>: one set-based status change for every selected order. """
+    q=update.callback_query;uid=q.from_user.id
+    if not roles.can(uid,"orders"):await q.answer(await _(context,"admin_unauthorized",user_id=uid),show_alert=True);return
+    status=q.data.rsplit('_',1)[-1]
+    state=context.user_data.setdefault('order_mgmt',{'selected':set(),'page':0,'notify':True})
+    if not state['selected']:
+        await q.answer(await _(context,"admin_orders_nothing_selected",user_id=uid,default="Select at least one order."),show_alert=True);return
+    changed_ids=await storage.backend.set_orders_status(sorted(state['selected']),status,state['notify'])
+    if changed_ids is None:
+        await q.answer(await _(context,"generic_error_message",user_id=uid,default="Error."),show_alert=True);return
+    await q.answer(await _(context,"admin_orders_status_result",user_id=uid,changed=len(changed_ids),skipped=len(state['selected'])-len(changed_ids),
+                           status=await _(context,f"order_status_{status}",user_id=uid,default=status),default=f"{len(changed_ids)} orders: {status}"),show_alert=True)
+    if changed_ids and state['notify']: jobs.kick_outbox_delivery(context.application)
+    state['selected'].difference_update(changed_ids)
+    await _show_order_management(q, context, uid)
+
+def _admin_orders_preset_days(preset: str):
+    """ Maps a filter preset to an inclusive (first_day, last_day) pair in the bot timezone; None means no filter. """
+    today = local_today()
+    if preset == "today": return today, today
+    if preset == "yesterday": return today - timedelta(days=1), today - timedelta(days=1)
+    if preset == "week": return today - timedelta(days=6), today
+    return None
+
+async def _build_admin_orders_view(context: ContextTypes.DEFAULT_TYPE, uid: int, day_range=None) -> tuple[str, InlineKeyboardMarkup]:
+    start_ts, end_ts = local_day_range_to_epoch(*day_range) if day_range else (None, None)
+    orders=await storage.backend.get_all_orders(start_ts, end_ts)
     text_parts = [await _(context,"admin_all_orders_title",user_id=uid, default="📦 All Customer Orders:\n\n")]
+    if day_range:
+        text_parts.append(await _(context,"admin_orders_range_label",user_id=uid,start=day_range[0].isoformat(),end=day_range[1].isoformat(),default=f"{day_range[0]} – {day_range[1]}\n\n"))
     if not orders:
         text_parts.append(await _(context,"admin_no_orders_found",user_id=uid))
     else:
-        for oid, cust_id_db, uname, date_val, total_val_float, status_val, items_val in orders:
+        for oid, cust_id_db, uname, order_ts, total_val_float, status_val, items_val in orders:
             items_display = items_val.replace(chr(10), "\n  ") if items_val else "N/A"
-            order_entry = await _(context,"admin_order_details_format",user_id=uid,order_id=oid,user_name=uname or "N/A",customer_id=cust_id_db,date=date_val,total=total_val_float,status=status_val.capitalize(),items=items_display, default="Order...")
+            order_entry = await _(context,"admin_order_details_format",user_id=uid,order_id=oid,user_name=uname or "N/A",customer_id=cust_id_db,date=format_timestamp(order_ts),total=total_val_float,status=status_val.capitalize(),items=items_display, default="Order...")
             text_parts.append(order_entry)
     full_text = "".join(text_parts)
-    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
-    reply_markup = InlineKeyboardMarkup(kb)
+    if len(full_text) > 4096: full_text = full_text[:4000]+"...\n(Truncated)"
+    kb=[
+        [InlineKeyboardButton(await _(context,"admin_orders_filter_today",user_id=uid,default="Today"),callback_data="admin_view_orders_range_today"),
+         InlineKeyboardButton(await _(context,"admin_orders_filter_yesterday",user_id=uid,default="Yesterday"),callback_data="admin_view_orders_range_yesterday"),
+         InlineKeyboardButton(await _(context,"admin_orders_filter_week",user_id=uid,default="Last 7 days"),callback_data="admin_view_orders_range_week")],
+        [InlineKeyboardButton(await _(context,"admin_orders_filter_all",user_id=uid,default="All"),callback_data="admin_view_orders_range_all"),
+         InlineKeyboardButton(await _(context,"admin_orders_filter_custom",user_id=uid,default="Custom dates"),callback_data="admin_view_orders_custom_cb")],
+        [InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]
+    ]
+    return full_text, InlineKeyboardMarkup(kb)
+
+async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"view"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return
+    preset = q.data.rsplit('_', 1)[-1] if q.data.startswith("admin_view_orders_range_") else "all"
+    full_text, reply_markup = await _build_admin_orders_view(context, uid, _admin_orders_preset_days(preset))
     try:
-        if len(full_text) > 4096: await q.edit_message_text(text=full_text[:4000]+"...\n(Truncated)", reply_markup=reply_markup)
-        else: await q.edit_message_text(text=full_text,reply_markup=reply_markup)
+        await q.edit_message_text(text=full_text,reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error admin_view_orders: {e}")
+        logger.error("Error admin_view_orders: %s", e)
         error_msg = await _(context, "generic_error_message", user_id=uid, default="Error displaying orders.")
         try: await q.edit_message_text(text=error_msg, reply_markup=reply_markup)
         except:
             if q.message: await q.message.reply_text(error_msg)
             elif uid: await context.bot.send_message(chat_id=uid, text=error_msg)
 
+async def admin_view_orders_custom_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"view"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return ConversationHandler.END
+    await q.edit_message_text(await _(context,"admin_orders_custom_range_prompt",user_id=uid,default="Enter a date (YYYY-MM-DD) or a range (YYYY-MM-DD YYYY-MM-DD):"))
+    return ADMIN_ORDERS_CUSTOM_RANGE
+
+async def admin_view_orders_custom_range_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    day_range = parse_date_range(update.message.text)
+    if not day_range:
+        await update.message.reply_text(await _(context,"admin_orders_invalid_range",user_id=uid,default="Invalid date. Use YYYY-MM-DD or YYYY-MM-DD YYYY-MM-DD."))
+        return ADMIN_ORDERS_CUSTOM_RANGE
+    full_text, reply_markup = await _build_admin_orders_view(context, uid, day_range)
+    await update.message.reply_text(text=full_text, reply_markup=reply_markup)
+    return ConversationHandler.END
+
 async def admin_shop_list_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q=update.callback_query;await q.answer();uid=q.from_user.id
-    slist=db_operations.get_shopping_list_from_db() # Returns list of (name, qty_float)
+    if not roles.can(uid,"view"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return
+    slist=await storage.backend.get_shopping_list() # Returns list of (name, qty_float)
     text_parts = [await _(context,"admin_shopping_list_title",user_id=uid, default="Shopping List:")+"\n\n"]
     if not slist:
         text_parts.append(await _(context,"admin_shopping_list_empty",user_id=uid))
@@ -741,13 +1312,183 @@ async def admin_shop_list_direct_cb(update: Update, context: ContextTypes.DEFAUL
     reply_markup = InlineKeyboardMarkup(kb)
     try: await q.edit_message_text(text=full_text,reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error admin_shop_list: {e}")
+        logger.error("Error admin_shop_list: %s", e)
         error_msg = await _(context, "generic_error_message", user_id=uid, default="Error displaying shopping list.")
         try: await q.edit_message_text(text=error_msg, reply_markup=reply_markup)
         except:
             if q.message: await q.message.reply_text(error_msg)
             elif uid: await context.bot.send_message(chat_id=uid, text=error_msg)
 
+async def admin_stats_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"view"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return
+    today = local_today()
+    stats = await storage.backend.get_sales_stats(today.isoformat(), (today - timedelta(days=6)).isoformat(), (today - timedelta(days=29)).isoformat())
+    text_parts = [await _(context,"admin_stats_title",user_id=uid,default="📈 Sales statistics\n\n")]
+    if not stats or not stats['month'][0]:
+        text_parts.append(await _(context,"admin_stats_empty",user_id=uid,default="No sales recorded yet."))
+    else:
+        for period_key in ("today", "week", "month"):
+            orders_count, revenue, completed_count = stats[period_key]
+            text_parts.append(await _(context,"admin_stats_period_line",user_id=uid,label=await _(context,f"admin_stats_label_{period_key}",user_id=uid,default=period_key),
+                                      orders=orders_count,revenue=revenue,completed=completed_count,avg_basket=(revenue / orders_count if orders_count else 0.0),default=f"{period_key}: {orders_count}\n"))
+        text_parts.append("\n" + await _(context,"admin_stats_daily_header",user_id=uid,default="Daily revenue (last 7 days):\n"))
+        for day, orders_count, revenue in stats['daily']:
+            text_parts.append(await _(context,"admin_stats_daily_line",user_id=uid,day=day,orders=orders_count,revenue=revenue,default=f"{day}: {revenue:.2f} EUR\n"))
+        text_parts.append("\n" + await _(context,"admin_stats_top_header",user_id=uid,default="Top products (30 days):\n"))
+        for i, (name, quantity, revenue) in enumerate(stats['top_products']):
+            text_parts.append(await _(context,"admin_stats_top_line",user_id=uid,index=i+1,name=name,quantity=quantity,revenue=revenue,default=f"{i+1}. {name}\n"))
+    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    try: await q.edit_message_text(text="".join(text_parts),reply_markup=InlineKeyboardMarkup(kb))
+    except Exception as e: logger.error("Error admin_stats: %s", e)
+
+async def _send_orders_export(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, fmt: str, compress: bool):
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+    except TelegramError as e:
+        logger.warning("Upload indicator for orders export not sent: %s", e) # Cosmetic; the export still runs
+    try:
+        export_file, rows_written = await exports.write_orders_export(fmt, compress)
+    except Exception as e:
+        logger.error("Orders export (%s, gzip=%s) failed: %s", fmt, compress, e)
+        await context.bot.send_message(chat_id=chat_id, text=await _(context,"admin_export_failed",user_id=uid,default="Export failed."))
+        return
+    filename = f"orders-{datetime.now().strftime('%Y%m%d-%H%M')}.{fmt}" + (".gz" if compress else "")
+    try:
+        await context.bot.send_document(chat_id=chat_id, document=export_file, filename=filename,
+                                        caption=await _(context,"admin_export_caption",user_id=uid,rows=rows_written,default=f"{rows_written} rows"))
+    except Exception as e:
+        logger.error("Failed to send orders export %s: %s", filename, e)
+        await context.bot.send_message(chat_id=chat_id, text=await _(context,"admin_export_failed",user_id=uid,default="Export failed."))
+    finally:
+        export_file.close()
+
+async def admin_export_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /export [csv|jsonl] [gz] -- sends all orders as a document. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"view"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    args = [arg.lower() for arg in (context.args or [])]
+    fmt = next((arg for arg in args if arg in exports.EXPORT_FORMATS), "csv")
+    compress = any(arg in ("gz", "gzip") for arg in args)
+    await _send_orders_export(context, update.effective_chat.id, uid, fmt, compress)
+
+async def admin_export_orders_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not roles.can(uid,"view"):await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid));return
+    await _send_orders_export(context, q.message.chat_id, uid, "csv", False)
+
+# --- Memory Report ---
+def _approx_size(obj, seen: set = None) -> int:
+    """ Rough deep size in bytes of plain containers (what user_data holds); shared objects are counted once. """
+    seen = set() if seen is None else seen
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict): size += sum(_approx_size(k, seen) + _approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)): size += sum(_approx_size(item, seen) for item in obj)
+    return size
+
+def _open_conversation_count(conversation: ConversationHandler) -> str:
+    # ConversationHandler has no public counter; _conversations is the per-key state dict it keeps in memory.
+    # If a PTB upgrade renames it, show "?" rather than a plausible-looking 0.
+    states = getattr(conversation, '_conversations', None)
+    if isinstance(states, dict): return str(len(states))
+    logger.warning("ConversationHandler has no _conversations dict; /memstats cannot count open conversations.")
+    return "?"
+
+async def admin_memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /memstats -- in-memory per-user state and open conversations. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"admin"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    application = context.application
+    user_sizes = sorted(((_approx_size(data), user_id) for user_id, data in application.user_data.items()), reverse=True)
+    total_bytes = sum(size for size, _user_id in user_sizes)
+    conversations = {"order": order_conv, "add_product": admin_add_prod_conv, "manage_products": admin_manage_prod_conv,
+                     "orders_range": admin_orders_range_conv, "import": admin_import_products_conv,
+                     "broadcast": admin_broadcast_conv, "clear_orders": admin_clear_orders_conv, "language": lang_conv}
+    open_conversations = ", ".join(f"{name}={_open_conversation_count(conv)}" for name, conv in conversations.items())
+    lines = [
+        await _(context,"admin_memstats_summary",user_id=uid,users=len(user_sizes),total_kb=total_bytes/1024,
+                avg_bytes=(total_bytes//len(user_sizes)) if user_sizes else 0,chats=len(application.chat_data),
+                saved_carts=len(context.bot_data.get('spilled_cart_users', ())),
+                default=f"Users in memory: {len(user_sizes)}, {total_bytes/1024:.1f} KiB"),
+        await _(context,"admin_memstats_conversations",user_id=uid,conversations=open_conversations,default=f"Open conversations (best effort): {open_conversations}"),
+    ]
+    if user_sizes:
+        lines.append(await _(context,"admin_memstats_largest",user_id=uid,default="Largest sessions:"))
+        lines.extend(f"{user_id}: {size} B" for size, user_id in user_sizes[:5])
+    await update.message.reply_text("\n".join(lines))
+
+async def admin_reload_translations_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /reloadlocales -- re-reads locales/*.json now instead of waiting for the file watcher. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"admin"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    problems=await asyncio.to_thread(reload_translations)
+    if not problems:
+        await update.message.reply_text(await _(context,"admin_translations_reloaded",user_id=uid,default="Translations reloaded."));return
+    shown="\n".join(f"- {problem}" for problem in problems[:20])+(f"\n(+{len(problems)-20})" if len(problems)>20 else "")
+    await update.message.reply_text((await _(context,"admin_translations_rejected",user_id=uid,count=len(problems),default=f"Reload rejected ({len(problems)} problems):"))+"\n"+shown)
+
+async def admin_roles_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /roles -- staff members and their roles. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"admin"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    role_names={role:await _(context,f"role_{role}",user_id=uid,default=role) for role in roles.ROLES}
+    lines=[await _(context,"admin_roles_title",user_id=uid,default="Staff roles:")]
+    for user_id,role in sorted(roles.staff().items(),key=lambda item:(roles.ROLES.index(item[1]),item[0])):
+        lines.append(f"{user_id}: {role_names[role]}"+(" *" if roles.is_configured_owner(user_id) else ""))
+    lines.append(await _(context,"admin_roles_usage",user_id=uid,default="* = set in the bot configuration. Change roles with /setrole <user id> <owner|packer|viewer|none>."))
+    await update.message.reply_text("\n".join(lines))
+
+async def admin_set_role_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /setrole <user id> <owner|packer|viewer|none> -- gives a staff role or takes it away. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"admin"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    args=context.args or []
+    if len(args)!=2 or not args[0].isdigit() or args[1].lower() not in (*roles.ROLES,"none"):
+        await update.message.reply_text(await _(context,"admin_set_role_usage",user_id=uid,default="Usage: /setrole <user id> <owner|packer|viewer|none>"));return
+    target_id,role=int(args[0]),args[1].lower()
+    if roles.is_configured_owner(target_id):
+        await update.message.reply_text(await _(context,"admin_set_role_configured_owner",user_id=uid,target_id=target_id,default=f"{target_id} is an owner from the bot configuration."));return
+    if not await roles.set_role(target_id,None if role=="none" else role):
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid));return
+    if role=="none":
+        await update.message.reply_text(await _(context,"admin_role_removed",user_id=uid,target_id=target_id,default=f"{target_id} is no longer staff."))
+    else:
+        await update.message.reply_text(await _(context,"admin_role_set",user_id=uid,target_id=target_id,role=await _(context,f"role_{role}",user_id=uid,default=role),default=f"{target_id} is now {role}."))
+
+# --- Profiling ---
+async def _send_profile(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, seconds: int, use_cprofile: bool, with_memory: bool):
+    try:
+        report = await profiling.profile_live_traffic(seconds, use_cprofile, with_memory)
+    except Exception as e:
+        logger.error("Profiling failed: %s", e)
+        await context.bot.send_message(chat_id=chat_id, text=await _(context,"admin_profile_failed",user_id=uid,default="Profiling failed."))
+        return
+    filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+    try:
+        await context.bot.send_document(chat_id=chat_id, document=report.encode(), filename=filename,
+                                        caption=await _(context,"admin_profile_caption",user_id=uid,seconds=seconds,default=f"Profile of {seconds} s"))
+    except TelegramError as e:
+        logger.error("Failed to send profile %s: %s", filename, e)
+
+async def admin_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /profile [seconds] [cprofile] [mem] -- profiles live traffic for a while and sends the report as a file; mem adds tracemalloc. """
+    uid=update.effective_user.id
+    if not roles.can(uid,"admin"):await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid));return
+    args=[arg.lower() for arg in (context.args or [])]
+    seconds=min(max(next((int(arg) for arg in args if arg.isdigit()),profiling.DEFAULT_SECONDS),1),profiling.MAX_SECONDS)
+    use_cprofile,with_memory="cprofile" in args,"mem" in args
+    if not profiling.claim():
+        await update.message.reply_text(await _(context,"admin_profile_busy",user_id=uid,default="A profile is already running."));return
+    try:
+        await update.message.reply_text(await _(context,"admin_profile_started",user_id=uid,seconds=seconds,profiler="cProfile" if use_cprofile else "sampling",
+                                                default=f"Profiling for {seconds} s..."))
+        context.application.create_task(_send_profile(context, update.effective_chat.id, uid, seconds, use_cprofile, with_memory))
+    except BaseException:
+        profiling.release() # The profile never started, so nothing else would give the claim back
+        raise
+
 # --- GENERAL CANCEL HANDLER ---
 async def general_cancel_command_handler(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     uid = update.effective_user.id if update.effective_user else None
@@ -761,19 +1502,19 @@ async def general_cancel_command_handler(update:Update,context:ContextTypes.DEFA
         elif update.message:
             await update.message.reply_text(cancel_txt, reply_markup=ReplyKeyboardRemove())
             message_sent_or_edited = True
-    except Exception as e: logger.warning(f"Cancel handler error on edit/reply: {e}")
+    except Exception as e: logger.warning("Cancel handler error on edit/reply: %s", e)
     if not message_sent_or_edited and update.effective_chat:
         try: await context.bot.send_message(chat_id=update.effective_chat.id, text=cancel_txt, reply_markup=ReplyKeyboardRemove())
-        except Exception as e: logger.error(f"Fallback cancel send error: {e}")
+        except Exception as e: logger.error("Fallback cancel send error: %s", e)
 
     lang_code = context.user_data.get('language_code')
     cart_data = context.user_data.get('cart')
-    keys_to_pop=['current_product_id','current_product_name','current_product_price','new_pname','editing_pid', 'admin_product_options_message_to_edit', 'last_product_list_message_id']
+    keys_to_pop=['current_product_id','current_product_name','current_product_price','new_pname','new_pid','editing_pid', 'admin_product_options_message_to_edit', 'last_product_list_message_id']
     for k_pop in keys_to_pop: context.user_data.pop(k_pop, None)
     if lang_code: context.user_data['language_code'] = lang_code
     if cart_data is not None: context.user_data['cart'] = cart_data
 
-    if ADMIN_IDS and uid in ADMIN_IDS:
+    if roles.is_staff(uid):
         # Create a new update object if original was callback to avoid issues with display_admin_panel editing
         temp_update = update
         if update.callback_query:
@@ -805,29 +1546,47 @@ lang_conv = ConversationHandler(
     per_user=True, per_chat=False # Explicitly set per_user
 )
 
+# Search and product deep links work from any step of the order flow, not just as entry points.
+order_flow_anytime_handlers = [
+    CommandHandler("search", order_flow_search_command),
+    CallbackQueryHandler(order_flow_reorder_cb, pattern=r"^order_flow_reorder_\d+$"),
+    CommandHandler("start", order_flow_deep_link_entry, filters=filters.Regex(r"^/start prod_\d+$"))
+]
+
 order_conv = ConversationHandler(
     entry_points=[
         CallbackQueryHandler(order_flow_browse_entry, pattern="^order_flow_browse_entry$"),
-        CallbackQueryHandler(order_flow_manage_cart_cb, pattern="^order_flow_view_cart_direct_entry$")
+        CallbackQueryHandler(order_flow_manage_cart_cb, pattern="^order_flow_view_cart_direct_entry$"),
+        *order_flow_anytime_handlers
     ],
     states={
         ORDER_FLOW_BROWSING_PRODUCTS: [
+            *order_flow_anytime_handlers,
             CallbackQueryHandler(order_flow_product_selected, pattern="^order_flow_select_prod_\d+$"),
+            CallbackQueryHandler(order_flow_catalog_nav_cb, pattern="^order_flow_(page|cat)_\d+$"),
             CallbackQueryHandler(order_flow_manage_cart_cb, pattern="^order_flow_manage_cart_cb$"),
             CallbackQueryHandler(order_flow_checkout_cb, pattern="^order_flow_checkout_cb$"),
+            CallbackQueryHandler(order_flow_slot_cb, pattern=r"^order_flow_slot_\d+$"),
             CallbackQueryHandler(lambda u,c: display_cart_and_products(u, c, u.callback_query.from_user.id, edit_message_id=u.callback_query.message.message_id), pattern="^order_flow_browse_return_cb_detailed$"),
         ],
         ORDER_FLOW_SELECTING_QUANTITY: [
+            *order_flow_anytime_handlers,
             MessageHandler(filters.TEXT & ~filters.COMMAND, order_flow_quantity_typed)
         ],
         ORDER_FLOW_VIEWING_CART: [ # Detailed cart management
+            *order_flow_anytime_handlers,
             CallbackQueryHandler(order_flow_remove_item_cb, pattern="^order_flow_remove_item_\d+$"),
+            CallbackQueryHandler(order_flow_standing_entry_cb, pattern="^order_flow_standing_entry_cb$"),
+            CallbackQueryHandler(order_flow_standing_day_cb, pattern="^order_flow_standing_day_[0-6]$"),
+            CallbackQueryHandler(order_flow_manage_cart_cb, pattern="^order_flow_manage_cart_cb$"),
             CallbackQueryHandler(order_flow_checkout_cb, pattern="^order_flow_checkout_cb$"),
+            CallbackQueryHandler(order_flow_slot_cb, pattern=r"^order_flow_slot_\d+$"),
             CallbackQueryHandler(lambda u,c: display_cart_and_products(u, c, u.callback_query.from_user.id, edit_message_id=u.callback_query.message.message_id), pattern="^order_flow_browse_return_cb_detailed$"),
         ]
     },
     fallbacks=general_conv_fallbacks,
-    per_user=True, per_chat=False
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
 )
 
 admin_add_prod_conv = ConversationHandler(
@@ -835,23 +1594,40 @@ admin_add_prod_conv = ConversationHandler(
     states={
         ADMIN_ADD_PROD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_prod_name_state)],
         ADMIN_ADD_PROD_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_prod_price_state)],
+        ADMIN_ADD_PROD_PHOTO: [
+            MessageHandler(filters.PHOTO, admin_add_prod_photo_state),
+            CallbackQueryHandler(admin_add_prod_skip_photo_cb, pattern="^admin_add_prod_skip_photo_cb$")
+        ],
     },
     fallbacks=admin_conv_fallbacks,
-    per_user=True, per_chat=False
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
 )
 
 admin_manage_prod_conv = ConversationHandler(
     entry_points=[CallbackQueryHandler(admin_manage_prod_list_entry_cb, pattern="^admin_manage_prod_list_entry_cb$")],
     states={
         ADMIN_MANAGE_PROD_LIST: [
-            CallbackQueryHandler(admin_manage_prod_selected_cb, pattern="^admin_manage_select_prod_\d+$")
+            CallbackQueryHandler(admin_manage_prod_selected_cb, pattern="^admin_manage_select_prod_\d+$"),
+            CallbackQueryHandler(admin_manage_catalog_nav_cb, pattern="^admin_manage_(page|cat)_\d+$")
         ],
         ADMIN_MANAGE_PROD_OPTIONS: [
             CallbackQueryHandler(admin_manage_edit_price_entry_cb, pattern="^admin_manage_edit_price_entry_cb$"),
             CallbackQueryHandler(admin_manage_toggle_avail_cb, pattern="^admin_manage_toggle_avail_cb_(0|1)$"),
             CallbackQueryHandler(admin_manage_delete_confirm_cb, pattern="^admin_manage_delete_confirm_cb$"),
+            CallbackQueryHandler(admin_manage_category_entry_cb, pattern="^admin_manage_category_entry_cb$"),
+            CallbackQueryHandler(admin_manage_set_category_cb, pattern="^admin_manage_set_cat_\d+$"),
+            CallbackQueryHandler(admin_manage_new_category_entry_cb, pattern="^admin_manage_new_cat_cb$"),
+            CallbackQueryHandler(admin_manage_photo_entry_cb, pattern="^admin_manage_photo_entry_cb$"),
+            CallbackQueryHandler(admin_manage_remove_photo_cb, pattern="^admin_manage_remove_photo_cb$"),
+            CallbackQueryHandler(admin_manage_prod_selected_cb, pattern="^admin_manage_select_prod_\d+$"), # Back from the category picker
             CallbackQueryHandler(admin_manage_prod_list_entry_cb, pattern="^admin_manage_prod_list_refresh_cb$") # Refresh
         ],
+        ADMIN_MANAGE_PROD_NEW_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_manage_new_category_state)],
+        ADMIN_MANAGE_PROD_PHOTO: [
+            MessageHandler(filters.PHOTO, admin_manage_photo_state),
+            CallbackQueryHandler(admin_manage_prod_selected_cb, pattern="^admin_manage_select_prod_\d+$") # Back
+        ],
         ADMIN_MANAGE_PROD_EDIT_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_manage_edit_price_state)],
         ADMIN_MANAGE_PROD_DELETE_CONFIRM: [
             CallbackQueryHandler(admin_manage_delete_do_cb, pattern="^admin_manage_delete_do_cb$"),
@@ -859,7 +1635,39 @@ admin_manage_prod_conv = ConversationHandler(
         ]
     },
     fallbacks=admin_conv_fallbacks,
-    per_user=True, per_chat=False
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
+)
+
+admin_orders_range_conv = ConversationHandler(
+    entry_points=[CallbackQueryHandler(admin_view_orders_custom_entry_cb, pattern="^admin_view_orders_custom_cb$")],
+    states={
+        ADMIN_ORDERS_CUSTOM_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_view_orders_custom_range_state)]
+    },
+    fallbacks=admin_conv_fallbacks,
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
+)
+
+admin_import_products_conv = ConversationHandler(
+    entry_points=[CallbackQueryHandler(admin_import_products_entry_cb, pattern="^admin_import_products_entry_cb$")],
+    states={
+        ADMIN_IMPORT_PRODUCTS_FILE: [MessageHandler(filters.Document.ALL, admin_import_products_file_state)]
+    },
+    fallbacks=admin_conv_fallbacks,
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
+)
+
+admin_broadcast_conv = ConversationHandler(
+    entry_points=[CallbackQueryHandler(admin_broadcast_entry_cb, pattern="^admin_broadcast_entry_cb$")],
+    states={
+        ADMIN_BROADCAST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_text_state)],
+        ADMIN_BROADCAST_CONFIRM: [CallbackQueryHandler(admin_broadcast_confirm_cb, pattern="^admin_broadcast_confirm_cb$")]
+    },
+    fallbacks=admin_conv_fallbacks,
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
 )
 
 admin_clear_orders_conv = ConversationHandler(
@@ -870,5 +1678,6 @@ admin_clear_orders_conv = ConversationHandler(
         ]
     },
     fallbacks=admin_conv_fallbacks,
-    per_user=True, per_chat=False
+    per_user=True, per_chat=False,
+    conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
 )
@@ -0,0 +1,229 @@
+# jobs.py
+# Background JobQueue callbacks. Blocking database work is pushed to a worker thread (the storage
+# backend does this for its own calls), so scheduled jobs never stall update processing on the event loop.
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import CallbackContext, ContextTypes
+
+from config_and_utils import (
+    BOT_TZ, BROADCAST_CONCURRENCY, BROADCAST_RATE_PER_SECOND, DB_BACKUP_KEEP, DB_IDLE_SECONDS, DELIVERY_SLOT_DAYS_AHEAD,
+    DELIVERY_SLOT_MAX_KG, DELIVERY_SLOT_MAX_ORDERS, DELIVERY_SLOTS, OUTBOX_RATE_PER_SECOND, SAVED_CART_TTL_SECONDS, USER_DATA_TTL_SECONDS, _,
+    backup_dir, reload_translations, translation_files_changed
+)
+
+import db_operations
+import notifications
+import sharding
+import storage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 50
+BROADCAST_BATCH_SIZE = 50 # Progress is persisted after every batch, so a crash re-sends at most one batch
+BROADCAST_PROGRESS_INTERVAL_SECONDS = 5
+
+
+
+async def rebuild_sales_rollups_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Periodic safety net for the incrementally maintained sales rollups. """
+    days_rebuilt = await storage.backend.rebuild_sales_rollups()
+    if days_rebuilt < 0:
+        logger.error("Scheduled sales rollup rebuild failed.")
+
+async def reload_translations_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Picks up edits to locales/*.json. Parsing and validation run in a thread; a rejected edit keeps the current translations. """
+    if await asyncio.to_thread(translation_files_changed):
+        await asyncio.to_thread(reload_translations)
+
+async def db_checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Truncating WAL checkpoint, only in idle windows and only if updates arrived since the last one (on any worker). """
+    last_update = sharding.last_activity(context.bot_data.get('last_update_monotonic', 0.0))
+    if time.monotonic() - last_update < DB_IDLE_SECONDS or context.bot_data.get('last_checkpoint_monotonic', -1.0) > last_update:
+        return
+    await asyncio.to_thread(db_operations.checkpoint_wal, "TRUNCATE")
+    context.bot_data['last_checkpoint_monotonic'] = time.monotonic()
+
+async def db_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Nightly: planner statistics, space reclaim, checkpoint and an online backup. Every step is timed in maintenance_log. """
+    await asyncio.to_thread(db_operations.optimize_database)
+    await asyncio.to_thread(db_operations.incremental_vacuum)
+    await asyncio.to_thread(db_operations.checkpoint_wal, "PASSIVE")
+    await asyncio.to_thread(db_operations.backup_database, backup_dir(), DB_BACKUP_KEEP)
+
+async def evict_idle_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Drops user_data of users idle for USER_DATA_TTL_SECONDS. Non-empty carts are spilled to saved_carts first
+    and handlers.record_activity restores them on the user's next update.
+    """
+    application = context.application
+    now = time.monotonic()
+    last_seen = context.bot_data.setdefault('user_last_seen', {})
+    spilled_cart_users = context.bot_data.setdefault('spilled_cart_users', set())
+    # Users without a timestamp (e.g. loaded before tracking started) get one now and are judged on the next run.
+    idle_user_ids = [user_id for user_id in list(application.user_data) if now - last_seen.setdefault(user_id, now) >= USER_DATA_TTL_SECONDS]
+    carts = {user_id: application.user_data[user_id]['cart'] for user_id in idle_user_ids if application.user_data[user_id].get('cart')}
+    if carts and not await asyncio.to_thread(db_operations.save_carts, carts):
+        idle_user_ids = [user_id for user_id in idle_user_ids if user_id not in carts] # Keep carts in memory rather than lose them
+    else:
+        spilled_cart_users.update(carts)
+    for user_id in idle_user_ids:
+        application.drop_user_data(user_id)
+        last_seen.pop(user_id, None)
+    for user_id in [user_id for user_id, seen in last_seen.items() if now - seen >= USER_DATA_TTL_SECONDS and user_id not in application.user_data]:
+        del last_seen[user_id]
+    spilled_cart_users.difference_update(await asyncio.to_thread(db_operations.prune_saved_carts, SAVED_CART_TTL_SECONDS))
+    if idle_user_ids:
+        logger.info("Evicted %s idle sessions (%s carts saved), %s remain in memory.", len(idle_user_ids), len(carts), len(application.user_data))
+
+async def deliver_outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Drains due outbox events in batches. Runs are serialized so an event is never delivered by two runs at once.
+    Sends are paced to OUTBOX_RATE_PER_SECOND, so a bulk status change notifying hundreds of customers trickles out.
+    """
+    async with context.bot_data.setdefault('outbox_lock', asyncio.Lock()): # Per application: shops (shops.py) deliver independently
+        while True:
+            events = await storage.backend.get_due_outbox_events(OUTBOX_BATCH_SIZE)
+            for event in events:
+                event_started = time.monotonic()
+                try:
+                    delivered, error, sends = await notifications.deliver_outbox_event(context, event)
+                except Exception as e: # A rendering bug must not wedge the queue; the event is retried with backoff.
+                    logger.exception("Unexpected error delivering outbox event %s", event[0])
+                    delivered, error, sends = False, str(e), 0
+                await storage.backend.finish_outbox_event(event[0], delivered, event[3], error)
+                await asyncio.sleep(max(0.0, sends / OUTBOX_RATE_PER_SECOND - (time.monotonic() - event_started)))
+            if len(events) < OUTBOX_BATCH_SIZE: break
+
+async def standing_orders_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Places the standing orders that are due, one transaction per STANDING_ORDER_BATCH_SIZE. Customer confirmations
+    and the admin digest are queued with each batch and delivered through the (rate-limited) outbox.
+    """
+    now_ts, placed = int(time.time()), 0
+    while True:
+        runs = await storage.backend.materialize_standing_orders(now_ts)
+        if runs is None:
+            logger.error("Scheduled standing order run failed."); break
+        placed += len(runs)
+        if len(runs) < db_operations.STANDING_ORDER_BATCH_SIZE: break
+    if placed: kick_outbox_delivery(context.application)
+
+async def ensure_delivery_slots_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Keeps DELIVERY_SLOT_DAYS_AHEAD days of DELIVERY_SLOTS open; capacities of slots that already exist are not touched. """
+    try:
+        slot_times = db_operations.delivery_slot_times(DELIVERY_SLOTS, datetime.now(BOT_TZ).date(), DELIVERY_SLOT_DAYS_AHEAD)
+    except ValueError as e:
+        logger.error("DELIVERY_SLOTS '%s' is invalid: %s", DELIVERY_SLOTS, e); return
+    added = await storage.backend.ensure_delivery_slots(slot_times, DELIVERY_SLOT_MAX_ORDERS, DELIVERY_SLOT_MAX_KG)
+    if added: logger.info("Opened %s delivery slots.", added)
+
+def kick_outbox_delivery(application):
+    """ Delivers freshly queued events now instead of waiting for the next poll. """
+    if not sharding.runs_shared_jobs(): # Only the job worker delivers, so an event is never sent by two processes
+        sharding.publish("outbox", to=sharding.JOB_WORKER_INDEX)
+    elif application.job_queue:
+        application.job_queue.run_once(deliver_outbox_job, 0, name="deliver_outbox_now")
+    else:
+        application.create_task(deliver_outbox_job(CallbackContext(application)))
+
+async def _send_broadcast_message(bot, user_id: int, text: str, semaphore: asyncio.Semaphore) -> str:
+    """ Returns 'sent', 'blocked' or 'failed'. Flood-control replies are honoured once before giving up. """
+    async with semaphore:
+        for _attempt in range(2):
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                return 'blocked' if "chat not found" in str(e).lower() else 'failed'
+            except TelegramError as e:
+                logger.warning("Broadcast message to %s failed: %s", user_id, e)
+                return 'failed'
+        return 'failed'
+
+async def _report_broadcast_progress(context, broadcast: dict, rate: float = None):
+    if not broadcast['progress_chat_id'] or not broadcast['progress_message_id']: return
+    admin_id = broadcast['progress_chat_id']
+    done = broadcast['sent_count'] + broadcast['failed_count'] + broadcast['blocked_count']
+    remaining = max(0, broadcast['total_count'] - done)
+    eta = str(timedelta(seconds=int(remaining / rate))) if rate and broadcast['status'] == 'running' else "-"
+    text = await _(context, f"admin_broadcast_status_{broadcast['status']}", user_id=admin_id, broadcast_id=broadcast['id'], default=f"📣 #{broadcast['id']}: {broadcast['status']}")
+    text += "\n" + await _(context, "admin_broadcast_progress", user_id=admin_id, done=done, total=broadcast['total_count'],
+                           sent=broadcast['sent_count'], failed=broadcast['failed_count'], blocked=broadcast['blocked_count'],
+                           rate=rate or 0.0, eta=eta, default=f"{done}/{broadcast['total_count']}")
+    reply_markup = None
+    if broadcast['status'] == 'running':
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(await _(context, "admin_broadcast_cancel_button", user_id=admin_id, default="⛔ Stop"),
+                                                                   callback_data=f"admin_broadcast_cancel_{broadcast['id']}")]])
+    try:
+        await context.bot.edit_message_text(chat_id=admin_id, message_id=broadcast['progress_message_id'], text=text, reply_markup=reply_markup)
+    except TelegramError as e: # "message is not modified" and deleted progress messages are harmless
+        logger.debug("Could not update progress of broadcast %s: %s", broadcast['id'], e)
+
+async def run_broadcast(context, broadcast_id: int):
+    """
+    Sends a broadcast from its persisted cursor to the end of the users table.
+    Batches are paced to BROADCAST_RATE_PER_SECOND with at most BROADCAST_CONCURRENCY sends in flight.
+    """
+    running_broadcasts = context.bot_data.setdefault('running_broadcasts', set())
+    if broadcast_id in running_broadcasts: return
+    running_broadcasts.add(broadcast_id)
+    try:
+        broadcast = await asyncio.to_thread(db_operations.get_broadcast, broadcast_id)
+        if not broadcast or broadcast['status'] != 'running': return
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        cursor, processed, started, last_report = broadcast['last_user_id'], 0, time.monotonic(), 0.0
+        rate = None
+        while True:
+            batch = await storage.backend.get_broadcast_recipients(cursor, BROADCAST_BATCH_SIZE)
+            if not batch: break
+            batch_started = time.monotonic()
+            results = await asyncio.gather(*(_send_broadcast_message(context.bot, user_id, broadcast['text'], semaphore) for user_id in batch))
+            cursor = batch[-1]
+            blocked = [user_id for user_id, result in zip(batch, results) if result == 'blocked']
+            if blocked: await storage.backend.mark_users_blocked(blocked)
+            await asyncio.to_thread(db_operations.advance_broadcast, broadcast_id, cursor, results.count('sent'), results.count('failed'), len(blocked))
+            await asyncio.sleep(max(0.0, len(batch) / BROADCAST_RATE_PER_SECOND - (time.monotonic() - batch_started)))
+            processed += len(batch)
+            rate = processed / max(time.monotonic() - started, 1e-6)
+
+            broadcast = await asyncio.to_thread(db_operations.get_broadcast, broadcast_id)
+            if not broadcast or broadcast['status'] != 'running': break # Cancelled by an admin
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL_SECONDS:
+                await _report_broadcast_progress(context, broadcast, rate)
+                last_report = time.monotonic()
+
+        await asyncio.to_thread(db_operations.set_broadcast_status, broadcast_id, 'done', True)
+        broadcast = await asyncio.to_thread(db_operations.get_broadcast, broadcast_id)
+        if broadcast:
+            logger.info("Broadcast %s %s: sent=%s failed=%s blocked=%s", broadcast_id, broadcast['status'], broadcast['sent_count'], broadcast['failed_count'], broadcast['blocked_count'])
+            await _report_broadcast_progress(context, broadcast, rate)
+    finally:
+        running_broadcasts.discard(broadcast_id)
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_broadcast(context, context.job.data)
+
+def start_broadcast(application, broadcast_id: int):
+    if not sharding.runs_shared_jobs(): # The job worker sends every broadcast, so the rate limit holds across processes
+        sharding.publish("broadcast", broadcast_id, to=sharding.JOB_WORKER_INDEX)
+    elif application.job_queue:
+        application.job_queue.run_once(broadcast_job, 0, data=broadcast_id, name=f"broadcast_{broadcast_id}")
+    else:
+        application.create_task(run_broadcast(CallbackContext(application), broadcast_id))
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    """ Picks up broadcasts that were still running when the bot stopped. """
+    for broadcast_id in await asyncio.to_thread(db_operations.get_running_broadcast_ids):
+        logger.info("Resuming broadcast %s.", broadcast_id)
+        start_broadcast(context.application, broadcast_id)
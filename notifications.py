@@ -0,0 +1,146 @@
+# notifications.py
+# Rendering and delivery of outbox events, queued with each order, with customer-facing status changes
+# and with each batch of standing orders (see Storage.save_order, set_orders_status and materialize_standing_orders).
+# Staff events go only to the roles subscribed to them (ROLE_SUBSCRIPTIONS, see roles.py). Each event is
+# rendered at delivery time once per recipient language and the same text is sent to everyone who reads it.
+
+import logging
+
+from telegram.error import Forbidden, TelegramError
+
+from config_and_utils import DEFAULT_LANGUAGE, NOTIFY_ROLES, _, format_slot, format_timestamp
+
+import roles
+import storage
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+async def render_order_created(context, recipient_id: int, payload: dict) -> str:
+    order_id, total_price = payload['order_id'], payload['total_price']
+    user_name = payload.get('user_name') or "N/A"
+    username = payload.get('username') or "N/A"
+    lines = [
+        await _(context, "admin_new_order_notification_title", user_id=recipient_id, order_id=order_id, default=f"🔔 New Order #{order_id}"),
+        await _(context, "admin_order_from", user_id=recipient_id, name=user_name, username=username, customer_id=payload['user_id'], default=f"From:{user_name}..."),
+    ]
+    if payload.get('slot'):
+        slot = format_slot(payload['slot']['start_ts'], payload['slot']['end_ts'])
+        lines.append(await _(context, "admin_order_slot", user_id=recipient_id, slot=slot, default=f"Slot: {slot}"))
+    lines += [
+        "\n",
+        await _(context, "admin_order_items_header", user_id=recipient_id, default="Items:"),
+        "------------------------------------"
+    ]
+    for i, item in enumerate(payload['items']):
+        lines.append(await _(context, "admin_order_item_line_format", user_id=recipient_id, index=i + 1, item_name=item['name'],
+                             quantity=item['quantity'], price_per_kg=item['price'], item_subtotal=item['price'] * item['quantity'],
+                             default=f"{i+1}. {item['name']}: ..."))
+    lines.append("------------------------------------")
+    lines.append(await _(context, "admin_order_grand_total", user_id=recipient_id, total_price=total_price, default=f"Total:{total_price:.2f} EUR"))
+    return "\n".join(lines)
+
+async def render_order_status_changed(context, recipient_id: int, payload: dict) -> str:
+    status = payload['status']
+    status_text = await _(context, f"order_status_{status}", user_id=recipient_id, default=status)
+    return await _(context, "order_status_changed_notification", user_id=recipient_id, order_id=payload['order_id'], status=status_text,
+                   default=f"Your order #{payload['order_id']} is now: {status_text}")
+
+async def render_standing_order_placed(context, recipient_id: int, payload: dict) -> str:
+    next_run = format_timestamp(payload['next_run_ts'], "%Y-%m-%d %H:%M")
+    if not payload['order_id']:
+        return await _(context, "standing_order_not_placed_notification", user_id=recipient_id, next_run=next_run,
+                       default=f"Your weekly order could not be placed: none of its products are available. Next try: {next_run}")
+    items = ", ".join(f"{item['name']} {item['quantity']}{item.get('unit') or 'kg'}" for item in payload['items'])
+    lines = [await _(context, "standing_order_placed_notification", user_id=recipient_id, order_id=payload['order_id'], items=items,
+                     total_price=payload['total_price'], next_run=next_run, default=f"🔁 Weekly order #{payload['order_id']} placed: {items}")]
+    if payload['skipped']:
+        lines.append(await _(context, "standing_order_skipped_items", user_id=recipient_id, items=", ".join(payload['skipped']),
+                             default=f"Not available this week: {', '.join(payload['skipped'])}"))
+    return "\n".join(lines)
+
+async def render_standing_orders_digest(context, recipient_id: int, payload: dict) -> str:
+    lines = [await _(context, "admin_standing_orders_digest_title", user_id=recipient_id, count=len(payload['orders']), total_price=payload['total_price'],
+                     default=f"🔁 {len(payload['orders'])} weekly orders placed")]
+    lines.extend(f"#{order_id} {user_name or 'N/A'}: {total_price:.2f} EUR" for order_id, user_name, total_price in payload['orders'])
+    if payload['skipped']:
+        lines.append(await _(context, "admin_standing_orders_digest_skipped", user_id=recipient_id, count=payload['skipped'], default=f"Not placed: {payload['skipped']}"))
+    return "\n".join(lines)
+
+EVENT_RENDERERS = {
+    'order_created': render_order_created,
+    'order_status_changed': render_order_status_changed,
+    'standing_order_placed': render_standing_order_placed,
+    'standing_orders_digest': render_standing_orders_digest,
+}
+
+# Staff event type -> the roles that receive it. NOTIFY_ROLES overrides single entries.
+ROLE_SUBSCRIPTIONS = {
+    'order_created': ('owner', 'packer'),
+    'standing_orders_digest': ('owner', 'packer'),
+}
+
+def _parse_role_subscriptions(spec: str) -> dict:
+    """ "event=role+role,other=role" -> {event: (role, role)}; unknown events or roles are skipped. """
+    subscriptions = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        event_type, _sep, role_names = (part.strip() for part in entry.partition("="))
+        subscribed = tuple(filter(None, (role.strip() for role in role_names.split("+"))))
+        if event_type not in ROLE_SUBSCRIPTIONS or not all(role in roles.ROLES for role in subscribed):
+            logger.warning("Ignoring malformed NOTIFY_ROLES entry '%s'", entry)
+            continue
+        subscriptions[event_type] = subscribed
+    return subscriptions
+
+ROLE_SUBSCRIPTIONS.update(_parse_role_subscriptions(NOTIFY_ROLES))
+
+def event_recipients(event_type: str, payload: dict) -> list:
+    if event_type in ROLE_SUBSCRIPTIONS: return sorted(roles.members(ROLE_SUBSCRIPTIONS[event_type]))
+    if event_type in ('order_status_changed', 'standing_order_placed'): return [payload['user_id']]
+    return []
+
+async def _send_long_message(bot, chat_id: int, text: str):
+    for start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+        await bot.send_message(chat_id=chat_id, text=text[start:start + TELEGRAM_MESSAGE_LIMIT])
+
+class _LanguageContext:
+    """ Stands in for the job's context while rendering: _() takes the language from user_data instead of asking storage. """
+
+    def __init__(self, context, language_code: str):
+        self.bot = context.bot
+        self.user_data = {'language_code': language_code}
+
+async def deliver_outbox_event(context, event: tuple) -> tuple[bool, str | None, int]:
+    """
+    Sends one outbox event to every recipient that has not received it yet.
+    Returns (done, error, attempted sends); done is False when at least one recipient should be retried.
+    """
+    event_id, event_type, payload, _attempts, done_recipients = event
+    renderer = EVENT_RENDERERS.get(event_type)
+    if renderer is None:
+        return False, f"Unknown event type '{event_type}'", 0
+
+    error, attempts = None, 0
+    pending = [recipient_id for recipient_id in event_recipients(event_type, payload) if recipient_id not in done_recipients]
+    languages = await storage.backend.get_user_languages(pending) if pending else {}
+    texts = {} # language -> rendered text
+    for recipient_id in pending:
+        language = languages.get(recipient_id) or DEFAULT_LANGUAGE
+        if language not in texts:
+            texts[language] = await renderer(_LanguageContext(context, language), recipient_id, payload)
+        attempts += 1
+        try:
+            await _send_long_message(context.bot, recipient_id, texts[language])
+        except Forbidden as e:
+            # The recipient blocked the bot; retrying cannot help, so record it and move on.
+            logger.warning("Outbox event %s: recipient %s is unreachable: %s", event_id, recipient_id, e)
+            await storage.backend.record_outbox_delivery(event_id, recipient_id, 'unreachable', str(e))
+        except TelegramError as e:
+            logger.error("Outbox event %s: delivery to %s failed: %s", event_id, recipient_id, e)
+            await storage.backend.record_outbox_delivery(event_id, recipient_id, 'failed', str(e))
+            error = str(e)
+        else:
+            await storage.backend.record_outbox_delivery(event_id, recipient_id, 'sent')
+    return error is None, error, attempts
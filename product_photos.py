@@ -0,0 +1,88 @@
+# product_photos.py
+# Product photos are uploaded to Telegram once, by the admin. Every later send reuses the stored
+# file_id, so showing a photo costs no upload bytes. A local copy of the original is kept only so
+# that a file_id Telegram stops accepting can be replaced by uploading the bytes once more.
+
+import asyncio
+import logging
+import os
+
+from telegram.error import BadRequest, TelegramError
+
+from config_and_utils import product_photo_dir
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def local_photo_path(product_id: int) -> str:
+    return os.path.join(product_photo_dir(), f"{product_id}.jpg")
+
+def _write_local_copy(product_id: int, data: bytes):
+    path = local_photo_path(product_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".partial", "wb") as f:
+        f.write(data)
+    os.replace(path + ".partial", path)
+
+def _read_local_copy(product_id: int) -> bytes:
+    with open(local_photo_path(product_id), "rb") as f:
+        return f.read()
+
+def _is_stale_file_id_error(error: BadRequest) -> bool:
+    # e.g. "Wrong file identifier/http url specified", "Wrong remote file identifier specified", "File reference expired"
+    return "file" in error.message.lower()
+
+
+async def store_product_photo(product_id: int, photo_sizes) -> bool:
+    """
+    Makes an uploaded photo (Message.photo) the product's photo. Telegram already keeps downscaled
+    sizes of it for previews, so only the largest size is recorded and copied to disk.
+    """
+    largest = max(photo_sizes, key=lambda size: size.width * size.height)
+    if not await storage.backend.set_product_photo(product_id, largest.file_id):
+        return False
+    try:
+        data = await (await largest.get_file()).download_as_bytearray()
+        await asyncio.to_thread(_write_local_copy, product_id, bytes(data))
+    except (TelegramError, OSError) as e:
+        # The file_id still works; only a later re-upload would be impossible.
+        logger.warning("Product %s: could not keep a local copy of the photo: %s", product_id, e)
+    logger.info("Product %s: photo stored (%s bytes).", product_id, largest.file_size)
+    return True
+
+async def remove_product_photo(product_id: int):
+    """ Forgets the product's photo and deletes the local copy. Also used after the product itself is deleted. """
+    await storage.backend.set_product_photo(product_id, None)
+    try:
+        await asyncio.to_thread(os.remove, local_photo_path(product_id))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Product %s: could not delete the local photo copy: %s", product_id, e)
+
+async def send_product_photo(bot, chat_id: int, product_id: int, **kwargs):
+    """
+    Sends the product's photo by its stored file_id. If Telegram rejects the id, the local copy is
+    uploaded once and the returned file_id replaces the stale one.
+    Returns the sent Message, or None if the product has no usable photo. Other Telegram errors propagate.
+    """
+    file_id = (await storage.backend.get_product_photo_ids()).get(product_id)
+    if not file_id:
+        return None
+    try:
+        return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+    except BadRequest as e:
+        if not _is_stale_file_id_error(e): raise
+        logger.warning("Product %s: stored photo file_id was rejected (%s); re-uploading the local copy.", product_id, e)
+
+    try:
+        data = await asyncio.to_thread(_read_local_copy, product_id)
+    except OSError as e:
+        logger.error("Product %s: photo file_id is stale and there is no local copy (%s); removing the photo.", product_id, e)
+        await storage.backend.set_product_photo(product_id, None)
+        return None
+    message = await bot.send_photo(chat_id=chat_id, photo=data, **kwargs)
+    await storage.backend.set_product_photo(product_id, max(message.photo, key=lambda size: size.width * size.height).file_id)
+    return message
@@ -0,0 +1,188 @@
+# profiling.py
+# On-demand profiling of live traffic (/profile). The bot keeps serving while it runs; the result is a
+# plain-text report of the hottest functions and of the allocation sites that grew.
+#
+# The default profiler samples: a helper thread reads the event loop thread's Python stack (handlers and jobs,
+# not the to_thread pool) every SAMPLE_INTERVAL_SECONDS, so its cost is bounded by the sample rate and is
+# measured directly as the CPU time the sampler thread used. cProfile instead traces every call on the loop
+# thread; it sees every function but slows Python code down by a factor, which is measured on a calibration
+# workload and printed with the report. tracemalloc ("mem") compares snapshots taken at the start and at the
+# end; its slowdown is measured the same way. It is off by default because it slows allocation-heavy code
+# several times over (benchmarks/bench_profiling.py). Everything is process-wide, so one profile runs at a
+# time (in multi-shop mode it covers all shops; with WORKER_PROCESSES > 1 only the worker that handled the command).
+
+import asyncio
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 300
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_STACK_DEPTH = 64
+TOP_N = 30
+TRACEMALLOC_FRAMES = 1 # Frames kept per allocation; more frames make tracemalloc slower and bigger
+CALIBRATION_ROUNDS = 3
+
+_claimed = False
+
+
+def claim() -> bool:
+    """ Reserves the profiler for one profile_live_traffic call; False while another profile is running. """
+    global _claimed
+    if _claimed: return False
+    _claimed = True
+    return True
+
+def release():
+    """ Gives back a claim(); profile_live_traffic does it when it ends. """
+    global _claimed
+    _claimed = False
+
+
+class StackSampler:
+    """ Samples one thread's Python stack from a helper thread until stopped. """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id, self.interval = thread_id, interval
+        self.own = collections.Counter() # function -> samples where it was running
+        self.total = collections.Counter() # function -> samples where it was on the stack
+        self.samples = self.idle = 0
+        self.cpu_seconds = 0.0
+        self._labels = {} # code object -> "name (file:line)", so each function is formatted once
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        started = time.thread_time()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: break
+            self.samples += 1
+            if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle += 1 # The event loop is waiting for I/O
+                continue
+            functions = []
+            while frame is not None and len(functions) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                label = self._labels.get(code)
+                if label is None: label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+                functions.append(label)
+                frame = frame.f_back
+            self.own[functions[0]] += 1
+            self.total.update(set(functions))
+        self.cpu_seconds = time.thread_time() - started
+
+    def report(self, seconds: float) -> list:
+        busy = self.samples - self.idle
+        lines = [f"Sampling profiler: {self.samples} samples every {self.interval * 1000:.0f} ms, event loop busy in {busy} "
+                 f"({busy * 100 / max(self.samples, 1):.1f}%)",
+                 f"Sampler overhead: {self.cpu_seconds * 1000:.0f} ms CPU in {seconds:.0f} s ({self.cpu_seconds * 100 / seconds:.2f}% of one core)", ""]
+        for title, counter in (("Own time (function running)", self.own), ("Total time (function on the stack)", self.total)):
+            lines.append(f"{title}, share of busy samples:")
+            lines.extend(f"{count * 100 / max(busy, 1):6.1f}%  {count:6d}  {function}" for function, count in counter.most_common(TOP_N))
+            lines.append("")
+        return lines
+
+def _short_path(path: str) -> str:
+    for prefix in sorted({p for p in sys.path if p}, key=len, reverse=True):
+        if path.startswith(prefix + os.sep): return path[len(prefix) + 1:]
+    return path
+
+
+def _calibration_workload():
+    """ Small mix of short Python calls and allocations, like building a keyboard in a handler. """
+    def label(product): return f"{product['name']} - {product['price']:.2f} EUR/kg"
+    def button(product): return {'text': label(product), 'callback_data': f"select_{product['id']}"}
+    products = [{'id': i, 'name': f"product {i}", 'price': i * 1.5} for i in range(200)]
+    return sum(len(row['text']) for _ in range(20) for row in map(button, sorted(products, key=lambda product: product['name'])))
+
+def _calibration_seconds() -> float:
+    best = float("inf")
+    for _ in range(CALIBRATION_ROUNDS):
+        started = time.perf_counter()
+        _calibration_workload()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def _slowdown(baseline: float) -> str:
+    return f"{_calibration_seconds() / baseline:.1f}x"
+
+
+def _memory_report(start: tracemalloc.Snapshot, end: tracemalloc.Snapshot, peak: int) -> list:
+    ignored = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"))
+    start, end = start.filter_traces(ignored), end.filter_traces(ignored)
+    lines = [f"Traced memory at the end: {sum(stat.size for stat in end.statistics('filename')) / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB", "",
+             "Allocation sites that grew during the profile:"]
+    lines.extend(f"{stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7d} blocks  {_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}"
+                 for stat in end.compare_to(start, "lineno")[:TOP_N] if stat.size_diff > 0)
+    lines += ["", "Largest allocation sites at the end:"]
+    lines.extend(f"{stat.size / 1024:9.1f} KiB {stat.count:7d} blocks  {_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}"
+                 for stat in end.statistics("lineno")[:TOP_N])
+    return lines
+
+
+async def profile_live_traffic(seconds: float, use_cprofile: bool = False, with_memory: bool = False) -> str:
+    """
+    Profiles whatever runs on the event loop for `seconds` and returns the report. The caller must have
+    claim()ed the profiler; it is released here.
+    """
+    started_tracing = False
+    try:
+        baseline = _calibration_seconds()
+        lines = [f"Profile of {seconds:.0f} s of live traffic, started {time.strftime('%Y-%m-%d %H:%M:%S')}, pid {os.getpid()}"]
+        started_tracing = with_memory and not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start(TRACEMALLOC_FRAMES)
+        if with_memory:
+            lines.append(f"tracemalloc slows allocation-heavy code down {_slowdown(baseline)}")
+            start_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+
+        profiler = sampler = None
+        started = time.perf_counter()
+        if use_cprofile:
+            profiler = cProfile.Profile()
+            profiler.enable() # Traces this thread, i.e. every task on the event loop
+            lines.append(f"cProfile slows Python code down {_slowdown(baseline)} (measured with tracemalloc {'on' if with_memory else 'off'})")
+        else:
+            sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL_SECONDS)
+            sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            if profiler: profiler.disable()
+            if sampler: await asyncio.to_thread(sampler.stop)
+        elapsed = time.perf_counter() - started
+        lines.append("")
+
+        if sampler:
+            lines += sampler.report(elapsed)
+        else:
+            for sort_key, title in (("tottime", "own time"), ("cumulative", "total time")):
+                stream = io.StringIO()
+                stats = pstats.Stats(profiler, stream=stream)
+                await asyncio.to_thread(lambda: stats.strip_dirs().sort_stats(sort_key).print_stats(TOP_N))
+                lines += [f"cProfile, sorted by {title}:", stream.getvalue()]
+
+        if with_memory:
+            end_snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing: tracemalloc.stop()
+            lines += await asyncio.to_thread(_memory_report, start_snapshot, end_snapshot, peak)
+        return "\n".join(lines) + "\n"
+    finally:
+        if started_tracing and tracemalloc.is_tracing(): tracemalloc.stop()
+        release()
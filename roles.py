@@ -0,0 +1,81 @@
+# roles.py
+# Staff roles, stored in users.role and given out by owners with /setrole. The users in ADMIN_TELEGRAM_ID
+# (a shop's "admins" in multi-shop mode) are always owners and cannot be changed from the bot.
+#
+#   owner   everything: catalog, broadcasts, clearing orders, roles and maintenance commands
+#   packer  works the orders: order lists, status changes, shopping list, delivery slots, stats and exports
+#   viewer  read-only: order lists, shopping list, delivery slots, stats and exports
+#
+# Every admin update checks a role, so the roles live in memory as one dict per shop, plus a frozenset of
+# members per role for notification routing. Both are rebuilt from the database on start and after every
+# change and swapped in with one assignment; in multi-process mode the other workers reload on the bus.
+
+import logging
+
+from config_and_utils import admin_ids, current_shop
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+ROLES = ('owner', 'packer', 'viewer')
+ROLE_PERMISSIONS = {
+    'owner': frozenset({'view', 'orders', 'catalog', 'broadcast', 'admin'}),
+    'packer': frozenset({'view', 'orders'}),
+    'viewer': frozenset({'view'}),
+}
+
+_staff = {} # current_shop (None without shops) -> ({user_id: role}, {role: frozenset of user ids})
+
+# Called after a role change was saved; in multi-process mode sharding.py uses it to tell the other workers.
+role_change_listeners = []
+
+
+def _build(stored_roles: dict) -> tuple[dict, dict]:
+    roles = {user_id: role for user_id, role in stored_roles.items() if role in ROLE_PERMISSIONS}
+    roles.update(dict.fromkeys(admin_ids(), 'owner'))
+    members = {role: frozenset(user_id for user_id, user_role in roles.items() if user_role == role) for role in ROLES}
+    return roles, members
+
+def _current() -> tuple[dict, dict]:
+    # Before load_roles has run (or when it failed) only the configured admins are staff.
+    return _staff.get(current_shop.get()) or _build({})
+
+def role_of(user_id: int) -> str | None:
+    return _current()[0].get(user_id)
+
+def is_staff(user_id: int) -> bool:
+    return user_id in _current()[0]
+
+def can(user_id: int, permission: str) -> bool:
+    role = _current()[0].get(user_id)
+    return role is not None and permission in ROLE_PERMISSIONS[role]
+
+def members(roles) -> frozenset:
+    """ Every user holding one of the roles. """
+    by_role = _current()[1]
+    return frozenset().union(*(by_role.get(role, ()) for role in roles))
+
+def staff() -> dict:
+    """ {user_id: role} of every staff member, the configured owners included. """
+    return dict(_current()[0])
+
+def is_configured_owner(user_id: int) -> bool:
+    return user_id in admin_ids()
+
+
+async def load_roles() -> bool:
+    """ Re-reads the roles of the current shop. On a database error the roles in memory stay as they are. """
+    stored_roles = await storage.backend.get_staff_roles()
+    if stored_roles is None: return False
+    _staff[current_shop.get()] = _build(stored_roles)
+    logger.info("Loaded %s staff roles.", len(_staff[current_shop.get()][0]))
+    return True
+
+async def set_role(user_id: int, role: str | None) -> bool:
+    """ Saves a role (None removes it) and refreshes the roles in memory here and in the other workers. """
+    if role is not None and role not in ROLE_PERMISSIONS: raise ValueError(f"Unknown role '{role}'")
+    if not await storage.backend.set_user_role(user_id, role): return False
+    await load_roles()
+    for listener in role_change_listeners: listener()
+    return True
@@ -0,0 +1,191 @@
+# sharding.py
+# Multi-process mode (WORKER_PROCESSES > 1). The parent process is the ingest: it long-polls
+# getUpdates and routes every raw update to one of N worker processes by user id, so one user's
+# updates are always handled by the same worker, in order. Each worker runs the normal Application
+# (handlers, conversations, user_data) without an updater. Workers share the SQLite database in WAL mode
+# (and the PostgreSQL server when STORAGE_BACKEND=postgres).
+#
+# Workers keep in-process caches (catalog, translations, staff roles), so invalidations are published on a small
+# bus of per-worker inboxes. The bus also forwards outbox and broadcast kicks to worker 0, the only
+# worker running the shared background jobs. That keeps sends rate-limited in one place and stops
+# two processes from delivering the same outbox event. Each worker also writes the time of its last update
+# into a shared array, so worker 0's idle-window jobs (the WAL checkpoint) see traffic on every shard.
+
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import signal
+import threading
+from datetime import timedelta
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+
+from config_and_utils import TELEGRAM_TOKEN, reload_translations, translation_reload_listeners
+
+import db_operations
+import roles
+import storage
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT_SECONDS = 30
+WORKER_STOP_TIMEOUT_SECONDS = 15
+JOB_WORKER_INDEX = 0
+
+# Set in worker processes only; the single-process bot leaves these at their defaults.
+_worker_index = None
+_bus_inboxes = []
+_last_activity = None # Shared array: time.monotonic() of each worker's last update (the clock is system-wide)
+
+
+def runs_shared_jobs() -> bool:
+    """ True in the single-process bot and in the job worker. """
+    return _worker_index is None or _worker_index == JOB_WORKER_INDEX
+
+def publish(topic: str, payload=None, to: int = None):
+    """ Sends a bus message to one worker (to=index) or to every other worker. No-op outside multi-process mode. """
+    if _worker_index is None: return
+    for index, inbox in enumerate(_bus_inboxes):
+        if index != _worker_index and (to is None or index == to):
+            inbox.put((topic, payload))
+
+def note_activity(now: float):
+    """ Records this worker's last update time for last_activity(). No-op outside multi-process mode. """
+    if _last_activity is not None: _last_activity[_worker_index] = now
+
+def last_activity(local: float) -> float:
+    """ The newest update time of any worker; `local` (this process's own) outside multi-process mode. """
+    if _last_activity is None: return local
+    return max(local, *_last_activity)
+
+def update_user_id(update: dict) -> int:
+    """ The user a raw update belongs to: the sender, else the chat. 0 when there is neither (e.g. poll updates). """
+    for payload in update.values():
+        if not isinstance(payload, dict): continue
+        user = payload.get("from") or payload.get("user")
+        if user: return user["id"]
+        chat = payload.get("chat")
+        if chat: return chat["id"]
+    return 0
+
+def shard_for_update(update: dict, worker_count: int) -> int:
+    return update_user_id(update) % worker_count
+
+
+# --- Worker processes ---
+
+def _handle_bus_message(application, topic: str, payload):
+    import jobs
+    if topic == "catalog":
+        storage.backend.invalidate_catalog_cache(notify=False)
+    elif topic == "translations":
+        application.create_task(asyncio.to_thread(reload_translations, False)) # Validated again here; parsing stays off the loop
+    elif topic == "roles":
+        application.create_task(roles.load_roles())
+    elif topic == "outbox":
+        jobs.kick_outbox_delivery(application)
+    elif topic == "broadcast":
+        jobs.start_broadcast(application, payload)
+    else:
+        logger.warning("Worker %s: unknown bus topic '%s'", _worker_index, topic)
+
+def _listen_bus(loop, inbox, application):
+    while True:
+        message = inbox.get()
+        if message is None: return
+        loop.call_soon_threadsafe(_handle_bus_message, application, *message)
+
+async def _run_worker(application, update_queue, inbox):
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.post_init(application) # Not run by start(); opens the storage backend
+        await application.start()
+        threading.Thread(target=_listen_bus, args=(loop, inbox, application), name="bus", daemon=True).start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, update_queue.get)
+                if data is None: break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            # stop() still processes the updates already handed to the application
+            inbox.put(None)
+            await application.stop()
+            await application.post_shutdown(application)
+
+def _worker_main(index: int, update_queue, bus_inboxes, last_activity_times):
+    global _worker_index, _bus_inboxes, _last_activity
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole process group; the ingest shuts workers down in order
+    _worker_index, _bus_inboxes, _last_activity = index, bus_inboxes, last_activity_times
+    import bot
+    if not bot.configure(init_database=False): return
+    db_operations.catalog_invalidation_listeners.append(lambda: publish("catalog"))
+    translation_reload_listeners.append(lambda: publish("translations"))
+    roles.role_change_listeners.append(lambda: publish("roles"))
+    application = bot.build_application(with_shared_jobs=runs_shared_jobs(), with_updater=False)
+    logger.info("Worker %s started.", index)
+    asyncio.run(_run_worker(application, update_queue, bus_inboxes[index]))
+    logger.info("Worker %s stopped.", index)
+
+
+# --- Ingest process ---
+
+async def _ingest(worker_queues: list, workers: list):
+    """ Routes raw updates (plain dicts, not parsed here) until cancelled or a worker dies. """
+    worker_count = len(worker_queues)
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        await bot.delete_webhook()
+        offset, backoff = None, 1
+        try:
+            while all(worker.is_alive() for worker in workers):
+                try:
+                    updates = await bot.do_api_request("getUpdates", api_kwargs={"offset": offset, "timeout": POLL_TIMEOUT_SECONDS},
+                                                       read_timeout=POLL_TIMEOUT_SECONDS + 10)
+                    backoff = 1
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay); continue
+                except (TimedOut, NetworkError) as e:
+                    logger.warning("getUpdates failed: %s; retrying in %ss", e, backoff)
+                    await asyncio.sleep(backoff); backoff = min(backoff * 2, 30); continue
+                for update in updates:
+                    worker_queues[shard_for_update(update, worker_count)].put(update)
+                    offset = update["update_id"] + 1
+            logger.critical("A worker process died; shutting down.")
+        finally:
+            if offset is not None: # Confirm the routed updates so a restart does not receive them again
+                try: await bot.do_api_request("getUpdates", api_kwargs={"offset": offset, "timeout": 0})
+                except TelegramError as e: logger.warning("Could not confirm the last updates: %s", e)
+
+async def _run_ingest(worker_queues: list, workers: list):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    ingest = asyncio.create_task(_ingest(worker_queues, workers))
+    stop_requested = asyncio.create_task(stop.wait())
+    await asyncio.wait([ingest, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+    stop_requested.cancel()
+    ingest.cancel() # Routing has no await points, so a poll is never half routed
+    with contextlib.suppress(asyncio.CancelledError):
+        await ingest
+
+def run_sharded(worker_count: int):
+    """ Runs the ingest in this process and worker_count handler processes. The database must already be initialized. """
+    mp = multiprocessing.get_context("spawn") # Fresh interpreters: no event loop or SQLite handles inherited from the parent
+    worker_queues = [mp.Queue() for _ in range(worker_count)]
+    bus_inboxes = [mp.Queue() for _ in range(worker_count)]
+    last_activity_times = mp.Array('d', worker_count, lock=False) # One slot per worker, written only by that worker
+    workers = [mp.Process(target=_worker_main, args=(index, worker_queues[index], bus_inboxes, last_activity_times), name=f"worker-{index}")
+               for index in range(worker_count)]
+    for worker in workers: worker.start()
+    try:
+        asyncio.run(_run_ingest(worker_queues, workers))
+    finally:
+        for update_queue in worker_queues: update_queue.put(None)
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT_SECONDS)
+            if worker.is_alive():
+                logger.error("Worker %s did not stop in time; terminating it.", worker.name)
+                worker.terminate()
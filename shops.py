@@ -0,0 +1,141 @@
+# shops.py
+# Multi-shop mode (SHOPS_CONFIG): one process runs an Application per shop, each with its own bot token,
+# admins, SQLite file (or PostgreSQL pool), catalog cache, backups and product photos. Translations,
+# rendered keyboards, the event loop and the to_thread pool are shared by all shops.
+#
+# The shop is never passed around. Each Application is started in its own copy of the context with
+# config_and_utils.current_shop set to its Shop, and everything the application spawns (update processing,
+# jobs, asyncio.to_thread calls) inherits it. db_operations.db_path(), admin_ids(), storage.backend and
+# the other per-shop lookups read it from there.
+#
+# SHOPS_CONFIG names a JSON file with a list of shops, e.g.
+#   [{"name": "north", "token": "123:abc", "admins": [111], "db": "/data/north.db"},
+#    {"name": "south", "token": "456:def", "admins": [222, 333], "database_url": "postgresql://bot@localhost/south"}]
+# "db" defaults to <name>.db next to DB_NAME and is used even with "database_url" (broadcasts, saved carts
+# and maintenance always stay in SQLite, see storage.py). "backup_dir" and "photo_dir" default to
+# backups/<name> and product_photos/<name> next to the shop's database. TELEGRAM_TOKEN, ADMIN_TELEGRAM_ID,
+# STORAGE_BACKEND and DATABASE_URL are not used in this mode.
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import signal
+
+from config_and_utils import DB_NAME, current_shop
+
+import db_operations
+import storage
+
+logger = logging.getLogger(__name__)
+
+SHOP_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+SHOPS = [] # Filled by configure_shops; empty in the single-shop bot
+
+
+class Shop:
+    """ One shop's settings and storage backend. Built by load_shops. """
+
+    def __init__(self, name: str, token: str, admin_ids: list, db_name: str, database_url: str = None,
+                 backup_dir: str = None, photo_dir: str = None):
+        self.name, self.token, self.admin_ids, self.db_name = name, token, admin_ids, db_name
+        base_dir = os.path.dirname(os.path.abspath(db_name))
+        self.backup_dir = backup_dir or os.path.join(base_dir, "backups", name)
+        self.photo_dir = photo_dir or os.path.join(base_dir, "product_photos", name)
+        self.backend = storage.PostgresStorage(database_url) if database_url else storage.SqliteStorage()
+
+    def context(self) -> contextvars.Context:
+        """ A fresh copy of the current context with this shop as current_shop, for tasks and calls on its behalf. """
+        context = contextvars.copy_context()
+        context.run(current_shop.set, self)
+        return context
+
+    def __repr__(self):
+        return f"Shop({self.name!r})"
+
+
+class CurrentShopStorage:
+    """ storage.backend in multi-shop mode: every attribute is looked up on the current shop's backend. """
+
+    def __getattr__(self, name):
+        shop = current_shop.get()
+        if shop is None: raise RuntimeError(f"storage.backend.{name} used outside of a shop's context")
+        return getattr(shop.backend, name)
+
+
+def load_shops(path: str) -> list:
+    """ Shops from a SHOPS_CONFIG file. Raises OSError or ValueError with a message fit for the log. """
+    with open(path, encoding="utf-8") as f:
+        try:
+            entries = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}") from e
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must hold a non-empty list of shops.")
+    shops, taken = [], {}
+    for number, entry in enumerate(entries, 1):
+        name = entry.get("name") if isinstance(entry, dict) else None
+        if not isinstance(name, str) or not SHOP_NAME_PATTERN.match(name):
+            raise ValueError(f"Shop #{number} needs a name made of letters, digits, '-' and '_'.")
+        if not entry.get("token"):
+            raise ValueError(f"Shop '{name}' has no token.")
+        admin_ids = entry.get("admins")
+        if not isinstance(admin_ids, list) or not all(isinstance(admin_id, int) for admin_id in admin_ids):
+            raise ValueError(f"Shop '{name}': admins must be a list of Telegram user ids.")
+        if entry.get("database_url") and storage.asyncpg is None:
+            raise ValueError(f"Shop '{name}' uses database_url, which needs the asyncpg package (pip install asyncpg).")
+        db_name = os.path.abspath(entry.get("db") or os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), f"{name}.db"))
+        for field, value in (("name", name), ("token", entry["token"]), ("database", db_name)):
+            if (field, value) in taken: raise ValueError(f"Shops '{taken[(field, value)]}' and '{name}' have the same {field}.")
+            taken[(field, value)] = name
+        shops.append(Shop(name, entry["token"], admin_ids, db_name, entry.get("database_url"), entry.get("backup_dir"), entry.get("photo_dir")))
+    return shops
+
+def configure_shops(shops: list):
+    """ Makes the shops current for this process: storage.backend from now on follows current_shop. """
+    SHOPS[:] = shops
+    storage.backend = CurrentShopStorage()
+
+def init_shop_databases():
+    for shop in SHOPS:
+        shop.context().run(db_operations.init_db)
+
+
+# --- Running ---
+
+async def _run_shop(shop: Shop, stop: asyncio.Event):
+    """ One shop's Application from start to shutdown. Runs as a task in shop.context(). """
+    import bot
+    application = bot.build_application(token=shop.token)
+    async with application:
+        await application.post_init(application) # Not run by start(); opens the shop's storage backend
+        await application.updater.start_polling()
+        await application.start()
+        logger.info("Shop '%s' started as @%s.", shop.name, application.bot.username)
+        try:
+            await stop.wait()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await application.post_shutdown(application)
+    logger.info("Shop '%s' stopped.", shop.name)
+
+async def _run_shops(shops: list):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    tasks = [asyncio.create_task(_run_shop(shop, stop), name=f"shop-{shop.name}", context=shop.context()) for shop in shops]
+    stop_requested = asyncio.create_task(stop.wait())
+    await asyncio.wait([*tasks, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+    if not stop.is_set(): logger.critical("A shop stopped unexpectedly; shutting down the others.")
+    stop.set()
+    for shop, result in zip(shops, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(result, Exception): logger.critical("Shop '%s' failed: %s", shop.name, result)
+
+def run_shops():
+    """ Runs every configured shop in this process until SIGINT/SIGTERM. The databases must already be initialized. """
+    asyncio.run(_run_shops(SHOPS))
@@ -0,0 +1,1053 @@
+# storage.py
+# Repository interface for users, the catalog and orders (with the sales rollups and the outbox that are
+# written in the same transaction as an order). Handlers, jobs and notifications only talk to `backend`,
+# picked by STORAGE_BACKEND:
+#   sqlite   - SqliteStorage, the db_operations functions on the local file (default)
+#   postgres - PostgresStorage, the same tables on a PostgreSQL server through an asyncpg connection pool
+# Both return the same plain tuples, lists and dicts, and follow the db_operations error convention:
+# database errors are logged and reported as None / False / [] / -1.
+#
+# Broadcast progress, saved carts and maintenance stay in the SQLite file with either backend (see db_operations).
+
+import abc
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config_and_utils import BOT_TZ, DATABASE_URL, DEFAULT_LANGUAGE, PG_POOL_MAX_SIZE, PG_POOL_MIN_SIZE, STORAGE_BACKEND
+
+import db_operations
+
+try:
+    import asyncpg # Optional: only needed for STORAGE_BACKEND=postgres
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ("sqlite", "postgres")
+
+
+class Storage(abc.ABC):
+    """ Each method behaves like the db_operations function SqliteStorage delegates it to. """
+
+    async def open(self):
+        """ Called once the event loop is running, before the first update is handled. """
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    def invalidate_catalog_cache(self, notify: bool = True): ...
+
+    # --- Users ---
+    @abc.abstractmethod
+    async def ensure_user(self, user_id: int, first_name: str, username: str) -> str:
+        """ Creates or refreshes the user and returns their language code. """
+
+    @abc.abstractmethod
+    async def get_user_language(self, user_id: int) -> str | None: ...
+
+    @abc.abstractmethod
+    async def set_user_language(self, user_id: int, lang_code: str): ...
+
+    @abc.abstractmethod
+    async def count_reachable_users(self) -> int: ...
+
+    @abc.abstractmethod
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int) -> list: ...
+
+    @abc.abstractmethod
+    async def mark_users_blocked(self, user_ids: list) -> bool: ...
+
+    @abc.abstractmethod
+    async def get_user_languages(self, user_ids: list) -> dict: ...
+
+    @abc.abstractmethod
+    async def get_staff_roles(self) -> dict | None: ...
+
+    @abc.abstractmethod
+    async def set_user_role(self, user_id: int, role: str | None) -> bool: ...
+
+    # --- Catalog ---
+    @abc.abstractmethod
+    async def get_products(self, available_only: bool = True) -> list: ...
+
+    @abc.abstractmethod
+    async def search_products(self, query_text: str, limit: int = 20, available_only: bool = True) -> list: ...
+
+    @abc.abstractmethod
+    async def get_catalog_page(self, page: int, page_size: int, category_id: int = 0, available_only: bool = True) -> tuple[list, int, int, list, int]: ...
+
+    @abc.abstractmethod
+    async def get_product(self, product_id: int): ...
+
+    @abc.abstractmethod
+    async def get_product_photo_ids(self) -> dict: ...
+
+    @abc.abstractmethod
+    async def add_product(self, name: str, price: float) -> int | None: ...
+
+    @abc.abstractmethod
+    async def update_product(self, product_id: int, name: str = None, price: float = None, is_available: int = None, category_id: int = None) -> bool: ...
+
+    @abc.abstractmethod
+    async def delete_product(self, product_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    async def set_product_photo(self, product_id: int, file_id: str | None) -> bool: ...
+
+    @abc.abstractmethod
+    async def get_categories(self) -> list: ...
+
+    @abc.abstractmethod
+    async def add_category(self, name: str) -> int | None: ...
+
+    @abc.abstractmethod
+    async def bulk_upsert_products(self, rows: list) -> dict | None: ...
+
+    # --- Orders ---
+    @abc.abstractmethod
+    async def save_order(self, user_id: int, user_name: str, cart: list, total_price: float, username: str = None, idempotency_key: str = None,
+                         slot_id: int = None) -> int | None:
+        """ See db_operations.save_order_to_db: returns db_operations.SLOT_FULL when the slot cannot take the order. """
+
+    @abc.abstractmethod
+    async def get_user_orders(self, user_id: int) -> list: ...
+
+    @abc.abstractmethod
+    async def get_reorder_lines(self, order_id: int, user_id: int) -> list: ...
+
+    @abc.abstractmethod
+    async def get_all_orders(self, start_ts: int = None, end_ts: int = None) -> list: ...
+
+    @abc.abstractmethod
+    def iter_order_export_rows(self, batch_size: int):
+        """ Async iterator over lists of at most batch_size db_operations.ORDER_EXPORT_QUERY rows. Errors propagate. """
+
+    @abc.abstractmethod
+    async def get_shopping_list(self) -> list: ...
+
+    @abc.abstractmethod
+    async def delete_completed_orders(self) -> int: ...
+
+    @abc.abstractmethod
+    async def get_orders_by_status(self, statuses: tuple = db_operations.OPEN_ORDER_STATUSES) -> list: ...
+
+    @abc.abstractmethod
+    async def set_orders_status(self, order_ids: list, status: str, notify_customers: bool = False) -> list | None:
+        """ See db_operations.set_orders_status: one set-based UPDATE, returns the changed ids or None on error. """
+
+    async def mark_order_completed(self, order_id: int) -> bool:
+        return bool(await self.set_orders_status([order_id], 'completed'))
+
+    # --- Delivery slots ---
+    @abc.abstractmethod
+    async def ensure_delivery_slots(self, slot_times: list, capacity_orders: int, capacity_kg: float) -> int: ...
+
+    @abc.abstractmethod
+    async def get_available_delivery_slots(self, after_ts: int, weight_kg: float, limit: int) -> list: ...
+
+    @abc.abstractmethod
+    async def get_delivery_slot_overview(self, after_ts: int, limit: int) -> list: ...
+
+    # --- Standing orders ---
+    @abc.abstractmethod
+    async def create_standing_order(self, user_id: int, user_name: str, username: str, cart: list, weekday: int) -> int | None: ...
+
+    @abc.abstractmethod
+    async def get_user_standing_orders(self, user_id: int) -> list: ...
+
+    @abc.abstractmethod
+    async def delete_standing_order(self, standing_id: int, user_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    async def materialize_standing_orders(self, now_ts: int, limit: int = db_operations.STANDING_ORDER_BATCH_SIZE) -> list | None:
+        """ See db_operations.materialize_standing_orders: one transaction per batch of due standing orders. """
+
+    @abc.abstractmethod
+    async def get_sales_stats(self, today: str, week_start: str, month_start: str, top_n: int = 5) -> dict: ...
+
+    @abc.abstractmethod
+    async def rebuild_sales_rollups(self) -> int: ...
+
+    # --- Outbox ---
+    @abc.abstractmethod
+    async def get_due_outbox_events(self, limit: int = 50) -> list: ...
+
+    @abc.abstractmethod
+    async def record_outbox_delivery(self, event_id: int, recipient_id: int, status: str, error: str = None) -> bool: ...
+
+    @abc.abstractmethod
+    async def finish_outbox_event(self, event_id: int, delivered: bool, attempts: int, error: str = None) -> bool: ...
+
+
+class SqliteStorage(Storage):
+    """
+    The db_operations functions. Calls the handlers always made inline (cached catalog reads, single-row
+    statements) still run on the event loop; scans and the background jobs' calls run in a worker thread.
+    """
+
+    def invalidate_catalog_cache(self, notify: bool = True):
+        db_operations.invalidate_catalog_cache(notify)
+
+    async def ensure_user(self, user_id, first_name, username):
+        return await db_operations.ensure_user_exists(user_id, first_name, username, None)
+
+    async def get_user_language(self, user_id):
+        return db_operations.get_user_language_from_db(user_id)
+
+    async def set_user_language(self, user_id, lang_code):
+        await db_operations.set_user_language_db(user_id, lang_code)
+
+    async def count_reachable_users(self):
+        return await asyncio.to_thread(db_operations.count_reachable_users)
+
+    async def get_broadcast_recipients(self, after_user_id, limit):
+        return await asyncio.to_thread(db_operations.get_broadcast_recipients, after_user_id, limit)
+
+    async def mark_users_blocked(self, user_ids):
+        return await asyncio.to_thread(db_operations.mark_users_blocked, user_ids)
+
+    async def get_user_languages(self, user_ids):
+        return await asyncio.to_thread(db_operations.get_user_languages, user_ids)
+
+    async def get_staff_roles(self):
+        return await asyncio.to_thread(db_operations.get_staff_roles)
+
+    async def set_user_role(self, user_id, role):
+        return db_operations.set_user_role(user_id, role)
+
+    async def get_products(self, available_only=True):
+        return db_operations.get_products_from_db(available_only)
+
+    async def search_products(self, query_text, limit=20, available_only=True):
+        return db_operations.search_products_in_db(query_text, limit, available_only)
+
+    async def get_catalog_page(self, page, page_size, category_id=0, available_only=True):
+        return db_operations.get_catalog_page(page, page_size, category_id, available_only)
+
+    async def get_product(self, product_id):
+        return db_operations.get_product_by_id(product_id)
+
+    async def get_product_photo_ids(self):
+        return db_operations.get_product_photo_ids()
+
+    async def add_product(self, name, price):
+        return db_operations.add_product_to_db(name, price)
+
+    async def update_product(self, product_id, name=None, price=None, is_available=None, category_id=None):
+        return db_operations.update_product_in_db(product_id, name, price, is_available, category_id)
+
+    async def delete_product(self, product_id):
+        return db_operations.delete_product_from_db(product_id)
+
+    async def set_product_photo(self, product_id, file_id):
+        return db_operations.set_product_photo(product_id, file_id)
+
+    async def get_categories(self):
+        return db_operations.get_categories_from_db()
+
+    async def add_category(self, name):
+        return db_operations.add_category_to_db(name)
+
+    async def bulk_upsert_products(self, rows):
+        return await asyncio.to_thread(db_operations.bulk_upsert_products, rows)
+
+    async def save_order(self, user_id, user_name, cart, total_price, username=None, idempotency_key=None, slot_id=None):
+        return db_operations.save_order_to_db(user_id, user_name, cart, total_price, username=username, idempotency_key=idempotency_key, slot_id=slot_id)
+
+    async def get_user_orders(self, user_id):
+        return db_operations.get_user_orders_from_db(user_id)
+
+    async def get_reorder_lines(self, order_id, user_id):
+        return db_operations.get_reorder_lines(order_id, user_id)
+
+    async def get_all_orders(self, start_ts=None, end_ts=None):
+        return db_operations.get_all_orders_from_db(start_ts, end_ts)
+
+    async def iter_order_export_rows(self, batch_size):
+        # A sqlite3 connection may only be used by the thread that opened it, so the whole
+        # generator (connect, every fetch, close) runs on one dedicated thread, in this task's context so
+        # db_operations.db_path() resolves the same shop there (run_in_executor does not copy it).
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        rows = db_operations.iter_order_export_rows(batch_size)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="export") as executor:
+            try:
+                while batch := await loop.run_in_executor(executor, context.run, lambda: list(itertools.islice(rows, batch_size))):
+                    yield batch
+            finally:
+                await loop.run_in_executor(executor, context.run, rows.close)
+
+    async def get_shopping_list(self):
+        return db_operations.get_shopping_list_from_db()
+
+    async def delete_completed_orders(self):
+        return db_operations.delete_completed_orders_from_db()
+
+    async def get_orders_by_status(self, statuses=db_operations.OPEN_ORDER_STATUSES):
+        return db_operations.get_orders_by_status(statuses)
+
+    async def set_orders_status(self, order_ids, status, notify_customers=False):
+        return await asyncio.to_thread(db_operations.set_orders_status, order_ids, status, notify_customers)
+
+    async def ensure_delivery_slots(self, slot_times, capacity_orders, capacity_kg):
+        return db_operations.ensure_delivery_slots(slot_times, capacity_orders, capacity_kg)
+
+    async def get_available_delivery_slots(self, after_ts, weight_kg, limit):
+        return db_operations.get_available_delivery_slots(after_ts, weight_kg, limit)
+
+    async def get_delivery_slot_overview(self, after_ts, limit):
+        return db_operations.get_delivery_slot_overview(after_ts, limit)
+
+    async def create_standing_order(self, user_id, user_name, username, cart, weekday):
+        return db_operations.create_standing_order(user_id, user_name, username, cart, weekday)
+
+    async def get_user_standing_orders(self, user_id):
+        return db_operations.get_user_standing_orders(user_id)
+
+    async def delete_standing_order(self, standing_id, user_id):
+        return db_operations.delete_standing_order(standing_id, user_id)
+
+    async def materialize_standing_orders(self, now_ts, limit=db_operations.STANDING_ORDER_BATCH_SIZE):
+        return await asyncio.to_thread(db_operations.materialize_standing_orders, now_ts, limit)
+
+    async def get_sales_stats(self, today, week_start, month_start, top_n=5):
+        return db_operations.get_sales_stats(today, week_start, month_start, top_n)
+
+    async def rebuild_sales_rollups(self):
+        return await asyncio.to_thread(db_operations.rebuild_sales_rollups)
+
+    async def get_due_outbox_events(self, limit=50):
+        return await asyncio.to_thread(db_operations.get_due_outbox_events, limit)
+
+    async def record_outbox_delivery(self, event_id, recipient_id, status, error=None):
+        return await asyncio.to_thread(db_operations.record_outbox_delivery, event_id, recipient_id, status, error)
+
+    async def finish_outbox_event(self, event_id, delivered, attempts, error=None):
+        return await asyncio.to_thread(db_operations.finish_outbox_event, event_id, delivered, attempts, error)
+
+
+# Same tables and columns as db_operations.init_db, so rows come back in the same shape. Telegram ids are BIGINT.
+# There is no FTS5 index here: search matches word prefixes of lower(name) with a regex, without diacritic folding.
+POSTGRES_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT, is_admin INTEGER DEFAULT 0,
+    language_code TEXT DEFAULT '{DEFAULT_LANGUAGE}', is_blocked INTEGER DEFAULT 0
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT;
+CREATE TABLE IF NOT EXISTS categories (id SERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, sort_order INTEGER DEFAULT 0);
+CREATE TABLE IF NOT EXISTS products (
+    id SERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, price_per_kg DOUBLE PRECISION NOT NULL, is_available INTEGER DEFAULT 1,
+    category_id INTEGER REFERENCES categories (id), photo_file_id TEXT
+);
+CREATE TABLE IF NOT EXISTS orders (
+    id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, user_name TEXT, order_date TEXT NOT NULL, order_ts BIGINT NOT NULL,
+    total_price DOUBLE PRECISION NOT NULL, status TEXT DEFAULT 'pending', items_summary TEXT, items_json TEXT, idempotency_key TEXT UNIQUE
+);
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS slot_id INTEGER;
+CREATE INDEX IF NOT EXISTS idx_orders_user_ts ON orders (user_id, order_ts);
+CREATE INDEX IF NOT EXISTS idx_orders_ts ON orders (order_ts);
+CREATE TABLE IF NOT EXISTS delivery_slots (
+    id SERIAL PRIMARY KEY, start_ts BIGINT NOT NULL UNIQUE, end_ts BIGINT NOT NULL, capacity_orders INTEGER NOT NULL,
+    capacity_kg DOUBLE PRECISION NOT NULL, booked_orders INTEGER NOT NULL DEFAULT 0, booked_kg DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS order_items (
+    id SERIAL PRIMARY KEY, order_id INTEGER NOT NULL REFERENCES orders (id), product_id INTEGER NOT NULL,
+    quantity_kg DOUBLE PRECISION NOT NULL, price_at_order DOUBLE PRECISION NOT NULL, product_name TEXT, unit TEXT DEFAULT 'kg'
+);
+CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id);
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day TEXT PRIMARY KEY, orders_count INTEGER NOT NULL DEFAULT 0, revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    completed_count INTEGER NOT NULL DEFAULT 0, completed_revenue DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sales_daily_product (
+    day TEXT NOT NULL, product_name TEXT NOT NULL, orders_count INTEGER NOT NULL DEFAULT 0,
+    quantity_kg DOUBLE PRECISION NOT NULL DEFAULT 0, revenue DOUBLE PRECISION NOT NULL DEFAULT 0, PRIMARY KEY (day, product_name)
+);
+CREATE TABLE IF NOT EXISTS sales_purged_daily (
+    day TEXT PRIMARY KEY, orders_count INTEGER NOT NULL DEFAULT 0, revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    completed_count INTEGER NOT NULL DEFAULT 0, completed_revenue DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sales_purged_daily_product (
+    day TEXT NOT NULL, product_name TEXT NOT NULL, orders_count INTEGER NOT NULL DEFAULT 0,
+    quantity_kg DOUBLE PRECISION NOT NULL DEFAULT 0, revenue DOUBLE PRECISION NOT NULL DEFAULT 0, PRIMARY KEY (day, product_name)
+);
+CREATE TABLE IF NOT EXISTS standing_orders (
+    id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, user_name TEXT, username TEXT, items_json TEXT NOT NULL, items_summary TEXT,
+    weekday INTEGER NOT NULL, next_run_ts BIGINT NOT NULL, created_ts BIGINT NOT NULL, last_order_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_standing_orders_next_run ON standing_orders (next_run_ts);
+CREATE INDEX IF NOT EXISTS idx_standing_orders_user ON standing_orders (user_id);
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY, event_type TEXT NOT NULL, payload TEXT NOT NULL, created_ts BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt_ts BIGINT NOT NULL, last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_ts);
+CREATE TABLE IF NOT EXISTS outbox_deliveries (
+    event_id BIGINT NOT NULL, recipient_id BIGINT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+    delivered_ts BIGINT, last_error TEXT, PRIMARY KEY (event_id, recipient_id)
+);
+"""
+SCHEMA_LOCK_KEY = 7_310_042 # pg_advisory_xact_lock key, so sharded workers starting together do not race on CREATE TABLE
+
+_DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) if asyncpg else ()
+
+def _tuples(records) -> list:
+    return [tuple(record) for record in records]
+
+def _rowcount(status: str) -> int:
+    """ Row count from an asyncpg command status such as 'UPDATE 3'. """
+    return int(status.rsplit(" ", 1)[-1])
+
+# Rollup rows aggregated in SQL, the same as accumulate_sales_rollups: $1 is the BOT_TZ name, so days are local.
+# Each takes a condition on orders o; cancelled orders are not sales.
+_PG_ROLLUP_DAY = "to_char(to_timestamp(o.order_ts) AT TIME ZONE $1, 'YYYY-MM-DD')"
+_PG_DAILY_ROLLUP = (f"SELECT {_PG_ROLLUP_DAY} AS day, COUNT(*) AS orders_count, SUM(o.total_price) AS revenue, "
+                    "COUNT(*) FILTER (WHERE o.status = 'completed') AS completed_count, "
+                    "COALESCE(SUM(o.total_price) FILTER (WHERE o.status = 'completed'), 0) AS completed_revenue "
+                    "FROM orders o WHERE o.status != 'cancelled' AND {} GROUP BY 1")
+_PG_PRODUCT_ROLLUP = (f"SELECT {_PG_ROLLUP_DAY} AS day, oi.product_name, COUNT(*) AS orders_count, SUM(oi.quantity_kg) AS quantity_kg, "
+                      "SUM(oi.quantity_kg * oi.price_at_order) AS revenue FROM orders o JOIN order_items oi ON oi.order_id = o.id "
+                      "WHERE o.status != 'cancelled' AND oi.product_name IS NOT NULL AND {} GROUP BY 1, 2")
+
+def _pg_timezone() -> str:
+    return getattr(BOT_TZ, 'key', 'UTC') # ZoneInfo name, or the UTC fallback of config_and_utils
+
+class _SlotFull(Exception):
+    """ Raised inside a checkout transaction to roll it back when the delivery slot has no room. """
+
+
+class PostgresStorage(Storage):
+    """
+    asyncpg connection pool opened in open(). Catalog reads are cached in-process exactly like db_operations,
+    and invalidations reach the same catalog_invalidation_listeners (other workers in multi-process mode).
+    """
+
+    def __init__(self, dsn: str, min_size: int = PG_POOL_MIN_SIZE, max_size: int = PG_POOL_MAX_SIZE, **pool_options):
+        """ pool_options go to asyncpg.create_pool, e.g. server_settings={'search_path': 'staging'}. """
+        self.dsn, self.min_size, self.max_size, self.pool_options = dsn, min_size, max_size, pool_options
+        self.pool = None
+        self._catalog_cache = {}
+        self._search_cache = {}
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size, **self.pool_options)
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_KEY)
+            await conn.execute(POSTGRES_SCHEMA)
+        logger.info("PostgreSQL storage ready (pool of %s-%s connections).", self.min_size, self.max_size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def invalidate_catalog_cache(self, notify: bool = True):
+        self._catalog_cache.clear()
+        self._search_cache.clear()
+        if notify:
+            for listener in db_operations.catalog_invalidation_listeners: listener()
+
+    # --- Users ---
+    async def ensure_user(self, user_id, first_name, username):
+        try:
+            # One round trip: the upsert returns the stored language, or the default for a new user.
+            current_lang = await self.pool.fetchval("""
+                INSERT INTO users (telegram_id, first_name, username, language_code) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (telegram_id) DO UPDATE SET first_name = EXCLUDED.first_name, username = EXCLUDED.username,
+                    is_blocked = 0, language_code = COALESCE(users.language_code, EXCLUDED.language_code)
+                RETURNING language_code
+            """, user_id, first_name, username, DEFAULT_LANGUAGE)
+            logger.info("User %s ensured in DB. Lang: %s", user_id, current_lang)
+            return current_lang
+        except _DB_ERRORS as e:
+            logger.error("DB error in ensure_user for user %s: %s", user_id, e)
+            return DEFAULT_LANGUAGE
+
+    async def get_user_language(self, user_id):
+        try:
+            return await self.pool.fetchval("SELECT language_code FROM users WHERE telegram_id = $1", user_id)
+        except _DB_ERRORS as e:
+            logger.error("DB error in get_user_language for user %s: %s", user_id, e)
+            return None
+
+    async def set_user_language(self, user_id, lang_code):
+        try:
+            await self.pool.execute("UPDATE users SET language_code = $1 WHERE telegram_id = $2", lang_code, user_id)
+            logger.info("User %s language set to %s in DB.", user_id, lang_code)
+        except _DB_ERRORS as e:
+            logger.error("DB error in set_user_language for user %s: %s", user_id, e)
+
+    async def count_reachable_users(self):
+        try:
+            return await self.pool.fetchval("SELECT COUNT(*) FROM users WHERE is_blocked = 0")
+        except _DB_ERRORS as e:
+            logger.error("DB error counting reachable users: %s", e)
+            return 0
+
+    async def get_broadcast_recipients(self, after_user_id, limit):
+        try:
+            records = await self.pool.fetch("SELECT telegram_id FROM users WHERE telegram_id > $1 AND is_blocked = 0 ORDER BY telegram_id LIMIT $2", after_user_id, limit)
+            return [record[0] for record in records]
+        except _DB_ERRORS as e:
+            logger.error("DB error reading broadcast recipients after %s: %s", after_user_id, e)
+            return []
+
+    async def mark_users_blocked(self, user_ids):
+        try:
+            await self.pool.execute("UPDATE users SET is_blocked = 1 WHERE telegram_id = ANY($1::bigint[])", list(user_ids))
+            return True
+        except _DB_ERRORS as e:
+            logger.error("DB error marking %s users as blocked: %s", len(user_ids), e)
+            return False
+
+    async def get_user_languages(self, user_ids):
+        try:
+            records = await self.pool.fetch("SELECT telegram_id, language_code FROM users WHERE telegram_id = ANY($1::bigint[])", list(user_ids))
+            return {record[0]: record[1] for record in records if record[1]}
+        except _DB_ERRORS as e:
+            logger.error("DB error reading the languages of %s users: %s", len(user_ids), e)
+            return {}
+
+    async def get_staff_roles(self):
+        try:
+            return dict(_tuples(await self.pool.fetch("SELECT telegram_id, role FROM users WHERE role IS NOT NULL")))
+        except _DB_ERRORS as e:
+            logger.error("DB error reading staff roles: %s", e)
+            return None
+
+    async def set_user_role(self, user_id, role):
+        try:
+            await self.pool.execute("""
+                INSERT INTO users (telegram_id, role) VALUES ($1, $2) ON CONFLICT (telegram_id) DO UPDATE SET role = EXCLUDED.role
+            """, user_id, role)
+            logger.info("User %s role set to %s.", user_id, role)
+            return True
+        except _DB_ERRORS as e:
+            logger.error("DB error setting the role of user %s: %s", user_id, e)
+            return False
+
+    # --- Catalog ---
+    async def get_products(self, available_only=True):
+        if available_only in self._catalog_cache:
+            return self._catalog_cache[available_only]
+        query = "SELECT id, name, price_per_kg, is_available FROM products"
+        if available_only: query += " WHERE is_available = 1"
+        try:
+            products = _tuples(await self.pool.fetch(query + " ORDER BY name"))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting products: %s", e)
+            return []
+        self._catalog_cache[available_only] = products
+        return products
+
+    async def search_products(self, query_text, limit=20, available_only=True):
+        terms = re.findall(r"\w+", query_text.lower())
+        if not terms: return []
+        cache_key = (" ".join(terms), limit, available_only)
+        if cache_key in self._search_cache:
+            return self._search_cache[cache_key]
+        # Every term must start a word (\m), like the FTS5 prefix query; terms are \w+ so they are regex-safe.
+        conditions = " AND ".join(f"lower(name) ~ ${i}" for i in range(1, len(terms) + 1))
+        if available_only: conditions += " AND is_available = 1"
+        try:
+            results = _tuples(await self.pool.fetch(f"SELECT id, name, price_per_kg, is_available FROM products WHERE {conditions} ORDER BY name LIMIT ${len(terms) + 1}",
+                                                    *(rf"\m{term}" for term in terms), limit))
+        except _DB_ERRORS as e:
+            logger.error("DB error searching products for '%s': %s", query_text, e)
+            return []
+        if len(self._search_cache) >= db_operations.SEARCH_CACHE_MAX_ENTRIES: self._search_cache.clear()
+        self._search_cache[cache_key] = results
+        return results
+
+    async def _get_catalog_index(self, available_only: bool) -> dict:
+        cache_key = ('index', available_only)
+        if cache_key in self._catalog_cache:
+            return self._catalog_cache[cache_key]
+        index = {'categories': [], 'by_category': {0: []}}
+        query = "SELECT id, name, price_per_kg, is_available, category_id FROM products"
+        if available_only: query += " WHERE is_available = 1"
+        try:
+            async with self.pool.acquire() as conn:
+                product_rows = await conn.fetch(query + " ORDER BY name")
+                category_rows = await conn.fetch("SELECT id, name FROM categories ORDER BY sort_order, name")
+        except _DB_ERRORS as e:
+            logger.error("DB error building catalog index: %s", e)
+            return index
+        for pid, name, price, avail, category_id in product_rows:
+            product = (pid, name, price, avail)
+            index['by_category'][0].append(product)
+            if category_id: index['by_category'].setdefault(category_id, []).append(product)
+        index['categories'] = [(cid, cname) for cid, cname in category_rows if cid in index['by_category']]
+        self._catalog_cache[cache_key] = index
+        return index
+
+    async def get_catalog_page(self, page, page_size, category_id=0, available_only=True):
+        return db_operations.slice_catalog_page(await self._get_catalog_index(available_only), page, page_size, category_id)
+
+    async def get_product(self, product_id):
+        try:
+            record = await self.pool.fetchrow("SELECT id, name, price_per_kg, is_available, category_id FROM products WHERE id = $1", product_id)
+        except _DB_ERRORS as e:
+            logger.error("DB error getting product by ID %s: %s", product_id, e)
+            return None
+        return tuple(record) if record else None
+
+    async def get_product_photo_ids(self):
+        if 'photos' in self._catalog_cache:
+            return self._catalog_cache['photos']
+        try:
+            photo_ids = dict(_tuples(await self.pool.fetch("SELECT id, photo_file_id FROM products WHERE photo_file_id IS NOT NULL")))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting product photo ids: %s", e)
+            return {}
+        self._catalog_cache['photos'] = photo_ids
+        return photo_ids
+
+    async def add_product(self, name, price):
+        try:
+            product_id = await self.pool.fetchval("INSERT INTO products (name, price_per_kg) VALUES ($1, $2) RETURNING id", name, price)
+        except asyncpg.UniqueViolationError:
+            logger.warning("Attempted to add duplicate product name: %s", name)
+            return None
+        except _DB_ERRORS as e:
+            logger.error("DB error adding product %s: %s", name, e)
+            return None
+        self.invalidate_catalog_cache()
+        logger.info("Product '%s' added to DB.", name)
+        return product_id
+
+    async def update_product(self, product_id, name=None, price=None, is_available=None, category_id=None):
+        changes = []
+        if name is not None: changes.append(("name", name))
+        if price is not None: changes.append(("price_per_kg", price))
+        if is_available is not None: changes.append(("is_available", is_available))
+        if category_id is not None: changes.append(("category_id", category_id or None))
+        if not changes: return False
+        fields = [f"{column} = ${i}" for i, (column, _value) in enumerate(changes, 1)]
+        params = [value for _column, value in changes] + [product_id]
+        try:
+            updated = _rowcount(await self.pool.execute(f"UPDATE products SET {', '.join(fields)} WHERE id = ${len(params)}", *params))
+        except _DB_ERRORS as e:
+            logger.error("DB error updating product %s: %s", product_id, e)
+            return False
+        if updated:
+            self.invalidate_catalog_cache()
+            logger.info("Product %s updated in DB. Fields: %s", product_id, fields)
+        return updated > 0
+
+    async def delete_product(self, product_id):
+        try:
+            deleted = _rowcount(await self.pool.execute("DELETE FROM products WHERE id = $1", product_id))
+        except _DB_ERRORS as e:
+            logger.error("DB error deleting product %s: %s", product_id, e)
+            return False
+        if deleted:
+            self.invalidate_catalog_cache()
+            logger.info("Product %s deleted from DB.", product_id)
+        return deleted > 0
+
+    async def set_product_photo(self, product_id, file_id):
+        try:
+            updated = _rowcount(await self.pool.execute("UPDATE products SET photo_file_id = $1 WHERE id = $2", file_id, product_id))
+        except _DB_ERRORS as e:
+            logger.error("DB error setting photo for product %s: %s", product_id, e)
+            return False
+        if updated: self.invalidate_catalog_cache()
+        return updated > 0
+
+    async def get_categories(self):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, name FROM categories ORDER BY sort_order, name"))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting categories: %s", e)
+            return []
+
+    async def add_category(self, name):
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute("INSERT INTO categories (name) VALUES ($1) ON CONFLICT (name) DO NOTHING", name)
+                category_id = await conn.fetchval("SELECT id FROM categories WHERE name = $1", name)
+        except _DB_ERRORS as e:
+            logger.error("DB error adding category %s: %s", name, e)
+            return None
+        self.invalidate_catalog_cache()
+        logger.info("Category '%s' ensured in DB (id %s).", name, category_id)
+        return category_id
+
+    async def bulk_upsert_products(self, rows):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                await conn.executemany("INSERT INTO categories (name) VALUES ($1) ON CONFLICT (name) DO NOTHING", {(cname,) for *_fields, cname in rows if cname})
+                category_ids = dict(_tuples(await conn.fetch("SELECT name, id FROM categories")))
+                current_products = await conn.fetch("SELECT name, price_per_kg, is_available, category_id FROM products")
+                added, updated, to_write = db_operations.plan_bulk_upsert(rows, category_ids, current_products)
+                await conn.executemany("""
+                    INSERT INTO products (name, price_per_kg, is_available, category_id) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (name) DO UPDATE SET price_per_kg = EXCLUDED.price_per_kg, is_available = EXCLUDED.is_available, category_id = EXCLUDED.category_id
+                """, to_write)
+        except _DB_ERRORS as e:
+            logger.error("DB error during bulk product import (%s rows): %s", len(rows), e)
+            return None
+        if to_write: self.invalidate_catalog_cache()
+        logger.info("Bulk product import: %s added, %s updated, %s unchanged.", len(added), len(updated), len(rows) - len(to_write))
+        return {'added': added, 'updated': updated, 'unchanged': len(rows) - len(to_write)}
+
+    # --- Orders ---
+    @staticmethod
+    async def _insert_order(conn, user_id, user_name, items, total_price, order_ts, idempotency_key=None, slot_id=None):
+        """ Order row, lines and rollup deltas in the caller's transaction, as db_operations._insert_order. None if the idempotency key exists. """
+        order_date = datetime.fromtimestamp(order_ts).strftime("%Y-%m-%d %H:%M:%S")
+        day = db_operations.rollup_day(order_ts)
+        # A concurrent checkout of the same cart waits on the unique key here and then inserts nothing.
+        order_id = await conn.fetchval("""
+            INSERT INTO orders (user_id, user_name, order_date, order_ts, total_price, status, items_summary, items_json, idempotency_key, slot_id)
+            VALUES ($1, $2, $3, $4, $5, 'pending', $6, $7, $8, $9) ON CONFLICT (idempotency_key) DO NOTHING RETURNING id
+        """, user_id, user_name, order_date, order_ts, total_price,
+            db_operations.format_order_items_summary(items), json.dumps(items, ensure_ascii=False), idempotency_key, slot_id)
+        if order_id is None: return None
+        await conn.executemany("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order, product_name, unit) VALUES ($1, $2, $3, $4, $5, $6)",
+                               [(order_id, item['id'], item['quantity'], item['price'], item['name'], item['unit']) for item in items])
+        await conn.execute("""
+            INSERT INTO sales_daily (day, orders_count, revenue) VALUES ($1, 1, $2)
+            ON CONFLICT (day) DO UPDATE SET orders_count = sales_daily.orders_count + 1, revenue = sales_daily.revenue + EXCLUDED.revenue
+        """, day, total_price)
+        await conn.executemany("""
+            INSERT INTO sales_daily_product (day, product_name, orders_count, quantity_kg, revenue) VALUES ($1, $2, 1, $3, $4)
+            ON CONFLICT (day, product_name) DO UPDATE SET orders_count = sales_daily_product.orders_count + 1,
+                quantity_kg = sales_daily_product.quantity_kg + EXCLUDED.quantity_kg, revenue = sales_daily_product.revenue + EXCLUDED.revenue
+        """, [(day, item['name'], item['quantity'], item['price'] * item['quantity']) for item in items])
+        return order_id
+
+    async def save_order(self, user_id, user_name, cart, total_price, username=None, idempotency_key=None, slot_id=None):
+        order_ts = int(time.time())
+        items = db_operations.snapshot_order_items(cart)
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    order_id = await self._insert_order(conn, user_id, user_name, items, total_price, order_ts, idempotency_key, slot_id)
+                    if order_id is not None:
+                        slot = None
+                        if slot_id is not None:
+                            # Reserved after the insert, so a duplicate checkout never books the slot twice; the row lock serializes checkouts.
+                            weight_kg = db_operations.order_weight_kg(items)
+                            row = await conn.fetchrow("UPDATE delivery_slots SET booked_orders = booked_orders + 1, booked_kg = booked_kg + $1 "
+                                                      "WHERE id = $2 AND start_ts > $3 AND booked_orders < capacity_orders AND booked_kg + $1 <= capacity_kg RETURNING start_ts, end_ts",
+                                                      weight_kg, slot_id, db_operations.slot_booking_cutoff(order_ts))
+                            if row is None: raise _SlotFull()
+                            slot = {'start_ts': row['start_ts'], 'end_ts': row['end_ts']}
+                        payload = {'order_id': order_id, 'user_id': user_id, 'user_name': user_name, 'username': username, 'items': items,
+                                   'total_price': total_price, 'slot': slot}
+                        await conn.execute("INSERT INTO outbox (event_type, payload, created_ts, next_attempt_ts) VALUES ($1, $2, $3, $3)",
+                                           'order_created', json.dumps(payload, ensure_ascii=False), order_ts)
+                if order_id is None:
+                    order_id = await conn.fetchval("SELECT id FROM orders WHERE idempotency_key = $1", idempotency_key)
+                    logger.info("Duplicate checkout for user %s ignored, order %s already saved.", user_id, order_id)
+                    return order_id
+        except _SlotFull:
+            logger.info("Slot %s cannot take the order of user %s.", slot_id, user_id)
+            return db_operations.SLOT_FULL
+        except _DB_ERRORS as e:
+            logger.error("Error saving order for user %s: %s", user_id, e)
+            return None
+        logger.info("Order %s for user %s saved to DB.", order_id, user_id)
+        return order_id
+
+    async def get_user_orders(self, user_id):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, order_ts, total_price, status, items_summary FROM orders WHERE user_id = $1 ORDER BY order_ts DESC", user_id))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting orders for user %s: %s", user_id, e)
+            return []
+
+    async def get_reorder_lines(self, order_id, user_id):
+        try:
+            return _tuples(await self.pool.fetch("""
+                SELECT oi.product_id, oi.product_name, oi.quantity_kg, oi.price_at_order, p.name, p.price_per_kg, p.is_available
+                FROM orders o
+                JOIN order_items oi ON oi.order_id = o.id
+                LEFT JOIN products p ON p.id = oi.product_id
+                WHERE o.id = $1 AND o.user_id = $2
+                ORDER BY oi.id
+            """, order_id, user_id))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting reorder lines for order %s: %s", order_id, e)
+            return []
+
+    async def get_all_orders(self, start_ts=None, end_ts=None):
+        conditions, params = [], []
+        if start_ts is not None: params.append(start_ts); conditions.append(f"order_ts >= ${len(params)}")
+        if end_ts is not None: params.append(end_ts); conditions.append(f"order_ts < ${len(params)}")
+        query = "SELECT id, user_id, user_name, order_ts, total_price, status, items_json FROM orders"
+        if conditions: query += " WHERE " + " AND ".join(conditions)
+        try:
+            records = await self.pool.fetch(query + " ORDER BY order_ts DESC", *params)
+        except _DB_ERRORS as e:
+            logger.error("DB error getting all orders: %s", e)
+            return []
+        return [(oid, cust_id, uname, date_val, total_val, status_val, db_operations.format_admin_items_details(items_json))
+                for oid, cust_id, uname, date_val, total_val, status_val, items_json in records]
+
+    async def iter_order_export_rows(self, batch_size):
+        # Server-side cursor: only one batch is held in memory at a time.
+        async with self.pool.acquire() as conn, conn.transaction():
+            cursor = await conn.cursor(db_operations.ORDER_EXPORT_QUERY)
+            while batch := await cursor.fetch(batch_size):
+                yield _tuples(batch)
+
+    async def get_shopping_list(self):
+        try:
+            return _tuples(await self.pool.fetch("SELECT oi.product_name, SUM(oi.quantity_kg) AS total_quantity FROM order_items oi JOIN orders o ON oi.order_id = o.id "
+                                                 "WHERE o.status IN ('pending','confirmed') GROUP BY oi.product_name ORDER BY oi.product_name"))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting shopping list: %s", e)
+            return []
+
+    async def delete_completed_orders(self):
+        """ As db_operations.delete_completed_orders_from_db: the orders' rollup totals move to sales_purged_daily*. """
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                # Locked, so no order changes status between adding up its totals and deleting it.
+                order_ids = [row[0] for row in await conn.fetch("SELECT id FROM orders WHERE status = 'completed' ORDER BY id FOR UPDATE")]
+                if not order_ids: return 0
+                await conn.execute(f"""
+                    INSERT INTO sales_purged_daily (day, orders_count, revenue, completed_count, completed_revenue)
+                    {_PG_DAILY_ROLLUP.format("o.id = ANY($2::integer[])")}
+                    ON CONFLICT (day) DO UPDATE SET orders_count = sales_purged_daily.orders_count + EXCLUDED.orders_count,
+                        revenue = sales_purged_daily.revenue + EXCLUDED.revenue, completed_count = sales_purged_daily.completed_count + EXCLUDED.completed_count,
+                        completed_revenue = sales_purged_daily.completed_revenue + EXCLUDED.completed_revenue
+                """, _pg_timezone(), order_ids)
+                await conn.execute(f"""
+                    INSERT INTO sales_purged_daily_product (day, product_name, orders_count, quantity_kg, revenue)
+                    {_PG_PRODUCT_ROLLUP.format("o.id = ANY($2::integer[])")}
+                    ON CONFLICT (day, product_name) DO UPDATE SET orders_count = sales_purged_daily_product.orders_count + EXCLUDED.orders_count,
+                        quantity_kg = sales_purged_daily_product.quantity_kg + EXCLUDED.quantity_kg, revenue = sales_purged_daily_product.revenue + EXCLUDED.revenue
+                """, _pg_timezone(), order_ids)
+                await conn.execute("DELETE FROM order_items WHERE order_id = ANY($1::integer[])", order_ids)
+                deleted_count = _rowcount(await conn.execute("DELETE FROM orders WHERE id = ANY($1::integer[])", order_ids))
+        except _DB_ERRORS as e:
+            logger.error("DB error deleting completed orders: %s", e)
+            return -1
+        if deleted_count: logger.info("Deleted %s completed orders from DB.", deleted_count)
+        return deleted_count
+
+    async def get_orders_by_status(self, statuses=db_operations.OPEN_ORDER_STATUSES):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, user_id, user_name, order_ts, total_price, status FROM orders WHERE status = ANY($1::text[]) ORDER BY order_ts, id",
+                                                 list(statuses)))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting %s orders: %s", "/".join(statuses), e)
+            return []
+
+    async def set_orders_status(self, order_ids, status, notify_customers=False):
+        from_statuses = db_operations.ORDER_STATUS_TRANSITIONS[status]
+        if not order_ids: return []
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                changed = _tuples(await conn.fetch("UPDATE orders SET status = $1 WHERE id = ANY($2::int[]) AND status = ANY($3::text[]) "
+                                                   "RETURNING id, user_id, order_ts, total_price, items_json, slot_id", status, list(order_ids), list(from_statuses)))
+                daily_deltas, product_deltas = db_operations.status_rollup_deltas(status, changed)
+                await conn.executemany("UPDATE delivery_slots SET booked_orders = booked_orders - $1, booked_kg = booked_kg - $2 WHERE id = $3",
+                                       db_operations.slot_release_deltas(status, changed))
+                await conn.executemany("UPDATE sales_daily SET orders_count = orders_count + $1, revenue = revenue + $2, completed_count = completed_count + $3, "
+                                       "completed_revenue = completed_revenue + $4 WHERE day = $5", daily_deltas)
+                await conn.executemany("UPDATE sales_daily_product SET orders_count = orders_count + $1, quantity_kg = quantity_kg + $2, revenue = revenue + $3 "
+                                       "WHERE day = $4 AND product_name = $5", product_deltas)
+                if notify_customers and changed:
+                    now = int(time.time())
+                    await conn.executemany("INSERT INTO outbox (event_type, payload, created_ts, next_attempt_ts) VALUES ($1, $2, $3, $3)",
+                                           [('order_status_changed', json.dumps({'order_id': order_id, 'user_id': user_id, 'status': status}), now)
+                                            for order_id, user_id, *_rest in changed])
+        except _DB_ERRORS as e:
+            logger.error("DB error setting %s orders to '%s': %s", len(order_ids), status, e)
+            return None
+        logger.info("%s of %s orders set to '%s'.", len(changed), len(order_ids), status)
+        return [row[0] for row in changed]
+
+    # --- Delivery slots ---
+    async def ensure_delivery_slots(self, slot_times, capacity_orders, capacity_kg):
+        try:
+            async with self.pool.acquire() as conn:
+                inserted = await conn.fetch("INSERT INTO delivery_slots (start_ts, end_ts, capacity_orders, capacity_kg) "
+                                            "SELECT start_ts, end_ts, $3, $4 FROM unnest($1::bigint[], $2::bigint[]) AS slot (start_ts, end_ts) "
+                                            "ON CONFLICT (start_ts) DO NOTHING RETURNING id",
+                                            [start_ts for start_ts, _end_ts in slot_times], [end_ts for _start_ts, end_ts in slot_times],
+                                            capacity_orders, capacity_kg)
+        except _DB_ERRORS as e:
+            logger.error("DB error creating delivery slots: %s", e)
+            return 0
+        return len(inserted)
+
+    async def get_available_delivery_slots(self, after_ts, weight_kg, limit):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, start_ts, end_ts FROM delivery_slots WHERE start_ts > $1 AND booked_orders < capacity_orders "
+                                                 "AND booked_kg + $2 <= capacity_kg ORDER BY start_ts LIMIT $3", after_ts, weight_kg, limit))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting delivery slots: %s", e)
+            return []
+
+    async def get_delivery_slot_overview(self, after_ts, limit):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, start_ts, end_ts, booked_orders, capacity_orders, booked_kg, capacity_kg FROM delivery_slots "
+                                                 "WHERE end_ts > $1 ORDER BY start_ts LIMIT $2", after_ts, limit))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting delivery slot overview: %s", e)
+            return []
+
+    # --- Standing orders ---
+    async def create_standing_order(self, user_id, user_name, username, cart, weekday):
+        items = db_operations.snapshot_order_items(cart)
+        now = int(time.time())
+        try:
+            standing_id = await self.pool.fetchval("""
+                INSERT INTO standing_orders (user_id, user_name, username, items_json, items_summary, weekday, next_run_ts, created_ts)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id
+            """, user_id, user_name, username, json.dumps(items, ensure_ascii=False), db_operations.format_order_items_summary(items),
+                weekday, db_operations.next_weekly_run(weekday, now), now)
+        except _DB_ERRORS as e:
+            logger.error("DB error creating standing order for user %s: %s", user_id, e)
+            return None
+        logger.info("Standing order %s created for user %s (weekday %s).", standing_id, user_id, weekday)
+        return standing_id
+
+    async def get_user_standing_orders(self, user_id):
+        try:
+            return _tuples(await self.pool.fetch("SELECT id, weekday, next_run_ts, items_summary FROM standing_orders WHERE user_id = $1 ORDER BY id", user_id))
+        except _DB_ERRORS as e:
+            logger.error("DB error getting standing orders for user %s: %s", user_id, e)
+            return []
+
+    async def delete_standing_order(self, standing_id, user_id):
+        try:
+            return _rowcount(await self.pool.execute("DELETE FROM standing_orders WHERE id = $1 AND user_id = $2", standing_id, user_id)) > 0
+        except _DB_ERRORS as e:
+            logger.error("DB error deleting standing order %s: %s", standing_id, e)
+            return False
+
+    async def materialize_standing_orders(self, now_ts, limit=db_operations.STANDING_ORDER_BATCH_SIZE):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                # SKIP LOCKED: a second runner takes the next batch instead of waiting for (and then repeating) this one.
+                due_rows = _tuples(await conn.fetch("SELECT id, user_id, user_name, username, items_json, weekday, next_run_ts FROM standing_orders "
+                                                    "WHERE next_run_ts <= $1 ORDER BY next_run_ts, id LIMIT $2 FOR UPDATE SKIP LOCKED", now_ts, limit))
+                product_ids = sorted({line['id'] for row in due_rows for line in json.loads(row[4])})
+                products = {record['id']: (record['name'], record['price_per_kg'], record['is_available'])
+                            for record in await conn.fetch("SELECT id, name, price_per_kg, is_available FROM products WHERE id = ANY($1::int[])", product_ids)} if product_ids else {}
+                runs = db_operations.plan_standing_order_runs(due_rows, products, now_ts)
+                for run in runs:
+                    run['order_id'] = None
+                    if run['items']:
+                        run['order_id'] = (await self._insert_order(conn, run['user_id'], run['user_name'], run['items'], run['total_price'], now_ts, run['idempotency_key'])
+                                           or await conn.fetchval("SELECT id FROM orders WHERE idempotency_key = $1", run['idempotency_key']))
+                await conn.executemany("UPDATE standing_orders SET next_run_ts = $1, last_order_id = COALESCE($2, last_order_id) WHERE id = $3",
+                                       [(run['next_run_ts'], run['order_id'], run['standing_id']) for run in runs])
+                await conn.executemany("INSERT INTO outbox (event_type, payload, created_ts, next_attempt_ts) VALUES ($1, $2, $3, $3)",
+                                       [(event_type, json.dumps(payload, ensure_ascii=False), int(time.time())) for event_type, payload in db_operations.standing_order_events(runs)])
+        except _DB_ERRORS as e:
+            logger.error("DB error materializing standing orders: %s", e)
+            return None
+        if runs: logger.info("Materialized %s standing orders (%s placed).", len(runs), sum(1 for run in runs if run['order_id']))
+        return runs
+
+    async def get_sales_stats(self, today, week_start, month_start, top_n=5):
+        stats = {}
+        try:
+            async with self.pool.acquire() as conn:
+                for label, first_day in (("today", today), ("week", week_start), ("month", month_start)):
+                    stats[label] = tuple(await conn.fetchrow("SELECT COALESCE(SUM(orders_count), 0), COALESCE(SUM(revenue), 0), COALESCE(SUM(completed_count), 0) "
+                                                             "FROM sales_daily WHERE day >= $1 AND day <= $2", first_day, today))
+                stats['daily'] = _tuples(await conn.fetch("SELECT day, orders_count, revenue FROM sales_daily WHERE day >= $1 AND day <= $2 ORDER BY day DESC", week_start, today))
+                stats['top_products'] = _tuples(await conn.fetch("SELECT product_name, SUM(quantity_kg), SUM(revenue) FROM sales_daily_product WHERE day >= $1 AND day <= $2 "
+                                                                 "GROUP BY product_name ORDER BY SUM(revenue) DESC LIMIT $3", month_start, today, top_n))
+        except _DB_ERRORS as e:
+            logger.error("DB error reading sales stats: %s", e)
+            return {}
+        return stats
+
+    async def rebuild_sales_rollups(self):
+        """ As db_operations.rebuild_sales_rollups, aggregated on the server: live orders plus the purged totals. """
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                days = [row[0] for row in await conn.fetch(f"""
+                    INSERT INTO sales_daily (day, orders_count, revenue, completed_count, completed_revenue)
+                    SELECT day, SUM(orders_count), SUM(revenue), SUM(completed_count), SUM(completed_revenue) FROM (
+                        {_PG_DAILY_ROLLUP.format("TRUE")}
+                        UNION ALL SELECT day, orders_count, revenue, completed_count, completed_revenue FROM sales_purged_daily
+                    ) rollup GROUP BY day
+                    ON CONFLICT (day) DO UPDATE SET orders_count = EXCLUDED.orders_count, revenue = EXCLUDED.revenue,
+                        completed_count = EXCLUDED.completed_count, completed_revenue = EXCLUDED.completed_revenue
+                    RETURNING day
+                """, _pg_timezone())]
+                await conn.execute("DELETE FROM sales_daily_product WHERE day = ANY($1::text[])", days)
+                await conn.execute(f"""
+                    INSERT INTO sales_daily_product (day, product_name, orders_count, quantity_kg, revenue)
+                    SELECT day, product_name, SUM(orders_count), SUM(quantity_kg), SUM(revenue) FROM (
+                        {_PG_PRODUCT_ROLLUP.format("TRUE")}
+                        UNION ALL SELECT day, product_name, orders_count, quantity_kg, revenue FROM sales_purged_daily_product
+                    ) rollup GROUP BY day, product_name
+                """, _pg_timezone())
+        except _DB_ERRORS as e:
+            logger.error("DB error rebuilding sales rollups: %s", e)
+            return -1
+        logger.info("Rebuilt sales rollups for %s days.", len(days))
+        return len(days)
+
+    # --- Outbox ---
+    async def get_due_outbox_events(self, limit=50):
+        try:
+            async with self.pool.acquire() as conn:
+                records = await conn.fetch("SELECT id, event_type, payload, attempts FROM outbox WHERE status = 'pending' AND next_attempt_ts <= $1 ORDER BY id LIMIT $2",
+                                           int(time.time()), limit)
+                delivered = {}
+                if records:
+                    for event_id, recipient_id in await conn.fetch("SELECT event_id, recipient_id FROM outbox_deliveries WHERE status IN ('sent', 'unreachable') AND event_id = ANY($1::bigint[])",
+                                                                   [record[0] for record in records]):
+                        delivered.setdefault(event_id, set()).add(recipient_id)
+        except _DB_ERRORS as e:
+            logger.error("DB error reading due outbox events: %s", e)
+            return []
+        return [(event_id, event_type, json.loads(payload), attempts, delivered.get(event_id, set()))
+                for event_id, event_type, payload, attempts in records]
+
+    async def record_outbox_delivery(self, event_id, recipient_id, status, error=None):
+        try:
+            await self.pool.execute("""
+                INSERT INTO outbox_deliveries (event_id, recipient_id, status, attempts, delivered_ts, last_error) VALUES ($1, $2, $3, 1, $4, $5)
+                ON CONFLICT (event_id, recipient_id) DO UPDATE SET status = EXCLUDED.status, attempts = outbox_deliveries.attempts + 1,
+                    delivered_ts = EXCLUDED.delivered_ts, last_error = EXCLUDED.last_error
+            """, event_id, recipient_id, status, int(time.time()) if status == 'sent' else None, error)
+            return True
+        except _DB_ERRORS as e:
+            logger.error("DB error recording outbox delivery %s -> %s: %s", event_id, recipient_id, e)
+            return False
+
+    async def finish_outbox_event(self, event_id, delivered, attempts, error=None):
+        status, attempts, next_attempt_ts = db_operations.next_outbox_state(delivered, attempts)
+        try:
+            await self.pool.execute("UPDATE outbox SET status = $1, attempts = $2, next_attempt_ts = $3, last_error = $4 WHERE id = $5",
+                                    status, attempts, next_attempt_ts, error, event_id)
+        except _DB_ERRORS as e:
+            logger.error("DB error finishing outbox event %s: %s", event_id, e)
+            return False
+        if status == 'failed': logger.error("Outbox event %s gave up after %s attempts: %s", event_id, attempts, error)
+        return True
+
+
+def configuration_error() -> str | None:
+    """ Why the configured backend cannot be used, or None. Checked by bot.configure before anything starts. """
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        return f"STORAGE_BACKEND must be one of {', '.join(STORAGE_BACKENDS)}, got '{STORAGE_BACKEND}'."
+    if STORAGE_BACKEND == "postgres":
+        if asyncpg is None: return "STORAGE_BACKEND=postgres needs the asyncpg package (pip install asyncpg)."
+        if not DATABASE_URL: return "STORAGE_BACKEND=postgres needs DATABASE_URL."
+    return None
+
+backend: Storage = PostgresStorage(DATABASE_URL) if STORAGE_BACKEND == "postgres" else SqliteStorage()